@@ -10,13 +10,21 @@ import urllib.request
 import urllib.error
 import shutil
 import re
+import copy
+import atexit
+import zlib
+import heapq
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, g
+import click
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import text
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import QueuePool
 from werkzeug.security import generate_password_hash, check_password_hash
-from functools import wraps
+from functools import wraps, lru_cache
 
 app = Flask(__name__)
 app.secret_key = "globalmarket_fixed_secret_key"
@@ -44,6 +52,145 @@ FACTORY_CONFIG = {
     "textile_mill": {"name": "Tekstil Atölyesi", "type": "Tekstil", "rate": 3, "capacity": 400, "unlock_lvl": 4, "cost": 4000, "worker_capacity": 8, "duration_min": 10}
 }
 
+# 1 birim çıktı için tüketilen girdiler; listede olmayan fabrikalar ham üretici
+RECIPES = {
+    "steel_mill": {"Demir": 2},
+    "electronics_factory": {"Plastik": 2, "Çelik": 1},
+}
+
+# Tarif tablosu seviye başına bu seviyeye kadar önceden hesaplanır
+RECIPE_TABLE_LEVELS = 50
+
+class RecipeGraph:
+    """Tarifler açılışta bir kez derlenir: fabrikalar girdi -> çıktı
+    bağımlılığına göre topolojik sıralanır (üst zincirin çıktısı aynı toplama
+    geçişinde alt zincire girer), girdi oranları tuple'a, seviye başı aralık
+    üretimi ve girdi ihtiyacı tabloya çevrilir."""
+
+    def __init__(self, factories, recipes):
+        unknown = set(recipes) - set(factories)
+        if unknown:
+            raise ValueError(f"Tarifte bilinmeyen fabrika: {', '.join(sorted(unknown))}")
+        producers = {}
+        for fid, conf in factories.items():
+            producers.setdefault(conf['type'], []).append(fid)
+        self.inputs = {}
+        for fid in factories:
+            ins = tuple(sorted(recipes.get(fid, {}).items()))
+            if any(int(r) != r or r <= 0 for _, r in ins):
+                raise ValueError(f"{fid}: girdi oranları pozitif tam sayı olmalı")
+            self.inputs[fid] = ins
+        deps = {fid: {p for item, _ in self.inputs[fid] for p in producers.get(item, ()) if p != fid}
+                for fid in factories}
+        self.order = self._topo_sort(list(factories), deps)
+        self.table = {fid: tuple(self._throughput(conf, self.inputs[fid], lvl) for lvl in range(RECIPE_TABLE_LEVELS + 1))
+                      for fid, conf in factories.items()}
+        self._factories = factories
+
+    @staticmethod
+    def _topo_sort(fids, deps):
+        # Kahn; hazır düğümler FACTORY_CONFIG sırasıyla çıkar, sıra kararlı kalır
+        index = {fid: i for i, fid in enumerate(fids)}
+        pending = {fid: len(deps[fid]) for fid in fids}
+        users = {fid: [] for fid in fids}
+        for fid in fids:
+            for dep in deps[fid]:
+                users[dep].append(fid)
+        ready = [index[fid] for fid in fids if pending[fid] == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            fid = fids[heapq.heappop(ready)]
+            order.append(fid)
+            for nxt in users[fid]:
+                pending[nxt] -= 1
+                if pending[nxt] == 0:
+                    heapq.heappush(ready, index[nxt])
+        if len(order) != len(fids):
+            raise ValueError(f"Tariflerde döngü var: {', '.join(f for f in fids if pending[f])}")
+        return tuple(order)
+
+    @staticmethod
+    def _throughput(conf, inputs, level):
+        out = conf['rate'] * level
+        return out, tuple((item, ratio * out) for item, ratio in inputs)
+
+    def throughput(self, fid, level):
+        """Seviyedeki aralık başı (çıktı, ((girdi, miktar), ...))."""
+        table = self.table[fid]
+        if level < len(table): return table[level]
+        return self._throughput(self._factories[fid], self.inputs[fid], level)
+
+    def max_output(self, fid, inventory, want):
+        """En kıt girdinin izin verdiği üretim (want ile sınırlı)."""
+        for item, ratio in self.inputs[fid]:
+            want = min(want, int(inventory.get(item, 0)) // ratio)
+        return want
+
+    def consume(self, fid, inventory, produced, consumed=None):
+        for item, ratio in self.inputs[fid]:
+            used = ratio * produced
+            inventory[item] = inventory.get(item, 0) - used
+            if consumed is not None:
+                consumed[item] = consumed.get(item, 0) + used
+
+    def unit_value(self, fid, prices):
+        """Birim çıktının katma değeri: çıktı fiyatı eksi girdi maliyeti."""
+        conf = self._factories[fid]
+        return prices.get(conf['type'], 0) - sum(prices.get(item, 0) * ratio for item, ratio in self.inputs[fid])
+
+RECIPE_GRAPH = RecipeGraph(FACTORY_CONFIG, RECIPES)
+
+LAND_OPTIONS = {
+    "Tarla": {"base_price": 1000, "locations": {"Kırsal": 0.9, "Şehir": 1.1}},
+    "Sanayi Arsası": {"base_price": 5000, "locations": {"Kırsal": 0.95, "Şehir": 1.2}},
+    "Şehir Arsası": {"base_price": 10000, "locations": {"Kırsal": 1.0, "Şehir": 1.4}}
+}
+LAND_SIZES = {"Küçük": 1.0, "Orta": 1.8, "Büyük": 3.2}
+
+WORKER_TYPES = {
+    "İşçi": {"salary": 50, "productivity": 1.0},
+    "Usta": {"salary": 120, "productivity": 1.5},
+    "Mühendis": {"salary": 300, "productivity": 2.0}
+}
+
+VEHICLE_TYPES = {
+    "Kamyon": {"capacity": 100, "price": 250000},
+    "Tır": {"capacity": 500, "price": 1000000},
+    "Uçak": {"capacity": 2000, "price": 10000000},
+    "Gemi": {"capacity": 10000, "price": 50000000}
+}
+
+EXPEDITION_TYPES = {
+    "short": {"name": "Kısa Mesafe", "time": 300, "cost": 100, "reward_mult": 1.5},
+    "medium": {"name": "Orta Mesafe", "time": 900, "cost": 500, "reward_mult": 2.0},
+    "long": {"name": "Uzun Mesafe", "time": 3600, "cost": 2000, "reward_mult": 3.0}
+}
+
+# ---------------------------------------------------------
+# GAME CONFIG REGISTRY
+# ---------------------------------------------------------
+# İstemcinin ihtiyaç duyduğu sabit ayarlar açılışta tek gövdeye serileştirilir;
+# sürüm içeriğin özeti. /api/config bu gövdeyi ETag ile sunar, sık çağrılan
+# yanıtlar (/api/me, /api/user/me) yalnızca config_version taşır.
+
+def _build_game_config():
+    config = {
+        "factories": FACTORY_CONFIG,
+        "recipes": RECIPES,
+        "recipe_order": list(RECIPE_GRAPH.order),
+        "land": {"options": LAND_OPTIONS, "sizes": LAND_SIZES},
+        "workers": WORKER_TYPES,
+        "vehicles": VEHICLE_TYPES,
+        "expeditions": EXPEDITION_TYPES,
+    }
+    canonical = json.dumps(config, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    version = hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+    body = json.dumps({"version": version, **config}, ensure_ascii=False, separators=(",", ":"))
+    return version, body.encode("utf-8")
+
+CONFIG_VERSION, _CONFIG_BODY = _build_game_config()
+
 def _normalize_username(u: str) -> str:
     return str(u or "").strip()
 
@@ -68,16 +215,205 @@ if not database_url:
     database_url = f"sqlite:///{os.path.join(os.path.abspath(os.path.dirname(__file__)), 'render.db')}"
     print("UYARI: DATABASE_URL yok, SQLite kullanılıyor")
 
+# Bağlantı havuzu: worker başına DB_POOL_SIZE kalıcı + DB_MAX_OVERFLOW geçici
+# bağlantı. Toplam = worker sayısı x (size + overflow), DB'nin
+# max_connections sınırının altında kalmalı.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "1") != "0"
+
+_pool_stats = {"checkouts": 0, "connects": 0, "invalidated": 0, "timeouts": 0,
+               "wait_ms_total": 0.0, "wait_ms_max": 0.0, "waits": 0}
+_pool_stats_lock = threading.Lock()
+
+class _InstrumentedQueuePool(QueuePool):
+    """QueuePool + bağlantı bekleme süresi ve zaman aşımı sayaçları."""
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            return super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            with _pool_stats_lock: _pool_stats["timeouts"] += 1
+            raise
+        finally:
+            ms = (time.perf_counter() - t0) * 1000.0
+            with _pool_stats_lock:
+                _pool_stats["wait_ms_total"] += ms
+                if ms > _pool_stats["wait_ms_max"]: _pool_stats["wait_ms_max"] = ms
+                if ms >= 1.0: _pool_stats["waits"] += 1
+
+def _engine_options(url):
+    if url.startswith("sqlite") and ":memory:" in url:
+        return {}
+    opts = {"poolclass": _InstrumentedQueuePool, "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT}
+    if not url.startswith("sqlite"):
+        # Uzak DB: bayat bağlantıyı kullanmadan önce yokla, idle kesilmeden yenile
+        opts.update(pool_pre_ping=DB_POOL_PRE_PING, pool_recycle=DB_POOL_RECYCLE)
+    return opts
+
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = _engine_options(database_url)
 db = SQLAlchemy(app)
 
+def _pool_telemetry(engine):
+    def _count(key):
+        def handler(*args):
+            with _pool_stats_lock: _pool_stats[key] += 1
+        return handler
+    sqlalchemy.event.listen(engine, "checkout", _count("checkouts"))
+    sqlalchemy.event.listen(engine, "connect", _count("connects"))
+    sqlalchemy.event.listen(engine, "invalidate", _count("invalidated"))
+
+def pool_stats():
+    with _pool_stats_lock:
+        out = dict(_pool_stats)
+    pool = db.engine.pool
+    out["wait_ms_avg"] = out["wait_ms_total"] / out["checkouts"] if out["checkouts"] else 0.0
+    if isinstance(pool, QueuePool):
+        out.update(size=pool.size(), checked_out=pool.checkedout(),
+                   checked_in=pool.checkedin(), overflow=max(0, pool.overflow()))
+    return out
+
+with app.app_context():
+    _pool_telemetry(db.engine)
+
+# SQLite profili (DATABASE_URL yoksa): WAL ile okuyucular yazarı beklemez,
+# synchronous=NORMAL WAL'da commit başına fsync'i checkpoint'e bırakır
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_KB = int(os.environ.get("SQLITE_CACHE_KB", "32768"))
+SQLITE_MMAP_MB = int(os.environ.get("SQLITE_MMAP_MB", "256"))
+# Arka plan WAL checkpoint aralığı (sn, 0 = kapalı)
+SQLITE_CHECKPOINT_INTERVAL = float(os.environ.get("SQLITE_CHECKPOINT_INTERVAL", "30"))
+
+_SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("busy_timeout", SQLITE_BUSY_TIMEOUT_MS),
+    ("cache_size", -SQLITE_CACHE_KB),
+    ("mmap_size", SQLITE_MMAP_MB * 1024 * 1024),
+    ("temp_store", "MEMORY"),
+    # Checkpoint'i arka plan thread'i yapar; bu sadece emniyet sınırı
+    ("wal_autocheckpoint", 10000),
+)
+
+_SQLITE_WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE", "REPLACE", "SAVEPOINT", "CREATE", "DROP", "ALTER")
+
+def _sqlite_profile(engine):
+    """Her yeni bağlantıya pragmaları uygular. pysqlite BEGIN'i ilk DML'e
+    kadar erteler; SAVEPOINT'ler gerçek bir transaction içinde çalışsın diye
+    BEGIN'i SQLAlchemy emreder.
+
+    Transaction'lar ertelenmiş BEGIN ile açılır, salt okunan istekler
+    yazarları bekletmez. Yazma kilidi ilk yazmada (ya da SAVEPOINT'te)
+    alınır: ertelenmiş transaction'ın okuma görüntüsü, arada başka bir
+    bağlantı commit ettiyse yazmaya yükseltilemez ("database is locked"),
+    bu yüzden o noktada henüz yazılmamış transaction ROLLBACK edilip
+    BEGIN IMMEDIATE ile yeniden açılır. Önceki okumalar eski görüntüden
+    yapılmış olur; kullanıcı yazmalarını version koruması zaten denetler."""
+    def _connect(dbapi_conn, rec):
+        dbapi_conn.isolation_level = None
+        for name, value in _SQLITE_PRAGMAS:
+            dbapi_conn.execute(f"PRAGMA {name} = {value}")
+    def _begin(conn):
+        conn.exec_driver_sql("BEGIN")
+        conn.info["sqlite_write_lock"] = False
+    def _lock_on_first_write(conn, cursor, statement, parameters, context, executemany):
+        if conn.info.get("sqlite_write_lock") is not False: return
+        if not statement.lstrip().upper().startswith(_SQLITE_WRITE_PREFIXES): return
+        conn.info["sqlite_write_lock"] = True
+        raw = conn.connection.driver_connection
+        raw.execute("ROLLBACK")
+        raw.execute("BEGIN IMMEDIATE")
+    sqlalchemy.event.listen(engine, "connect", _connect)
+    sqlalchemy.event.listen(engine, "begin", _begin)
+    sqlalchemy.event.listen(engine, "before_cursor_execute", _lock_on_first_write)
+
+with app.app_context():
+    if db.engine.dialect.name == "sqlite":
+        _sqlite_profile(db.engine)
+
+_checkpoint_stats = {"runs": 0, "busy": 0, "wal_pages": 0, "checkpointed": 0, "last_ms": 0.0, "errors": 0}
+
+def sqlite_profile_report():
+    """Bağlantıda gerçekten etkin olan pragma değerleri."""
+    with db.engine.connect() as conn:
+        return {name: conn.exec_driver_sql(f"PRAGMA {name}").scalar() for name, _ in _SQLITE_PRAGMAS}
+
+def sqlite_checkpoint(mode="PASSIVE"):
+    """WAL'ı ana dosyaya aktarır. PASSIVE okuyucu/yazarı beklemez."""
+    raw = db.engine.raw_connection()
+    try:
+        t0 = time.perf_counter()
+        busy, wal_pages, done = raw.driver_connection.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        _checkpoint_stats["last_ms"] = (time.perf_counter() - t0) * 1000.0
+    finally:
+        raw.close()
+    _checkpoint_stats["runs"] += 1
+    _checkpoint_stats["busy"] += int(busy)
+    _checkpoint_stats["wal_pages"] = wal_pages
+    _checkpoint_stats["checkpointed"] = done
+    return busy, wal_pages, done
+
+def start_sqlite_checkpointer():
+    if SQLITE_CHECKPOINT_INTERVAL <= 0: return
+    def run():
+        while True:
+            time.sleep(SQLITE_CHECKPOINT_INTERVAL)
+            try:
+                with app.app_context():
+                    sqlite_checkpoint()
+            except Exception as e:
+                _checkpoint_stats["errors"] += 1
+                print(f"WAL checkpoint error: {e}")
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+
 # VERİTABANI BAŞLATILACAK - init_db içinde sıfırlanacak
 # Not: Tam sıfırlama init_db() fonksiyonunda yapılıyor
 
-# Concurrency lock
+# Concurrency lock (sadece kayıt: user_id ataması MAX+1 ile yapılıyor)
 lock = threading.Lock()
 
+# Oyuncu bazlı kilit şeritleri; farklı oyuncular birbirini beklemez
+USER_LOCK_STRIPES = int(os.environ.get("USER_LOCK_STRIPES", "64"))
+
+class _UserLocks:
+    """Kullanıcı adına göre şeritlenmiş (striped) kilitler.
+
+    Aynı şeride düşen iki oyuncu nadiren birbirini bekler; iki oyunculu
+    işlemler şeritleri artan sırada aldığı için A→B ile B→A kilitlenmez.
+    RLock: update_user bir hold() bloğunun içinden de çağrılabilir.
+    """
+    def __init__(self, stripes):
+        self._locks = [threading.RLock() for _ in range(max(1, stripes))]
+
+    def _index(self, username):
+        return zlib.crc32(username.lower().encode('utf-8')) % len(self._locks)
+
+    @contextmanager
+    def hold(self, *usernames):
+        idx = sorted({self._index(n) for n in usernames if n})
+        for i in idx: self._locks[i].acquire()
+        try:
+            yield
+        finally:
+            for i in reversed(idx): self._locks[i].release()
+
+user_locks = _UserLocks(USER_LOCK_STRIPES)
+
+# update_user'ın version çakışmasında mutasyonu yeniden deneme sayısı
+USER_CAS_RETRIES = int(os.environ.get("USER_CAS_RETRIES", "5"))
+
+# Kullanıcı belgesi önbelleği (0 = süreç LRU'su kapalı, sadece istek bazlı önbellek)
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "0"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "5"))
+# Ertelenmiş kullanıcı yazmalarının (write-behind) boşaltılma aralığı (sn)
+USER_FLUSH_INTERVAL = float(os.environ.get("USER_FLUSH_INTERVAL", "10"))
+
 # ---------------------------------------------------------
 # DATABASE MODELS
 # ---------------------------------------------------------
@@ -88,6 +424,32 @@ class User(db.Model):
     password_hash = db.Column(db.String, nullable=False)
     data = db.Column(db.Text, nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
+    # Normalize alanlar (NULL = henüz blob'dan taşınmamış kullanıcı)
+    money = db.Column(db.BigInteger)
+    xp = db.Column(db.BigInteger)
+    level = db.Column(db.Integer)
+    net_worth = db.Column(db.BigInteger, index=True)
+    # Optimistic concurrency: her yazma version = version + 1 yapar
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+class UserInventory(db.Model):
+    __tablename__ = 'user_inventory'
+    username = db.Column(db.String, primary_key=True)
+    item = db.Column(db.String, primary_key=True)
+    qty = db.Column(db.BigInteger, nullable=False, default=0)
+
+class UserFactoryState(db.Model):
+    __tablename__ = 'user_factory_state'
+    username = db.Column(db.String, primary_key=True)
+    factory_type = db.Column(db.String, primary_key=True)
+    level = db.Column(db.Integer)
+    storage = db.Column(db.Float)
+    last_update = db.Column(db.Float)
+    last_collect = db.Column(db.Float)
+    run_start = db.Column(db.Float)
+    run_duration = db.Column(db.Float)
+    running = db.Column(db.Integer)
+    boost_until = db.Column(db.Float)
 
 class MarketplaceProduct(db.Model):
     __tablename__ = 'marketplace_products'
@@ -163,6 +525,9 @@ def seed_db():
         try:
             # Seed prices if empty
             row = db.session.execute(text('SELECT COUNT(*) FROM prices')).fetchone()
+            # Okuma transaction'ı kapanır: arka plan göçü araya yazarsa SQLite
+            # eski anlık görüntüden yazmaya izin vermez, yeni transaction bekler
+            db.session.rollback()
             if row and row[0] == 0:
                 items = [
                     ("Odun", 50), ("Taş", 40), ("Demir", 120), ("Kömür", 80),
@@ -171,51 +536,147 @@ def seed_db():
                 ]
                 now = time.time()
                 for name, price in items:
-                    db.session.execute(text('INSERT INTO prices (item, price, last_change, updated_at) VALUES (:i, :p, 0, :t)'),
+                    db.session.execute(text('INSERT INTO prices (item, price, last_change, updated_at) VALUES (:i, :p, 0, :t) '
+                                            'ON CONFLICT (item) DO NOTHING'),
                                  {"i": name, "p": price, "t": now})
+                _prices_written(get_db_connection())
                 db.session.commit()
                 print("Prices Seeded")
         except Exception as e:
             print(f"Seeding failed: {e}")
             db.session.rollback()
 
-def init_db():
+def init_db(reset=False):
+    """Şemayı göçlerle hazırlar ve fiyatları tohumlar.
+    reset=True verilmedikçe hiçbir tablo silinmez."""
     with app.app_context():
         try:
-            print("🔄 VERİTABANI TAMAMEN SIFIRLANIYOR...")
-            
-            # PostgreSQL için sıfırlama - önce her şeyi temizle
-            db.drop_all()
-            print("🗑️ Tüm tablolar silindi")
-            
-            db.create_all()
-            print("✅ SQLAlchemy tabloları oluşturuldu")
+            if reset:
+                print("🔄 VERİTABANI TAMAMEN SIFIRLANIYOR...")
+                db.drop_all()
+                with db.engine.begin() as conn:
+                    for name in _BASE_TABLES:
+                        conn.execute(text(f"DROP TABLE IF EXISTS {name.split(' ', 1)[0]}"))
+                print("🗑️ Tüm tablolar silindi")
             
-            # PostgreSQL uyumlu tablolar oluştur
-            for sql in [
-                "CREATE TABLE IF NOT EXISTS user_ids (username TEXT PRIMARY KEY, user_id INTEGER UNIQUE)",
-                "CREATE TABLE IF NOT EXISTS user_logs (id SERIAL PRIMARY KEY, user_id INTEGER, action TEXT, amount REAL, timestamp REAL)",
-                "CREATE TABLE IF NOT EXISTS market (id SERIAL PRIMARY KEY, satici TEXT, item TEXT, adet INTEGER, fiyat INTEGER, time REAL)",
-                "CREATE TABLE IF NOT EXISTS chat (id SERIAL PRIMARY KEY, username TEXT, message TEXT, time TEXT)",
-                "CREATE TABLE IF NOT EXISTS prices (item TEXT PRIMARY KEY, price REAL NOT NULL, last_change REAL NOT NULL, updated_at REAL NOT NULL)",
-                "CREATE TABLE IF NOT EXISTS system_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
-                "CREATE TABLE IF NOT EXISTS factory_assignments (id SERIAL PRIMARY KEY, owner TEXT NOT NULL, factory_type TEXT NOT NULL, count INTEGER NOT NULL, created_at REAL NOT NULL)",
-                "CREATE TABLE IF NOT EXISTS vehicles (id SERIAL PRIMARY KEY, owner TEXT NOT NULL, type TEXT NOT NULL, capacity INTEGER NOT NULL, created_at REAL NOT NULL)",
-                "CREATE TABLE IF NOT EXISTS logistics_tasks (id SERIAL PRIMARY KEY, owner TEXT NOT NULL, vehicle_id INTEGER NOT NULL, item TEXT NOT NULL, amount INTEGER NOT NULL, destination TEXT NOT NULL, city_scope TEXT NOT NULL, eta REAL NOT NULL, delivered INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL)",
-                "CREATE TABLE IF NOT EXISTS transactions (id SERIAL PRIMARY KEY, owner TEXT NOT NULL, type TEXT NOT NULL, amount INTEGER NOT NULL, balance_after INTEGER, description TEXT, time REAL NOT NULL, meta TEXT)"
-            ]:
-                try:
-                    db.session.execute(text(sql))
-                    print(f"✅ Tablo hazır: {sql.split('(')[0].replace('CREATE TABLE IF NOT EXISTS ', '')}")
-                except Exception as table_error:
-                    print(f"⚠️ Tablo zaten var: {table_error}")
-            
-            print("🎉 VERİTABANI SIFIRLANDI VE HAZIR (PostgreSQL)")
+            version = run_migrations()
+            print(f"🎉 VERİTABANI HAZIR (şema sürümü {version})")
             seed_db()
         except Exception as e: 
             print(f"❌ DB Init Failed: {str(e)}")
             # Transaction olmadan devam et
 
+# ---------------------------------------------------------
+# SCHEMA MIGRATIONS
+# ---------------------------------------------------------
+# Uygulanan son göç system_state'te 'schema_version' olarak tutulur. Her adım
+# idempotenttir (IF NOT EXISTS) ve kendi transaction'ında sürüm kaydıyla
+# birlikte commit edilir. Şema değişikliği = listeye yeni adım; eski adımlar
+# değiştirilmez. Sıcak sorguların planları check_indexes.py ile doğrulanır.
+
+# {pk}: SQLite'ta INTEGER PRIMARY KEY (rowid), Postgres'te SERIAL
+_BASE_TABLES = [
+    "user_ids (username TEXT PRIMARY KEY, user_id INTEGER UNIQUE)",
+    "user_logs (id {pk}, user_id INTEGER, action TEXT, amount REAL, timestamp REAL)",
+    "market (id {pk}, satici TEXT, item TEXT, adet INTEGER, fiyat INTEGER, time REAL)",
+    "chat (id {pk}, username TEXT, message TEXT, time TEXT)",
+    "prices (item TEXT PRIMARY KEY, price REAL NOT NULL, last_change REAL NOT NULL, updated_at REAL NOT NULL)",
+    "system_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    "factory_assignments (id {pk}, owner TEXT NOT NULL, factory_type TEXT NOT NULL, count INTEGER NOT NULL, created_at REAL NOT NULL)",
+    "vehicles (id {pk}, owner TEXT NOT NULL, type TEXT NOT NULL, capacity INTEGER NOT NULL, created_at REAL NOT NULL)",
+    "logistics_tasks (id {pk}, owner TEXT NOT NULL, vehicle_id INTEGER NOT NULL, item TEXT NOT NULL, amount INTEGER NOT NULL, destination TEXT NOT NULL, city_scope TEXT NOT NULL, eta REAL NOT NULL, delivered INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL)",
+    "transactions (id {pk}, owner TEXT NOT NULL, type TEXT NOT NULL, amount INTEGER NOT NULL, balance_after INTEGER, description TEXT, time REAL NOT NULL, meta TEXT)",
+    # Route'ların kullandığı ama daha önce hiç oluşturulmayan tablolar
+    "lands (id {pk}, owner TEXT NOT NULL, type TEXT NOT NULL, size INTEGER, location TEXT, price INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL)",
+    "workers (id {pk}, owner TEXT NOT NULL, type TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0, salary INTEGER, productivity REAL, created_at REAL NOT NULL)",
+    "resources (id {pk}, owner TEXT NOT NULL, item TEXT NOT NULL, quantity INTEGER NOT NULL, updated_at REAL NOT NULL)",
+    "buildings (id {pk}, owner TEXT NOT NULL, type TEXT NOT NULL, level INTEGER NOT NULL DEFAULT 1, created_at REAL NOT NULL)",
+    "news (id {pk}, title TEXT NOT NULL, body TEXT, created_at REAL NOT NULL)",
+]
+
+def _m001_base_tables(conn):
+    db.metadata.create_all(conn)
+    pk = "INTEGER PRIMARY KEY" if conn.dialect.name == "sqlite" else "SERIAL PRIMARY KEY"
+    for ddl in _BASE_TABLES:
+        conn.execute(text("CREATE TABLE IF NOT EXISTS " + ddl.format(pk=pk)))
+
+def _m002_user_columns(conn):
+    # Normalize kullanıcı kolonları (blob'dan taşınan money/xp/level/net_worth + version)
+    have = {c['name'] for c in sqlalchemy.inspect(conn).get_columns('users')}
+    for col, typ in (("money", "BIGINT"), ("xp", "BIGINT"), ("level", "INTEGER"), ("net_worth", "BIGINT"),
+                     ("version", "INTEGER NOT NULL DEFAULT 0")):
+        if col not in have:
+            conn.execute(text(f"ALTER TABLE users ADD COLUMN {col} {typ}"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_net_worth ON users (net_worth)"))
+
+def _m003_hot_lookup_indexes(conn):
+    for ddl in (
+        "ix_lands_owner ON lands (owner)",
+        "ix_workers_owner ON workers (owner)",
+        "ix_resources_owner ON resources (owner)",
+        "ix_resources_item ON resources (item)",
+        "ix_buildings_owner ON buildings (owner)",
+        "ix_factory_assignments_owner_type ON factory_assignments (owner, factory_type)",
+        "ix_vehicles_owner ON vehicles (owner)",
+        "ix_logistics_tasks_owner_created ON logistics_tasks (owner, created_at)",
+        "ix_transactions_type_time ON transactions (type, time)",
+        "ix_marketplace_products_name_bot ON marketplace_products (name, is_bot)",
+        "ix_marketplace_products_created ON marketplace_products (created_at)",
+        "ix_user_logs_user_ts ON user_logs (user_id, timestamp)",
+        "ix_market_time ON market (time)",
+        # chat.id sırası: PK indeksi (SQLite'ta rowid) yeterli, ayrı indeks yok
+        # _find_username_ci: LOWER(username) = LOWER(?)
+        "ix_users_username_lower ON users (LOWER(username))",
+    ):
+        conn.execute(text("CREATE INDEX IF NOT EXISTS " + ddl))
+
+def _m004_timer_events(conn):
+    pk = "INTEGER PRIMARY KEY" if conn.dialect.name == "sqlite" else "SERIAL PRIMARY KEY"
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS timer_events (id {pk}, username TEXT NOT NULL, kind TEXT NOT NULL, "
+                      "target TEXT NOT NULL, due REAL NOT NULL, fired_at REAL NOT NULL)"))
+    # Aynı etki bir kez kaydedilir (birden fazla worker aynı heap'i taşır)
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_timer_events_once ON timer_events (username, kind, target, due)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_timer_events_user_id ON timer_events (username, id)"))
+
+def _m005_order_book(conn):
+    # market emir defteri olur: mevcut ilanlar satış emri
+    have = {c['name'] for c in sqlalchemy.inspect(conn).get_columns('market')}
+    if 'side' not in have:
+        conn.execute(text("ALTER TABLE market ADD COLUMN side TEXT NOT NULL DEFAULT 'sell'"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_market_side_time ON market (side, time)"))
+
+MIGRATIONS = [
+    (1, "temel tablolar", _m001_base_tables),
+    (2, "normalize kullanıcı kolonları", _m002_user_columns),
+    (3, "sıcak sorgu indeksleri", _m003_hot_lookup_indexes),
+    (4, "zamanlı etki olayları", _m004_timer_events),
+    (5, "emir defteri", _m005_order_book),
+]
+
+def schema_version():
+    with db.engine.connect() as conn:
+        try:
+            row = conn.execute(text("SELECT value FROM system_state WHERE key = 'schema_version'")).fetchone()
+        except Exception:
+            return 0
+    return int(row[0]) if row else 0
+
+def run_migrations():
+    """Uygulanmamış göçleri sırayla uygular; son şema sürümünü döner."""
+    current = schema_version()
+    for version, name, step in MIGRATIONS:
+        if version <= current: continue
+        with db.engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                # Aynı anda açılan worker'lar göçü sırayla uygular
+                conn.execute(text("SELECT pg_advisory_xact_lock(4201)"))
+            step(conn)
+            conn.execute(text("INSERT INTO system_state (key, value) VALUES ('schema_version', :v) "
+                              "ON CONFLICT (key) DO UPDATE SET value = excluded.value"), {"v": str(version)})
+        print(f"✅ Şema göçü {version}: {name}")
+        current = version
+    return current
+
 def create_admin_if_not_exists():
     with app.app_context():
         try:
@@ -230,51 +691,231 @@ def create_admin_if_not_exists():
             print(f"Admin creation failed: {e}")
             # Transaction olmadan devam et
 
+# ---------------------------------------------------------
+# UNIT OF WORK
+# ---------------------------------------------------------
+# İstek başına tek transaction: istek içindeki tüm yazmalar (kullanıcı
+# belgeleri dahil) cevap dönmeden önce tek commit ile kalıcı olur.
+# DB_UNIT_OF_WORK=0 eski "her DML'den sonra commit" davranışına döner.
+DB_UNIT_OF_WORK = os.environ.get("DB_UNIT_OF_WORK", "1") != "0"
+
+_tx_stats = {"requests": 0, "commits": 0, "rollbacks": 0, "statements": 0, "writes": 0,
+             "commit_ms_total": 0.0, "commit_ms_max": 0.0}
+_tx_stats_lock = threading.Lock()
+
+def _unit_of_work():
+    """Aktif isteğin iş birimi (yoksa None)."""
+    if not DB_UNIT_OF_WORK or not has_request_context(): return None
+    return g.get('_uow')
+
+def _timed_commit():
+    t0 = time.perf_counter()
+    db.session.commit()
+    ms = (time.perf_counter() - t0) * 1000.0
+    with _tx_stats_lock:
+        _tx_stats["commits"] += 1
+        _tx_stats["commit_ms_total"] += ms
+        if ms > _tx_stats["commit_ms_max"]: _tx_stats["commit_ms_max"] = ms
+
+def db_commit():
+    """İş birimi içindeyse commit istek sonuna kalır, değilse hemen yapılır."""
+    if _unit_of_work() is None: _timed_commit()
+
+def release_session():
+    """İş birimi dışında session'ı havuza iade eder; istek içinde açık kalır."""
+    if _unit_of_work() is None: db.session.remove()
+
+@contextmanager
+def savepoint(nested=False):
+    """Atomik blok: iş birimi içinde (ya da nested=True ile toplu yazmada)
+    SAVEPOINT, dışında tam rollback. Blok hata verirse sadece bloğun
+    yazmaları geri alınır."""
+    if nested or _unit_of_work() is not None:
+        with db.session.begin_nested():
+            yield
+        return
+    try:
+        yield
+    except Exception:
+        db.session.rollback()
+        raise
+
+def tx_stats():
+    with _tx_stats_lock:
+        out = dict(_tx_stats)
+    out["commit_ms_avg"] = out["commit_ms_total"] / out["commits"] if out["commits"] else 0.0
+    out["commits_per_request"] = out["commits"] / out["requests"] if out["requests"] else 0.0
+    return out
+
+@app.before_request
+def begin_unit_of_work():
+    if DB_UNIT_OF_WORK:
+        g._uow = {"writes": 0, "failed": False, "users": set(), "on_rollback": []}
+
+def on_rollback(fn):
+    """İş birimi geri alınırsa fn çağrılır: commit'ten önce belleğe uygulanmış
+    bir değişikliği geçersiz kılmak için. İş birimi yoksa yazma zaten commit
+    edilmiştir, hiçbir şey yapılmaz."""
+    uow = _unit_of_work()
+    if uow is not None: uow.setdefault("on_rollback", []).append(fn)
+
+def _rollback_unit_of_work(uow):
+    db.session.rollback()
+    with _tx_stats_lock: _tx_stats["rollbacks"] += 1
+    for name in uow["users"]: _forget_user(name)
+    for fn in uow.get("on_rollback", ()): fn()
+
+def abort_unit_of_work():
+    """İstek yarıda kaldı: commit edilmemiş her şeyi geri al."""
+    uow = _unit_of_work()
+    if uow is None: return
+    uow["failed"] = True
+
+def commit_unit_of_work(resp):
+    """Kirli kullanıcıları yazar ve isteğin transaction'ını tek seferde
+    commit eder. Hata ve 2xx/3xx dışındaki cevaplarda rollback yapılır;
+    yazması düşmüş bir istek başarılı cevap dönmez (409/500)."""
+    uow = _unit_of_work()
+    if uow is None:
+        # DB_UNIT_OF_WORK=0: her belge kendi commit'iyle yazılır
+        if has_request_context() and g.get('_dirty_users'):
+            try:
+                ok = _flush_dirty_users()
+            except Exception:
+                return app.make_response((jsonify({"success": False, "message": "İşlem kaydedilemedi, tekrar deneyin"}), 500))
+            backup_database()
+            if not ok and resp.status_code < 400:
+                return app.make_response(user_conflict_error(None))
+        return resp
+    g._uow = None
+    with _tx_stats_lock: _tx_stats["requests"] += 1
+    if not uow["failed"] and resp.status_code < 400:
+        try:
+            if not _flush_dirty_users(uow):
+                uow["failed"] = "conflict"
+        except Exception:
+            uow["failed"] = True
+    else:
+        g.pop('_dirty_users', None)
+    if uow["failed"] or resp.status_code >= 400:
+        _rollback_unit_of_work(uow)
+        if resp.status_code < 400:
+            # Yazma düştü: başarılı görünen cevap geri alınan işi bildirmesin
+            if uow["failed"] == "conflict":
+                return app.make_response(user_conflict_error(None))
+            return app.make_response((jsonify({"success": False, "message": "İşlem kaydedilemedi, tekrar deneyin"}), 500))
+        return resp
+    try:
+        _timed_commit()
+    except Exception as e:
+        print(f"unit of work commit error: {e}")
+        _rollback_unit_of_work(uow)
+        return app.make_response((jsonify({"success": False, "message": "İşlem kaydedilemedi, tekrar deneyin"}), 500))
+    if uow["writes"]: backup_database()
+    return resp
+
 # ---------------------------------------------------------
 # HELPERS
 # ---------------------------------------------------------
 
 class _DictRow:
-    def __init__(self, mapping):
-        self._d = dict(mapping)
-    def __getitem__(self, k): return self._d[k]
-    def get(self, k, d=None): return self._d.get(k, d)
-    def keys(self): return self._d.keys()
-    def items(self): return self._d.items()
-    def __iter__(self): return iter(self._d)
+    """Satırın sütun adlı görünümü. RowMapping'i sarar, kopyalamaz;
+    dict(r) ile tek seferde düz dict'e çevrilebilir."""
+    __slots__ = ("_m",)
+    def __init__(self, mapping): self._m = mapping
+    def __getitem__(self, k): return self._m[k]
+    def get(self, k, d=None): return self._m.get(k, d)
+    def keys(self): return self._m.keys()
+    def values(self): return self._m.values()
+    def items(self): return self._m.items()
+    def __iter__(self): return iter(self._m)
+    def __len__(self): return len(self._m)
+    def __contains__(self, k): return k in self._m
+    def __repr__(self): return f"_DictRow({dict(self._m)!r})"
 
 class _SAResultWrapper:
+    """Sonucu tembel okur: fetchone tek satır çekip imleci kapatır,
+    iterasyon satırları akıtır, fetchall sadece görünüm listesi kurar."""
+    __slots__ = ("_res", "rowcount")
     def __init__(self, res):
-        self._rows = []
-        if res:
-            for r in res.fetchall():
-                m = getattr(r, "_mapping", None)
-                self._rows.append(_DictRow(m if m is not None else dict(r)))
+        self._res = None
+        self.rowcount = -1
+        if res is not None:
+            self.rowcount = res.rowcount
+            if res.returns_rows: self._res = res
+            else: res.close()
+    def __iter__(self):
+        res, self._res = self._res, None
+        if res is None: return
+        try:
+            for r in res:
+                yield _DictRow(r._mapping)
+        finally:
+            res.close()
+    def fetchall(self): return list(self)
+    def fetchone(self):
+        res, self._res = self._res, None
+        if res is None: return None
+        try:
+            r = res.fetchone()
+            return _DictRow(r._mapping) if r is not None else None
+        finally:
             res.close()
-    def fetchall(self): return self._rows
-    def fetchone(self): return self._rows[0] if self._rows else None
+    def close(self):
+        res, self._res = self._res, None
+        if res is not None: res.close()
+
+# Derlenmiş SQL önbelleği: aynı birkaç düzine SQL metni sürekli çalışıyor;
+# ?→:pN çevirisi, text() ve ifade türü metin başına bir kez hesaplanır
+SQL_CACHE_SIZE = int(os.environ.get("SQL_CACHE_SIZE", "512"))
+
+@lru_cache(maxsize=SQL_CACHE_SIZE)
+def _compile_sql(sql, qmark):
+    """SQL metnini (TextClause, bind anahtarları, yazma mı) üçlüsüne derler.
+    qmark=True ise ? yer tutucuları sırayla :p0, :p1 ... olur."""
+    keys = ()
+    if qmark:
+        parts = sql.split('?')
+        keys = tuple(f"p{i}" for i in range(len(parts) - 1))
+        sql = parts[0] + "".join(f":{k}{p}" for k, p in zip(keys, parts[1:]))
+    return text(sql), keys, sql.lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE"))
 
 class _SAConnection:
     def __init__(self, session): self._session = session
     def cursor(self): return self
     def execute(self, sql, params=()):
-        if isinstance(params, (list, tuple)):
-            out, bind, idx = [], {}, 0
-            for ch in sql:
-                if ch == '?':
-                    key = f"p{idx}"; out.append(f":{key}"); bind[key] = params[idx]; idx += 1
-                else: out.append(ch)
-            sql, params = "".join(out), bind
+        qmark = isinstance(params, (list, tuple))
+        clause, keys, is_write = _compile_sql(sql, qmark)
+        if qmark:
+            if len(params) < len(keys): raise IndexError("SQL parametre sayısı eksik")
+            params = dict(zip(keys, params))
+        uow = _unit_of_work()
+        with _tx_stats_lock:
+            _tx_stats["statements"] += 1
+            if is_write: _tx_stats["writes"] += 1
         try:
-            res = self._session.execute(text(sql), params)
-            if sql.lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE")): self._session.commit()
+            if uow is not None and is_write:
+                # İş birimi: commit yok; hata sadece bu ifadeyi geri alır
+                with self._session.begin_nested():
+                    out = _SAResultWrapper(self._session.execute(clause, params))
+                uow["writes"] += 1
+                return out
+            res = self._session.execute(clause, params)
+            if is_write: _timed_commit()
             return _SAResultWrapper(res)
         except Exception:
+            if uow is not None:
+                # Yazmada SAVEPOINT geri alındı; okuma hatası transaction'ı
+                # bozar (Postgres). İkisinde de istek yarım kaydedilmez,
+                # geri alma istek sonunda tek seferde yapılır
+                uow["failed"] = True
+                raise
             self._session.rollback()
             return _SAResultWrapper(None)
     def commit(self):
-        try: self._session.commit()
+        try: db_commit()
         except Exception: pass
+    def savepoint(self): return savepoint()
     def close(self): pass
     def __enter__(self): return self
     def __exit__(self, et, e, tb): pass
@@ -283,31 +924,108 @@ def get_db_connection(): return _SAConnection(db.session)
 
 @app.teardown_appcontext
 def shutdown_session(exception=None):
+    # Bağlantı havuza döner; engine dispose edilmez
     db.session.remove()
-    if app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}).get('poolclass') == NullPool:
-        db.engine.dispose()
 
 @app.after_request
 def cleanup(resp):
-    db.session.remove()
-    return resp
+    return commit_unit_of_work(resp)
 
 # ---------------------------------------------------------
 # GLOBAL EVENT SYSTEM
 # ---------------------------------------------------------
-def _get_current_event():
-    conn = get_db_connection()
-    row = conn.execute("SELECT value FROM system_state WHERE key = 'current_event'").fetchone()
-    conn.close()
-    if not row:
-        return None
-    try:
-        ev = json.loads(row['value'])
-        if time.time() >= ev.get('end_time', 0):
+# Olay durumu süreç içinde önbellekte tutulur. _set/_clear_current_event aynı
+# transaction'da system_state'teki 'event_version'ı artırır; diğer worker'lar
+# istek başına bir kez bu sürümü okur, değişmişse olayı yeniden yükler.
+# Olay end_time'ı geçince DB'ye gitmeden kendiliğinden düşer. Üretim olayları
+# ayrıca 'production_events' geçmişinde segment olarak kalır: bitmiş bir olayın
+# bankalanmamış birikimdeki payı olay bitince kaybolmaz.
+
+class _EventCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.event = None
+        self.production = ()
+        self.reloads = 0
+
+    def _db_version(self):
+        # İstek içinde bir kez; arka plan döngüleri her çağrıda okur
+        if has_request_context() and '_event_version' in g: return g._event_version
+        conn = get_db_connection()
+        row = conn.execute("SELECT value FROM system_state WHERE key = 'event_version'").fetchone()
+        conn.close()
+        version = row['value'] if row else '0'
+        if has_request_context(): g._event_version = version
+        return version
+
+    def _load(self):
+        conn = get_db_connection()
+        rows = {r['key']: r['value'] for r in conn.execute(
+            "SELECT key, value FROM system_state WHERE key IN ('current_event', 'production_events')").fetchall()}
+        conn.close()
+        try:
+            ev = json.loads(rows['current_event']) if 'current_event' in rows else None
+        except Exception:
+            ev = None
+        try:
+            segs = tuple(tuple(s) for s in json.loads(rows.get('production_events') or '[]'))
+        except Exception:
+            segs = ()
+        return ev, segs
+
+    def _refresh(self):
+        version = self._db_version()
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self.event, self.production = self._load()
+                    self.version = version
+                    self.reloads += 1
+
+    def get(self):
+        self._refresh()
+        ev = self.event
+        if not ev or time.time() >= ev.get('end_time', 0):
             return None
         return ev
-    except Exception:
-        return None
+
+    def production_segments(self):
+        """Bitmiş ve süren üretim olaylarının (çarpan, başlangıç, bitiş) listesi."""
+        self._refresh()
+        return self.production
+
+    def invalidate(self):
+        with self._lock:
+            self.version = None
+        if has_request_context(): g.pop('_event_version', None)
+
+    def stats(self):
+        ev = self.event
+        return {"version": self.version, "reloads": self.reloads,
+                "active": bool(ev and time.time() < ev.get('end_time', 0))}
+
+event_cache = _EventCache()
+
+def _get_current_event():
+    return event_cache.get()
+
+def _bump_state_version(conn, key):
+    """system_state'teki sayaç anahtarını yazmayla aynı transaction'da artırır."""
+    conn.execute("INSERT INTO system_state (key, value) VALUES (?, '1') "
+                 "ON CONFLICT (key) DO UPDATE SET value = CAST(CAST(system_state.value AS INTEGER) + 1 AS TEXT)", (key,))
+
+def _is_production_event(ev):
+    return bool(ev) and ev.get('target', {}).get('type') == 'production'
+
+def _save_production_segments(conn, segs):
+    """Üretim olayı geçmişini yazar. Deposu en eski segmentin başından
+    (MIN(last_update)) önce biten olaylar artık hiçbir birikime girmez, atılır."""
+    row = conn.execute("SELECT MIN(last_update) AS m FROM user_factory_state WHERE level > 0").fetchone()
+    oldest = row['m'] if row and row['m'] is not None else time.time()
+    segs = [list(s) for s in segs if s[2] > oldest]
+    conn.execute("INSERT INTO system_state (key, value) VALUES ('production_events', ?) "
+                 "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (json.dumps(segs),))
 
 def _set_current_event(ev):
     is_pg = db.engine.dialect.name == 'postgresql'
@@ -316,14 +1034,28 @@ def _set_current_event(ev):
         conn.execute("INSERT INTO system_state (key, value) VALUES ('current_event', :v) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value", {"v": json.dumps(ev)})
     else:
         conn.execute("INSERT OR REPLACE INTO system_state (key, value) VALUES ('current_event', ?)", (json.dumps(ev),))
+    if _is_production_event(ev):
+        seg = (float(ev.get('production_multiplier', 1.0)), ev.get('started_at', 0), ev.get('end_time', 0))
+        _save_production_segments(conn, event_cache.production_segments() + (seg,))
+    _bump_state_version(conn, 'event_version')
     conn.commit()
     conn.close()
+    event_cache.invalidate()
 
 def _clear_current_event():
+    ev = _get_current_event()
     conn = get_db_connection()
+    if _is_production_event(ev):
+        # Süresinden önce biten olayın segmenti şimdi kapanır
+        now = time.time()
+        segs = [(m, a, min(b, now)) if (a, b) == (ev.get('started_at', 0), ev.get('end_time', 0)) else (m, a, b)
+                for m, a, b in event_cache.production_segments()]
+        _save_production_segments(conn, segs)
     conn.execute("DELETE FROM system_state WHERE key = 'current_event'")
+    _bump_state_version(conn, 'event_version')
     conn.commit()
     conn.close()
+    event_cache.invalidate()
 
 def _start_random_event():
     now = time.time()
@@ -362,6 +1094,408 @@ def _event_loop():
 t = threading.Thread(target=_event_loop, daemon=True)
 t.start()
 
+# ---------------------------------------------------------
+# PRICE BOOK
+# ---------------------------------------------------------
+# prices tablosu süreç içinde tutulur. Fiyat yazan her yer 'price_version'ı
+# artırıp defteri geçersiz kılar; diğer worker'lar sürümü en fazla
+# PRICE_POLL_SEC'te bir okur. Olay çarpanı uygulanmış fiyatlar (fiyat sürümü,
+# olay sürümü) başına bir kez hesaplanır.
+PRICE_POLL_SEC = float(os.environ.get("PRICE_POLL_SEC", "2"))
+
+def _event_price_multiplier(ev, item):
+    if not ev: return None
+    target = ev.get('target', {})
+    if target.get('type') == 'prices_all' or (target.get('type') == 'item' and target.get('name') == item):
+        return ev.get('price_multiplier', 1.0)
+    return None
+
+class _PriceBook:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self._checked = 0.0
+        self._rows = {}
+        self._effective = (None, {})
+        self.reloads = 0
+
+    def _fresh(self):
+        if self.version is not None and time.monotonic() - self._checked < PRICE_POLL_SEC: return
+        with self._lock:
+            now = time.monotonic()
+            if self.version is not None and now - self._checked < PRICE_POLL_SEC: return
+            conn = get_db_connection()
+            row = conn.execute("SELECT value FROM system_state WHERE key = 'price_version'").fetchone()
+            version = row['value'] if row else '0'
+            if version != self.version:
+                self._rows = {r['item']: dict(r) for r in conn.execute('SELECT * FROM prices').fetchall()}
+                self._effective = (None, {})
+                self.version = version
+                self.reloads += 1
+            conn.close()
+            self._checked = now
+
+    def invalidate(self):
+        with self._lock:
+            self.version = None
+
+    def rows(self):
+        """prices satırları (taban fiyat); paylaşılan dict'ler, değiştirilmez."""
+        self._fresh()
+        return list(self._rows.values())
+
+    def row(self, item):
+        self._fresh()
+        return self._rows.get(item)
+
+    def base(self, item):
+        row = self.row(item)
+        return row['price'] if row else None
+
+    def base_map(self):
+        self._fresh()
+        return {item: r['price'] for item, r in self._rows.items()}
+
+    def effective(self):
+        """{item: olay çarpanı uygulanmış fiyat}."""
+        self._fresh()
+        ev = _get_current_event()
+        key = (self.version, event_cache.version if ev else None)
+        cached_key, prices = self._effective
+        if cached_key == key: return prices
+        prices = {}
+        for item, r in self._rows.items():
+            mult = _event_price_multiplier(ev, item)
+            prices[item] = r['price'] if mult is None else max(1.0, r['price'] * mult)
+        self._effective = (key, prices)
+        return prices
+
+    def effective_rows(self):
+        prices = self.effective()
+        return [dict(r, price=prices[item]) for item, r in self._rows.items() if item in prices]
+
+    def stats(self):
+        return {"version": self.version, "reloads": self.reloads, "items": len(self._rows)}
+
+price_book = _PriceBook()
+
+def _prices_written(conn):
+    """Fiyat yazan kod commit'ten önce çağırır."""
+    _bump_state_version(conn, 'price_version')
+    price_book.invalidate()
+
+# Fiyat motoru: arz/talep güncellemesi GET /api/market yerine arka planda
+# döner. Her kaynak tablo için tek gruplu sorgu, tek toplu UPDATE. Birden çok
+# worker aynı turu çalıştırırsa updated_at koşulu ikinci yazmayı eler.
+PRICE_TICK_SEC = float(os.environ.get("PRICE_TICK_SEC", "10"))
+
+def price_engine_tick(now=None):
+    """Vakti gelen fiyatları arz/talebe göre günceller ve okuyuculara yayınlar."""
+    now = now or time.time()
+    conn = get_db_connection()
+    rows = conn.execute('SELECT item, price, updated_at FROM prices').fetchall()
+    due = [r for r in rows if now - r['updated_at'] >= PRICE_TICK_SEC]
+    stats = {"items": len(rows), "due": len(due), "updated": 0}
+    if due:
+        # Talep: son 50 satış ilanında ürünün geçme sayısı; arz: oyuncu kaynakları
+        demand = {r['item']: r['c'] for r in conn.execute(
+            "SELECT item, COUNT(*) AS c FROM (SELECT item FROM market WHERE side = 'sell' ORDER BY time DESC LIMIT 50) recent GROUP BY item").fetchall()}
+        supply = {r['item']: r['q'] for r in conn.execute(
+            'SELECT item, COALESCE(SUM(quantity),0) AS q FROM resources GROUP BY item').fetchall()}
+        params = []
+        for r in due:
+            delta = demand.get(r['item'], 0) * 0.01 - (supply.get(r['item'], 0) / 1000.0) * 0.01
+            delta = max(-0.05, min(0.05, delta))
+            new_price = max(1.0, r['price'] * (1.0 + delta))
+            params.append({"p": new_price, "c": new_price - r['price'], "t": now, "i": r['item'], "u0": r['updated_at']})
+        # Arka planda okuma transaction'ı kapanır: araya başka yazma girdiyse
+        # SQLite eski anlık görüntüden yazmaya izin vermez (updated_at koşulu korur)
+        if _unit_of_work() is None: db.session.rollback()
+        res = db.session.execute(text('UPDATE prices SET price = :p, last_change = :c, updated_at = :t '
+                                      'WHERE item = :i AND updated_at = :u0'), params)
+        stats["updated"] = max(0, res.rowcount)
+        if stats["updated"]: _prices_written(conn)
+    conn.commit()
+    conn.close()
+    # Commit'ten önce yeniden yüklenmiş olabilecek kopya da düşer
+    if stats["updated"]: price_book.invalidate()
+    return stats
+
+def start_price_engine():
+    def run():
+        while True:
+            time.sleep(PRICE_TICK_SEC)
+            try:
+                with app.app_context():
+                    price_engine_tick()
+            except Exception as e:
+                print(f"price engine error: {e}")
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+
+# ---------------------------------------------------------
+# ORDER BOOK
+# ---------------------------------------------------------
+# market tablosu ürün başına fiyat-zaman öncelikli limit emir defteridir
+# (side: 'sell' satış, 'buy' alış). Süreçte her ürün için iki heap tutulur:
+# en iyi emir O(1) okunur, eşleşen emir O(log n) çıkar; iptal edilen ve dolan
+# emirler _TimerIndex'teki gibi tembel silinir. Satış emri ürünü, alış emri
+# limit fiyatı * adet parayı emanete alır. Eşleşme defterde bekleyen emrin
+# fiyatından olur, alıcıya limit farkı iade edilir; bir emrin bütün
+# eşleşmeleri, iki tarafın kilit şeridi tutulurken tek savepoint'te yazılır.
+# Bellekteki defter yazma başarılı olunca değişir, istek geri alınırsa
+# yeniden kurulur. Defter açılışta tablodan kurulur; her
+# değişiklik system_state'teki 'market_version'ı artırır, başka worker'ın
+# değişikliğini gören süreç defteri yeniden kurar.
+ORDER_BOOK_DEPTH = 5   # /api/market'te ürün başına gösterilen fiyat seviyesi
+
+class _ItemBook:
+    __slots__ = ("asks", "bids", "levels")
+
+    def __init__(self):
+        self.asks = []   # (fiyat, zaman, id)
+        self.bids = []   # (-fiyat, zaman, id)
+        self.levels = {"sell": {}, "buy": {}}   # fiyat -> toplam adet
+
+class _MarketBook:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.version = None
+        self.books = {}
+        self.orders = {}   # id -> emir dict'i
+        self.loads = 0
+        self.matched = 0
+
+    @staticmethod
+    def _key(o):
+        return (o['price'] if o['side'] == 'sell' else -o['price'], o['time'], o['id'])
+
+    def _heap(self, item, side):
+        b = self.books.get(item)
+        if b is None: b = self.books[item] = _ItemBook()
+        return b.asks if side == 'sell' else b.bids
+
+    def _add(self, o, push=True):
+        self.orders[o['id']] = o
+        heap = self._heap(o['item'], o['side'])
+        if push: heapq.heappush(heap, self._key(o))
+        else: heap.append(self._key(o))
+        lv = self.books[o['item']].levels[o['side']]
+        lv[o['price']] = lv.get(o['price'], 0) + o['qty']
+
+    def _reduce(self, o, qty):
+        lv = self.books[o['item']].levels[o['side']]
+        left = lv.get(o['price'], 0) - qty
+        if left > 0: lv[o['price']] = left
+        else: lv.pop(o['price'], None)
+        o['qty'] -= qty
+        # Heap girdisi kalır; canlı emir listesinde olmadığı için atlanır
+        if o['qty'] <= 0: self.orders.pop(o['id'], None)
+
+    def load(self):
+        """Defteri market tablosundan kurar; emir sayısını döner."""
+        conn = get_db_connection()
+        row = conn.execute("SELECT value FROM system_state WHERE key = 'market_version'").fetchone()
+        rows = conn.execute('SELECT id, satici, item, adet, fiyat, time, side FROM market WHERE adet > 0').fetchall()
+        conn.close()
+        with self._lock:
+            self.books, self.orders = {}, {}
+            for r in rows:
+                self._add({"id": r['id'], "side": r['side'] or 'sell', "item": r['item'], "price": int(r['fiyat']),
+                           "qty": int(r['adet']), "owner": r['satici'], "time": r['time'] or 0}, push=False)
+            for b in self.books.values():
+                heapq.heapify(b.asks)
+                heapq.heapify(b.bids)
+            self.version = row['value'] if row else '0'
+            self.loads += 1
+        return len(rows)
+
+    def sync(self):
+        """İstek başına bir kez sürüm kontrolü; başka süreç yazdıysa yeniden kurar."""
+        if has_request_context() and g.get('_market_synced'): return
+        conn = get_db_connection()
+        row = conn.execute("SELECT value FROM system_state WHERE key = 'market_version'").fetchone()
+        conn.close()
+        if (row['value'] if row else '0') != self.version: self.load()
+        if has_request_context(): g._market_synced = True
+
+    def _bump(self, conn):
+        _bump_state_version(conn, 'market_version')
+        new = conn.execute("SELECT value FROM system_state WHERE key = 'market_version'").fetchone()['value']
+        # Araya başka bir worker girdiyse bu defter eksik: sonraki sync yeniden kurar
+        return new if self.version is not None and int(new) == int(self.version) + 1 else None
+
+    def order(self, order_id):
+        self.sync()
+        return self.orders.get(order_id)
+
+    def invalidate(self):
+        """Bellekteki defter commit edilmemiş bir değişikliği içeriyor olabilir:
+        sonraki sync tablodan yeniden kurar."""
+        with self._lock:
+            self.version = None
+
+    def place(self, u, side, item, qty, price):
+        """Limit emri karşı defterle eşleştirir, kalanı deftere yazar.
+        Bakiye/stok yetmezse hiçbir şey yazılmaz ve None döner."""
+        return self._trade(u, side, item, qty, price)
+
+    def take(self, u, order_id, qty):
+        """Eski /buy: adı verilen satış ilanından tam qty adet alır
+        (fill-or-kill, defterde kalan olmaz). İlan yoksa ya da yetmiyorsa
+        False, bakiye yetmezse None döner; iki durumda da hiçbir şey yazılmaz."""
+        return self._trade(u, 'buy', None, qty, None, only=order_id)
+
+    def _trade(self, u, side, item, qty, price, only=None):
+        for attempt in range(2):
+            if attempt: self.load()
+            else: self.sync()
+            with self._lock:
+                if only is not None:
+                    o = self.orders.get(only)
+                    if not o or o['side'] != 'sell' or o['qty'] < qty: return False
+                    item, price = o['item'], o['price']
+                heap = self._heap(item, 'buy' if side == 'sell' else 'sell')
+                if only is not None:
+                    taken, popped = [o], []
+                else:
+                    taken = popped = self._claim(heap, side, qty, price)
+                try:
+                    # Yapıcıların bakiyesi de değişir: hepsinin kilidi artan sırada
+                    with user_locks.hold(u['username'], *{o['owner'] for o in taken}):
+                        out, fills, rested, version = self._settle(u, side, item, qty, price, taken, rest=only is None)
+                except _StaleOrder:
+                    # Başka worker bir emri doldurmuş: hiçbir şey yazılmadı, taze defterle tekrar
+                    for o in popped: heapq.heappush(heap, self._key(o))
+                    self.version = None
+                    continue
+                except _BalanceShort:
+                    for o in popped: heapq.heappush(heap, self._key(o))
+                    return None
+                except Exception:
+                    for o in popped: heapq.heappush(heap, self._key(o))
+                    self.version = None
+                    raise
+                # Yazma başarılı: aynı değişiklik belleğe; istek geri alınırsa defter yeniden kurulur
+                on_rollback(self.invalidate)
+                for o, f in fills: self._reduce(o, f)
+                for o in popped:
+                    if o['qty'] > 0: heapq.heappush(heap, self._key(o))
+                if rested: self._add(rested)
+                self.version = version
+                self.matched += len(fills)
+                return out
+        return False if only is not None else None
+
+    def _claim(self, heap, side, qty, price):
+        """Fiyatı uyan emirleri öncelik sırasıyla heap'ten çıkarır (qty dolana kadar)."""
+        taken, need = [], qty
+        while need > 0 and heap:
+            o = self.orders.get(heap[0][2])
+            if o is None:
+                heapq.heappop(heap)
+                continue
+            if (o['price'] > price) if side == 'buy' else (o['price'] < price): break
+            heapq.heappop(heap)
+            taken.append(o)
+            need -= o['qty']
+        return taken
+
+    def _settle(self, u, side, item, qty, price, taken, rest=True):
+        """Eşleşmeleri, iki tarafın bakiyesini ve kalan emri tek savepoint'te yazar.
+        Bellekteki deftere dokunmaz; (cevap, eşleşmeler, kalan emir, sürüm) döner."""
+        username = u['username']
+        conn = get_db_connection()
+        try:
+            with savepoint():
+                remaining, fills = qty, []
+                for o in taken:
+                    fill = min(remaining, o['qty'])
+                    if fill <= 0: break
+                    # Koşullu düşüş: başka worker aynı emri doldurduysa hepsi geri alınır
+                    if conn.execute('UPDATE market SET adet = adet - ? WHERE id = ? AND adet = ?',
+                                    (fill, o['id'], o['qty'])).rowcount != 1:
+                        raise _StaleOrder(o['id'])
+                    fills.append((o, fill))
+                    remaining -= fill
+                if remaining and not rest: raise _StaleOrder(None)
+                done = [o['id'] for o, f in fills if f == o['qty']]
+                if done:
+                    conn.execute(f"DELETE FROM market WHERE id IN ({','.join('?' * len(done))}) AND adet <= 0", tuple(done))
+                # Taraf başına tek hedefli UPDATE
+                spent = sum(o['price'] * f for o, f in fills)
+                filled = qty - remaining
+                makers = {}
+                for o, f in fills:
+                    m = makers.setdefault(o['owner'], [0, 0])
+                    if side == 'buy': m[0] += o['price'] * f
+                    else: m[1] += f
+                for owner, (money, items) in makers.items():
+                    maker = get_user(owner)
+                    if not maker or not adjust_user_balance(maker, money_delta=money, items={item: items} if items else None):
+                        raise _BalanceShort(owner)
+                if side == 'buy':
+                    ok = adjust_user_balance(u, money_delta=-(spent + remaining * price),
+                                             items={item: filled} if filled else None)
+                else:
+                    ok = adjust_user_balance(u, money_delta=spent, items={item: -qty})
+                if not ok: raise _BalanceShort(username)
+                rested = None
+                if remaining > 0:
+                    now = time.time()
+                    rid = db.session.execute(text('INSERT INTO market (satici, item, adet, fiyat, time, side) '
+                                                  'VALUES (:s, :i, :a, :f, :t, :side) RETURNING id'),
+                                             {"s": username, "i": item, "a": remaining, "f": price, "t": now, "side": side}).scalar()
+                    rested = {"id": rid, "side": side, "item": item, "price": price, "qty": remaining, "owner": username, "time": now}
+                version = self._bump(conn)
+            db_commit()
+        finally:
+            conn.close()
+        out = {"filled": filled, "rest": remaining, "order_id": rested['id'] if rested else None,
+               "avg_price": round(spent / filled, 2) if filled else None,
+               "trades": [{"id": o['id'], "price": o['price'], "qty": f} for o, f in fills]}
+        return out, fills, rested, version
+
+    def cancel(self, u, order_id):
+        """Kullanıcının bekleyen emrini siler, emaneti iade eder; iade edilen adet ya da None."""
+        self.sync()
+        with self._lock:
+            o = self.orders.get(order_id)
+            if not o or o['owner'] != u['username']: return None
+            conn = get_db_connection()
+            try:
+                with savepoint():
+                    if conn.execute('DELETE FROM market WHERE id = ? AND adet = ?', (o['id'], o['qty'])).rowcount != 1:
+                        self.version = None
+                        return None
+                    if o['side'] == 'sell': ok = adjust_user_balance(u, items={o['item']: o['qty']})
+                    else: ok = adjust_user_balance(u, money_delta=o['qty'] * o['price'])
+                    if not ok: raise _BalanceShort(u['username'])
+                    version = self._bump(conn)
+                db_commit()
+            except _BalanceShort:
+                return None
+            finally:
+                conn.close()
+            on_rollback(self.invalidate)
+            qty = o['qty']
+            self._reduce(o, qty)
+            self.version = version
+        return qty
+
+    def depth(self, item, n=ORDER_BOOK_DEPTH):
+        """Fiyat seviyesi başına toplam adet: alışlar yüksekten, satışlar düşükten."""
+        b = self.books.get(item)
+        if b is None: return {"bids": [], "asks": []}
+        return {"bids": [{"fiyat": p, "adet": q} for p, q in heapq.nlargest(n, b.levels['buy'].items())],
+                "asks": [{"fiyat": p, "adet": q} for p, q in heapq.nsmallest(n, b.levels['sell'].items())]}
+
+    def stats(self):
+        return {"version": self.version, "orders": len(self.orders), "items": len(self.books),
+                "loads": self.loads, "matched": self.matched}
+
+market_book = _MarketBook()
+
 # ---------------------------------------------------------
 # BOT SELLERS BACKGROUND TASK
 # ---------------------------------------------------------
@@ -369,10 +1503,8 @@ def _bot_price_for(name):
     base = _avg_price_for(name)
     if base <= 0:
         # fallback to global prices if exists
-        conn = get_db_connection()
-        pr = conn.execute('SELECT price FROM prices WHERE item = ?', (name,)).fetchone()
-        conn.close()
-        base = int(pr['price']) if pr else random.randint(20, 200)
+        pr = price_book.base(name)
+        base = int(pr) if pr is not None else random.randint(20, 200)
     # +/- 10-30%
     pct = random.uniform(0.10, 0.30)
     updown = 1 if random.random() < 0.5 else -1
@@ -402,8 +1534,428 @@ def start_bot_sellers():
 
 start_bot_sellers()
 
+# ---------------------------------------------------------
+# USER STATE CACHE
+# ---------------------------------------------------------
+class _UserLRU:
+    """Onarılmış kullanıcı belgelerinin süreç çapında, boyutu sınırlı ve
+    TTL'li LRU'su.
+
+    Belgeler girerken ve çıkarken kopyalanır, böylece istekler aynı dict'i
+    paylaşmaz; tek nesneyi paylaşan aşağıdaki istek bazlı önbellektir.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._d = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if self.maxsize <= 0: return None
+        with self._lock:
+            hit = self._d.get(key)
+            if hit is None or time.time() - hit[0] > self.ttl:
+                if hit is not None: del self._d[key]
+                self.misses += 1
+                return None
+            self._d.move_to_end(key)
+            self.hits += 1
+            doc = hit[1]
+        return copy.deepcopy(doc)
+
+    def put(self, key, doc):
+        if self.maxsize <= 0: return
+        snap = copy.deepcopy(doc)
+        with self._lock:
+            self._d[key] = (time.time(), snap)
+            self._d.move_to_end(key)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._d.pop(key, None)
+
+_user_lru = _UserLRU(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# write-behind: username_lower -> belge anlık görüntüsü
+_pending_users = {}
+_pending_lock = threading.Lock()
+_write_stats = {"writes": 0, "deferred": 0, "coalesced": 0, "conflicts": 0}
+
+def _user_key(username):
+    return _normalize_username(username).lower()
+
+def _request_user_cache():
+    """İsteğe özel {username_lower: belge} eşlemesi; istek dışında None."""
+    if not has_request_context(): return None
+    cache = g.get('_user_docs')
+    if cache is None:
+        cache = {}
+        g._user_docs = cache
+    return cache
+
+def _forget_user(username):
+    key = _user_key(username)
+    _user_lru.invalidate(key)
+    _drop_pending_user(key)
+    cache = _request_user_cache()
+    if cache is not None: cache.pop(key, None)
+
 def get_user(username):
+    """Kullanıcı belgesini istek başına bir kez yükler.
+
+    Aynı istek içindeki tüm çağrılar (before_request, context processor,
+    route) aynı dict nesnesini alır.
+    """
     if not username: return None
+    key = _user_key(username)
+    cache = _request_user_cache()
+    if cache is not None and key in cache:
+        return cache[key]
+    u = _pending_user(key)
+    if u is None:
+        u = _user_lru.get(key)
+    if u is None:
+        u = _load_user(username)
+        if u is not None: _user_lru.put(key, u)
+    if u is not None and cache is not None:
+        cache[key] = u
+    return u
+
+# ---------------------------------------------------------
+# NORMALIZED USER STORAGE
+# ---------------------------------------------------------
+# Bakiye/seviye users kolonlarında, envanter user_inventory'de, fabrika
+# durumu user_factory_state'te tutulur; users.data sadece geri kalanını
+# taşır. Yazmalar yüklenen duruma (baseline) göre fark alır, böylece
+# hedefli UPDATE'ler ile tam belge yazmaları birbirini ezmez.
+
+_BALANCE_KEYS = ("money", "xp", "level", "net_worth")
+# (user_factory_state kolonu, belge anahtarı)
+_FACTORY_FIELDS = (
+    ("level", "factories"),
+    ("storage", "factory_storage"),
+    ("last_update", "factory_last_update"),
+    ("last_collect", "factory_last_collect"),
+    ("run_start", "factory_run_start"),
+    ("run_duration", "factory_run_duration"),
+    ("running", "factory_running"),
+    ("boost_until", "factory_boosts"),
+)
+_NORMALIZED_KEYS = frozenset(_BALANCE_KEYS + ("inventory",) + tuple(k for _, k in _FACTORY_FIELDS))
+
+class _UserDoc(dict):
+    """Kullanıcı belgesi; _baseline DB'deki son normalize durumu tutar
+    (None = tablolara henüz yazılmamış), _version yüklendiği satır sürümü,
+    _stale okunurken yükseltildi ama henüz yazılmadı."""
+    _baseline = None
+    _version = None
+    _stale = False
+
+class _BalanceShort(Exception):
+    """adjust_user_balance: bakiye/stok yetmedi, savepoint geri alınır."""
+
+class _StaleOrder(Exception):
+    """Defterdeki emir DB'de değişmiş (başka worker doldurdu/iptal etti)."""
+
+class UserVersionConflict(Exception):
+    """users.version beklenenden farklı: belge başka bir worker'da değişti."""
+
+def _factory_state_rows(doc):
+    fids = set()
+    for _, key in _FACTORY_FIELDS:
+        fids.update((doc.get(key) or {}).keys())
+    rows = {}
+    for fid in fids:
+        vals = []
+        for col, key in _FACTORY_FIELDS:
+            v = (doc.get(key) or {}).get(fid)
+            if col == "running" and v is not None: v = 1 if v else 0
+            vals.append(v)
+        rows[fid] = tuple(vals)
+    return rows
+
+def _snapshot_normalized(doc):
+    snap = {k: doc.get(k) for k in _BALANCE_KEYS}
+    snap["inventory"] = dict(doc.get("inventory") or {})
+    snap["factories"] = _factory_state_rows(doc)
+    return snap
+
+def _set_baseline(doc):
+    if isinstance(doc, _UserDoc):
+        doc._baseline = _snapshot_normalized(doc)
+
+def _overlay_normalized(doc, u_row):
+    """Normalize kolon/tabloları belgeye yazar ve baseline'ı kaydeder."""
+    uname = u_row['username']
+    for k in _BALANCE_KEYS:
+        if u_row.get(k) is not None: doc[k] = u_row[k]
+    inv = db.session.execute(text('SELECT item, qty FROM user_inventory WHERE username = :u'), {"u": uname}).fetchall()
+    doc["inventory"] = {r[0]: r[1] for r in inv}
+    fac = db.session.execute(text('SELECT * FROM user_factory_state WHERE username = :u'), {"u": uname}).fetchall()
+    for _, key in _FACTORY_FIELDS:
+        doc[key] = {}
+    for r in fac:
+        m = r._mapping
+        for col, key in _FACTORY_FIELDS:
+            v = m[col]
+            if v is None: continue
+            if col == "running": v = bool(v)
+            elif col == "level": v = int(v)
+            doc[key][m['factory_type']] = v
+    _set_baseline(doc)
+
+def _write_user_rows(doc):
+    """Belgenin değişen normalize alanlarını ve blob'u yazar (commit etmez)."""
+    uname = doc['username']
+    base = getattr(doc, "_baseline", None)
+    cur = _snapshot_normalized(doc)
+    blob = {k: v for k, v in doc.items() if k not in _NORMALIZED_KEYS}
+    params = {"d": json.dumps(blob), "u": uname}
+    sets = ["data = :d", "version = version + 1"]
+    for k in _BALANCE_KEYS:
+        if base is None or cur[k] != base[k]:
+            sets.append(f"{k} = :{k}")
+            params[k] = cur[k]
+    where = "username = :u"
+    ver = getattr(doc, "_version", None)
+    if ver is not None:
+        # compare-and-swap: yüklendiğinden beri kimse yazmadıysa
+        where += " AND version = :ver"
+        params["ver"] = ver
+    res = db.session.execute(text(f"UPDATE users SET {', '.join(sets)} WHERE {where}"), params)
+    if res.rowcount != 1:
+        raise UserVersionConflict(uname)
+
+    if base is None:
+        db.session.execute(text('DELETE FROM user_inventory WHERE username = :u'), {"u": uname})
+        db.session.execute(text('DELETE FROM user_factory_state WHERE username = :u'), {"u": uname})
+        base = {"inventory": {}, "factories": {}}
+    inv_up = [{"u": uname, "i": item, "q": int(qty)} for item, qty in cur["inventory"].items()
+              if base["inventory"].get(item) != qty]
+    inv_del = [{"u": uname, "i": item} for item in base["inventory"] if item not in cur["inventory"]]
+    if inv_up:
+        db.session.execute(text('INSERT INTO user_inventory (username, item, qty) VALUES (:u, :i, :q) '
+                                'ON CONFLICT (username, item) DO UPDATE SET qty = excluded.qty'), inv_up)
+    if inv_del:
+        db.session.execute(text('DELETE FROM user_inventory WHERE username = :u AND item = :i'), inv_del)
+
+    cols = [c for c, _ in _FACTORY_FIELDS]
+    fac_up = []
+    for fid, vals in cur["factories"].items():
+        if base["factories"].get(fid) != vals:
+            row = {"u": uname, "f": fid}
+            row.update(zip(cols, vals))
+            fac_up.append(row)
+    fac_del = [{"u": uname, "f": fid} for fid in base["factories"] if fid not in cur["factories"]]
+    if fac_up:
+        db.session.execute(text(
+            f"INSERT INTO user_factory_state (username, factory_type, {', '.join(cols)}) "
+            f"VALUES (:u, :f, {', '.join(':' + c for c in cols)}) "
+            f"ON CONFLICT (username, factory_type) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in cols)}"), fac_up)
+    if fac_del:
+        db.session.execute(text('DELETE FROM user_factory_state WHERE username = :u AND factory_type = :f'), fac_del)
+
+def _patch_cached_user(username, money_delta, items, new_version=None):
+    """Hedefli bir UPDATE'i bellekteki kopyalara (istek + write-behind) uygular.
+
+    Sadece güncel sürümdeki kopyaların version'ı ilerletilir; araya başka
+    yazma girmişse kopya eski kalır ve sonraki yazması çakışır."""
+    key = _user_key(username)
+    _user_lru.invalidate(key)
+    docs = []
+    cache = _request_user_cache()
+    if cache is not None and key in cache: docs.append(cache[key])
+    with _pending_lock:
+        if key in _pending_users: docs.append(_pending_users[key])
+    for doc in docs:
+        if new_version is not None and getattr(doc, "_version", None) == new_version - 1:
+            doc._version = new_version
+        base = getattr(doc, "_baseline", None)
+        targets = [doc] + ([base] if base is not None else [])
+        for t in targets:
+            if money_delta:
+                t["money"] = (t.get("money") or 0) + money_delta
+                t["net_worth"] = (t.get("net_worth") or 0) + money_delta
+            inv = t.setdefault("inventory", {})
+            for item, d in items.items():
+                inv[item] = inv.get(item, 0) + d
+
+def adjust_user_balance(u, money_delta=0, items=None):
+    """Bakiye ve envanteri tam belge yazmadan, hedefli UPDATE'lerle değiştirir.
+
+    items: {ürün: adet farkı}. Bakiye veya stok yetmezse hiçbir şey yazılmaz
+    ve False döner; DB hataları yükselir (500).
+    """
+    items = items or {}
+    uname = u['username']
+    if getattr(u, "_baseline", None) is None:
+        # Henüz normalize edilmemiş kullanıcı: önce tam yaz
+        if not _write_user(u): return False
+    try:
+        with savepoint():
+            for item, d in items.items():
+                if d < 0:
+                    r = db.session.execute(text('UPDATE user_inventory SET qty = qty + :d WHERE username = :u AND item = :i AND qty + :d >= 0'),
+                                           {"d": d, "u": uname, "i": item})
+                    if r.rowcount != 1: raise _BalanceShort(item)
+                elif d > 0:
+                    db.session.execute(text('INSERT INTO user_inventory (username, item, qty) VALUES (:u, :i, :d) '
+                                            'ON CONFLICT (username, item) DO UPDATE SET qty = user_inventory.qty + excluded.qty'),
+                                       {"d": d, "u": uname, "i": item})
+            # version'ı her durumda artır: eski kopyadan yapılan tam yazmalar çakışsın
+            r = db.session.execute(text('UPDATE users SET money = money + :m, net_worth = COALESCE(net_worth, 0) + :m, version = version + 1 '
+                                        'WHERE username = :u AND money + :m >= 0'),
+                                   {"m": money_delta, "u": uname})
+            if r.rowcount != 1: raise _BalanceShort("money")
+            new_version = db.session.execute(text('SELECT version FROM users WHERE username = :u'), {"u": uname}).scalar()
+        db_commit()
+    except _BalanceShort:
+        return False
+    except Exception as e:
+        print(f"adjust_user_balance error: {e}")
+        # Kilit/DB hatası bakiye yetersizliği değildir: istek geri alınır
+        abort_unit_of_work()
+        raise
+    finally:
+        release_session()
+    uow = _unit_of_work()
+    if uow is not None:
+        uow["writes"] += 1
+        uow["users"].add(uname)
+    _patch_cached_user(uname, money_delta, items, new_version)
+    return True
+
+# ---------------------------------------------------------
+# KULLANICI BELGESİ SÜRÜMLERİ
+# ---------------------------------------------------------
+# Belge içindeki 'schema_version' uygulanan son yükseltmeyi tutar. Güncel
+# belgeler _load_user'da hiç anahtar kontrolü yapılmadan döner; eskiler okunurken
+# yükseltilir, arka planda migrate_user_docs hepsini bir kere yazar.
+# Yeni alan eklerken: yeni bir _doc_vN fonksiyonu yaz, _DOC_UPGRADES'e ekle.
+USER_DOC_VERSION = 2
+
+def _doc_v1_defaults(u_data):
+    """Eski get_user'ın her okumada yaptığı onarım."""
+    if "inventory" not in u_data: u_data["inventory"] = {}
+    for k in ["Odun","Taş","Demir","Çelik","Plastik","Elektronik","Gıda","Tekstil"]:
+        u_data["inventory"][k] = u_data["inventory"].get(k, 0)
+    for k in ("factories", "factory_storage", "factory_last_update", "factory_last_collect",
+              "factory_run_start", "factory_run_duration", "avg_buy_prices"):
+        if k not in u_data: u_data[k] = {}
+    if "net_worth" not in u_data: u_data["net_worth"] = 0
+    if "xp" not in u_data: u_data["xp"] = 0
+    if "level" not in u_data: u_data["level"] = 1
+    try:
+        u_data["money"] = max(0, int(u_data.get("money", STARTING_MONEY)))
+    except Exception:
+        u_data["money"] = STARTING_MONEY
+    if "workers_available" not in u_data: u_data["workers_available"] = 0
+    if "council_member" not in u_data: u_data["council_member"] = (u_data["username"].lower() == "konsey")
+
+def _doc_v2_lazy_production(u_data):
+    """Kapalı form birikim: okumalarda dakikalık hızla biriken (sadece
+    gösterilen) depo sıfırlanır, segment son toplamadan başlar; toplanmamış
+    üretim kaybolmaz, eski depo değeri de bir kerede ödenmez."""
+    now = time.time()
+    last_collect = u_data.get("factory_last_collect") or {}
+    for fid in u_data.get("factories", {}):
+        start = last_collect.get(fid, u_data["factory_last_update"].get(fid, now))
+        u_data["factory_storage"][fid] = 0
+        u_data["factory_last_update"][fid] = start
+    u_data.pop("is_afk", None)
+
+_DOC_UPGRADES = [
+    (1, _doc_v1_defaults),
+    (2, _doc_v2_lazy_production),
+]
+
+def _upgrade_user_doc(u_data):
+    """Eksik yükseltmeleri sırayla uygular; belge değiştiyse True döner."""
+    current = u_data.get("schema_version", 0)
+    if current >= USER_DOC_VERSION: return False
+    for version, step in _DOC_UPGRADES:
+        if version > current: step(u_data)
+    u_data["schema_version"] = USER_DOC_VERSION
+    return True
+
+def migrate_user_docs(batch_size=200):
+    """Eski sürümdeki belgeleri yükseltip yazar. Hepsi güncelse system_state'e
+    'user_doc_version' yazılır ve sonraki açılışlarda tarama atlanır."""
+    with db.engine.connect() as conn:
+        row = conn.execute(text("SELECT value FROM system_state WHERE key = 'user_doc_version'")).fetchone()
+    if row and int(row[0]) >= USER_DOC_VERSION: return 0
+    total, failed, last = 0, 0, ""
+    while True:
+        try:
+            rows = db.session.execute(text('SELECT username FROM users WHERE username > :last ORDER BY username LIMIT :n'),
+                                      {"last": last, "n": batch_size}).fetchall()
+        finally:
+            db.session.remove()
+        if not rows: break
+        last = rows[-1][0]
+        for r in rows:
+            with user_locks.hold(r[0]):
+                doc = _pending_user(_user_key(r[0])) or _load_user(r[0])
+                if doc is None or not getattr(doc, "_stale", False): continue
+                try:
+                    ok = _write_user(doc)
+                except Exception:
+                    ok = False
+                if ok: total += 1
+                else: failed += 1
+    if not failed:
+        with db.engine.begin() as conn:
+            conn.execute(text("INSERT INTO system_state (key, value) VALUES ('user_doc_version', :v) "
+                              "ON CONFLICT (key) DO UPDATE SET value = excluded.value"), {"v": str(USER_DOC_VERSION)})
+    return total
+
+# migrate_user_blobs taşınmamış kullanıcı kalmadığını görünce True olur;
+# o zamana kadar liderlik tablosu blob'daki değerleri de okur
+_blobs_migrated = False
+
+def migrate_user_blobs(batch_size=200):
+    """Henüz taşınmamış (money IS NULL) kullanıcıları partiler halinde
+    normalize tablolara yazar. Taşınan kullanıcı sayısını döner."""
+    global _blobs_migrated
+    total = 0
+    while True:
+        try:
+            rows = db.session.execute(text('SELECT username FROM users WHERE money IS NULL LIMIT :n'), {"n": batch_size}).fetchall()
+        finally:
+            db.session.remove()
+        if not rows:
+            _blobs_migrated = True
+            break
+        done = 0
+        for r in rows:
+            doc = _pending_user(_user_key(r[0])) or _load_user(r[0])
+            try:
+                if doc is not None and _write_user(doc): done += 1
+            except Exception:
+                pass
+        total += done
+        if done == 0: break
+    return total
+
+def start_user_migrations():
+    """Blob taşıma ve belge yükseltmesini arka planda sırayla çalıştırır."""
+    def run():
+        try:
+            with app.app_context():
+                n = migrate_user_blobs()
+                if n: print(f"✅ {n} kullanıcı normalize tablolara taşındı")
+                n = migrate_user_docs()
+                if n: print(f"✅ {n} kullanıcı belgesi v{USER_DOC_VERSION} sürümüne yükseltildi")
+        except Exception as e:
+            print(f"user migration error: {e}")
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+
+def _load_user(username):
     uname = _normalize_username(username)
     try:
         res = db.session.execute(text('SELECT * FROM users WHERE username = :u'), {"u": uname})
@@ -416,54 +1968,196 @@ def get_user(username):
             # SQLAlchemy row to dict mapping
             mapping = getattr(user, "_mapping", None)
             u_row = dict(mapping) if mapping else dict(user)
-            u_data = json.loads(u_row['data'])
+            u_data = _UserDoc(json.loads(u_row['data']))
+            u_data._version = u_row.get('version')
             db_username = u_row['username']
             u_data['username'] = db_username
+            if u_row.get('money') is not None:
+                _overlay_normalized(u_data, u_row)
             
-            # Migration/Repair for missing keys
-            if "inventory" not in u_data: u_data["inventory"] = {}
-            # Ensure inventory keys exist
-            for k in ["Odun","Taş","Demir","Çelik","Plastik","Elektronik","Gıda","Tekstil"]:
-                u_data["inventory"][k] = u_data["inventory"].get(k, 0)
-            if "factories" not in u_data: u_data["factories"] = {}
-            if "factory_storage" not in u_data: u_data["factory_storage"] = {}
-            if "factory_last_update" not in u_data: u_data["factory_last_update"] = {}
-            if "factory_last_collect" not in u_data: u_data["factory_last_collect"] = {}
-            if "factory_run_start" not in u_data: u_data["factory_run_start"] = {}
-            if "factory_run_duration" not in u_data: u_data["factory_run_duration"] = {}
-            if "net_worth" not in u_data: u_data["net_worth"] = 0
-            if "xp" not in u_data: u_data["xp"] = 0
-            if "level" not in u_data: u_data["level"] = 1
-            if "money" not in u_data: u_data["money"] = STARTING_MONEY
-            try:
-                u_data["money"] = max(0, int(u_data.get("money", STARTING_MONEY)))
-            except Exception:
-                u_data["money"] = STARTING_MONEY
-            if "workers_available" not in u_data: u_data["workers_available"] = 0
-            if "avg_buy_prices" not in u_data: u_data["avg_buy_prices"] = {}
-            if "council_member" not in u_data: u_data["council_member"] = (db_username.lower() == "konsey")
+            if u_data.get("schema_version", 0) < USER_DOC_VERSION:
+                u_data._stale = _upgrade_user_doc(u_data)
             
             # session commit'i get_user içinde yapmamak daha güvenli, sadece okuma yapıyoruz
             return u_data
     except Exception as e:
         print(f"get_user error for {username}: {str(e)}")
-        db.session.rollback()
+        if _unit_of_work() is None: db.session.rollback()
     finally:
-        db.session.remove()
+        release_session()
     return None
 
-def save_user(user_data):
+def _write_user(user_data, uow=None):
+    """Belgeyi hemen yazar; iş birimi yoksa commit de eder.
+
+    Sadece version koruması tutmadığında (başka bir yazma araya girdi)
+    False döner; diğer DB hataları iş birimini düşürüp yükselir."""
     username = user_data['username']
+    uow = uow or _unit_of_work()
+    # Net servet para/fabrika değiştiğinde güncel kalsın; okumalar yazmıyor
+    user_data["net_worth"] = user_net_worth(user_data)
     try:
-        db.session.execute(text('UPDATE users SET data = :d WHERE username = :u'), 
-                     {"d": json.dumps(user_data), "u": username})
-        db.session.commit()
-        backup_database()
+        with savepoint(nested=uow is not None):
+            _write_user_rows(user_data)
+        if uow is None: _timed_commit()
+        _write_stats["writes"] += 1
+        _set_baseline(user_data)
+        if getattr(user_data, "_version", None) is not None:
+            user_data._version += 1
+        if getattr(user_data, "_stale", False):
+            user_data._stale = False
+        timer_index.sync(username, user_timers(user_data))
+        _user_lru.put(_user_key(username), user_data)
+        if uow is not None:
+            uow["writes"] += 1
+            uow["users"].add(username)
+        return True
+    except UserVersionConflict:
+        _write_stats["conflicts"] += 1
+        _forget_user(username)
+        return False
     except Exception as e:
         print(f"save_user error: {e}")
+        if uow is None: db.session.rollback()
+        else: uow["failed"] = True
+        _forget_user(username)
+        raise
+    finally:
+        if uow is None: db.session.remove()
+
+def save_user(user_data, durable=False, defer=False):
+    """Kullanıcı belgesini kirli olarak işaretler.
+
+    - varsayılan: istek sonunda tek UPDATE ile yazılır (aynı kullanıcıya
+      yapılan kayıtlar birleştirilir)
+    - durable=True: hemen yazılır (para/envanter değiştiren ticaretler)
+    - defer=True: süreç kuyruğuna alınır, USER_FLUSH_INTERVAL'da bir tek
+      commit'le toplu yazılır (sadece okuma kaynaklı, kaybı önemsiz
+      değişiklikler)
+    İstek dışında (arka plan işleri) her zaman hemen yazar.
+    """
+    key = _user_key(user_data['username'])
+    if durable or not has_request_context():
+        _drop_pending_user(key)
+        dirty = g.get('_dirty_users') if has_request_context() else None
+        if dirty: dirty.pop(key, None)
+        ok = _write_user(user_data)
+        backup_database()
+        return ok
+    _request_user_cache()[key] = user_data
+    if defer:
+        with _pending_lock:
+            if key in _pending_users: _write_stats["coalesced"] += 1
+            _pending_users[key] = copy.deepcopy(user_data)
+        _write_stats["deferred"] += 1
+        return True
+    dirty = g.get('_dirty_users')
+    if dirty is None:
+        dirty = {}
+        g._dirty_users = dirty
+    if key in dirty: _write_stats["coalesced"] += 1
+    dirty[key] = user_data
+    return True
+
+def update_user(username, mutate):
+    """Oku-değiştir-yaz döngüsünü version CAS ile çalıştırır.
+
+    mutate(u) belgeyi yerinde değiştirir ve route'un cevabını (ya da None)
+    döner; belge değişmediyse hiçbir şey yazılmaz. Aynı süreçteki yazarlar
+    oyuncunun kilidinde sıraya girer; başka bir süreç araya girip yazma
+    çakışırsa belge DB'den yeniden yüklenir ve mutate baştan
+    uygulanır, bu yüzden mutate DB'ye yan etki yazmamalıdır.
+    """
+    with user_locks.hold(username):
+        for _ in range(USER_CAS_RETRIES):
+            u = get_user(username)
+            if u is None:
+                raise UserVersionConflict(username)
+            before = json.dumps(u, sort_keys=True)
+            result = mutate(u)
+            if json.dumps(u, sort_keys=True) == before:
+                return result
+            key = _user_key(u['username'])
+            _drop_pending_user(key)
+            dirty = g.get('_dirty_users') if has_request_context() else None
+            if dirty: dirty.pop(key, None)
+            if _write_user(u):
+                break
+        else:
+            raise UserVersionConflict(username)
+    # Dosya kopyası kilit dışında; diğer oyuncuları bekletmez
+    backup_database()
+    return result
+
+def _drop_pending_user(key):
+    with _pending_lock:
+        _pending_users.pop(key, None)
+
+def _pending_user(key):
+    with _pending_lock:
+        doc = _pending_users.get(key)
+    return copy.deepcopy(doc) if doc is not None else None
+
+def flush_pending_users():
+    """Ertelenmiş (defer=True) belgeleri tek transaction'da yazar; commit
+    sayısı oyuncu sayısına değil aralığa bağlıdır. Yazma sırasında yenisi
+    gelen kullanıcılar kuyrukta kalır, çakışan belge bırakılır."""
+    with _pending_lock:
+        batch = list(_pending_users.items())
+    if not batch: return 0
+    uow = {"writes": 0, "failed": False, "users": set()}
+    try:
+        for key, doc in batch:
+            _write_user(doc, uow)
+        if uow["failed"]:
+            db.session.rollback()
+            for name in uow["users"]: _forget_user(name)
+        else:
+            _timed_commit()
+    except Exception as e:
+        print(f"user flush error: {e}")
         db.session.rollback()
+        for name in uow["users"]: _forget_user(name)
     finally:
         db.session.remove()
+    with _pending_lock:
+        for key, doc in batch:
+            if _pending_users.get(key) is doc:
+                del _pending_users[key]
+    if uow["writes"]: backup_database()
+    return uow["writes"]
+
+def start_user_flusher():
+    def run():
+        while True:
+            time.sleep(USER_FLUSH_INTERVAL)
+            try:
+                with app.app_context():
+                    flush_pending_users()
+            except Exception as e:
+                print(f"user flush error: {e}")
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+
+def _flush_pending_on_exit():
+    try:
+        with app.app_context():
+            flush_pending_users()
+    except Exception:
+        pass
+
+start_user_flusher()
+atexit.register(_flush_pending_on_exit)
+
+def _flush_dirty_users(uow=None):
+    """save_user ile kirli işaretlenen belgeleri yazar (istek sonunda tek yol).
+    Biri version çakışmasıyla yazılamazsa False döner; DB hatası yükselir."""
+    dirty = g.pop('_dirty_users', None)
+    ok = True
+    for key, doc in (dirty or {}).items():
+        _drop_pending_user(key)
+        if not _write_user(doc, uow): ok = False
+    return ok
 
 def create_user(username, password):
     username = _normalize_username(username)
@@ -498,21 +2192,27 @@ def create_user(username, password):
         "mission": {"description": "İlk fabrikanı kur!", "target_qty": 1, "current_qty": 0, "reward": 500},
         "last_active": time.time(),
         "last_login": 0,
-        "is_afk": False,
         "is_admin": is_admin,
         "expedition": None, # {type, start_time, end_time, cost}
         "last_daily_bonus": 0,
-        "workers_available": 0
+        "workers_available": 0,
+        "council_member": username.lower() == "konsey",
+        "avg_buy_prices": {},
+        "schema_version": USER_DOC_VERSION
     }
     
     try:
         with lock:
-            # Tamamen raw SQL ile - SQLAlchemy session olmadan
-            engine = db.engine
-            with engine.connect() as conn:
+            # İsteğin iş birimi içinde; hata olursa kayıt yarım kalmaz
+            with savepoint():
+                conn = db.session
                 # Kullanıcı ekle
-                conn.execute(text('INSERT INTO users (username, password_hash, data, is_admin) VALUES (:u, :p, :d, :a)'),
-                             {"u": username, "p": pw_hash, "d": json.dumps(initial_data), "a": is_admin})
+                blob = {k: v for k, v in initial_data.items() if k not in _NORMALIZED_KEYS}
+                conn.execute(text('INSERT INTO users (username, password_hash, data, is_admin, money, xp, level, net_worth) VALUES (:u, :p, :d, :a, :m, :x, :l, :nw)'),
+                             {"u": username, "p": pw_hash, "d": json.dumps(blob), "a": is_admin,
+                              "m": initial_data["money"], "x": initial_data["xp"], "l": initial_data["level"], "nw": initial_data["net_worth"]})
+                conn.execute(text('INSERT INTO user_inventory (username, item, qty) VALUES (:u, :i, :q)'),
+                             [{"u": username, "i": item, "q": qty} for item, qty in initial_data["inventory"].items()])
                 
                 # User ID ata
                 res = conn.execute(text('SELECT MAX(user_id) AS m FROM user_ids'))
@@ -528,9 +2228,7 @@ def create_user(username, password):
                 # Log ekle
                 conn.execute(text('INSERT INTO user_logs (user_id, action, amount, timestamp) VALUES (:id, :a, :am, :t)'), 
                              {"id": next_id, "a": 'register', "am": 0, "t": time.time()})
-                
-                conn.commit()
-                conn.close()
+            db_commit()
                 
             print(f"✅ Kullanıcı başarıyla oluşturuldu: {username}")
             backup_database()
@@ -582,70 +2280,536 @@ def check_level_up(user):
         return True
     return False
 
-def calculate_production(user):
-    now = time.time()
-    
-    # Check AFK (5 mins inactivity)
-    last_active = user.get("last_active", now)
-    user["is_afk"] = (now - last_active) > 300
-    user["last_active"] = now
-    
-    prod_mult = 0.1 if user["is_afk"] else 1.0
-    
-    for fid, level in user["factories"].items():
-        if level <= 0: continue
-        
-        conf = FACTORY_CONFIG.get(fid)
-        if not conf: continue
-        
-        last_upd = user["factory_storage"].get(fid, 0) # wait, storage is not last_upd
-        # Fix: storage logic
-        if "factory_last_update" not in user: user["factory_last_update"] = {}
-        last_t = user["factory_last_update"].get(fid, now)
-        
-        elapsed_min = (now - last_t) / 60.0
-        if elapsed_min <= 0: continue
-        
-        # Boost check
-        is_boosted = False
-        boost_end = user.get("factory_boosts", {}).get(fid, 0)
-        if boost_end > now:
-            is_boosted = True
-        
-        # Running status
-        running = True
-        running_map = user.get("factory_running", {})
-        if fid in running_map:
-            running = bool(running_map[fid])
-        # Worker assignment multiplier
-        conn = get_db_connection()
-        assigned = conn.execute('SELECT COALESCE(SUM(count),0) AS c FROM factory_assignments WHERE owner = ? AND factory_type = ?', 
-                                (user["username"], fid)).fetchone()['c']
-        conn.close()
-        worker_mult = 1.0 + (0.05 * assigned)
-        
-        rate = conf["rate"] * level * prod_mult * worker_mult
-        if not running:
-            rate = 0
-        if is_boosted: rate *= 2
-        
-        produced = rate * elapsed_min
-        
-        current_storage = user["factory_storage"].get(fid, 0)
-        max_storage = conf["capacity"] * level
-        
-        new_storage = min(max_storage, current_storage + produced)
-        
-        user["factory_storage"][fid] = new_storage
-        user["factory_last_update"][fid] = now
-        
-    # Net worth calc
-    nw = user["money"]
-    for fid, level in user["factories"].items():
+def get_worker_assignments(owner):
+    """{factory_type: atanmış işçi} haritası; tek GROUP BY sorgusu.
+    İstek içinde kullanıcı başına bir kez okunur, atama route'ları siler."""
+    cache = g.setdefault('_assignments', {}) if has_request_context() else None
+    key = _user_key(owner)
+    if cache is not None and key in cache: return cache[key]
+    conn = get_db_connection()
+    rows = conn.execute('SELECT factory_type, COALESCE(SUM(count),0) AS c FROM factory_assignments WHERE owner = ? GROUP BY factory_type',
+                        (owner,)).fetchall()
+    conn.close()
+    assigned = {r['factory_type']: r['c'] for r in rows}
+    if cache is not None: cache[key] = assigned
+    return assigned
+
+def _forget_worker_assignments(owner):
+    if has_request_context():
+        g.get('_assignments', {}).pop(_user_key(owner), None)
+
+# ---------------------------------------------------------
+# PRODUCTION MODEL
+# ---------------------------------------------------------
+# Birikim kapalı formdan hesaplanır: factory_last_update[fid] anında depoda
+# factory_storage[fid] vardı, o andan beri hız sabit, sadece boost/AFK/olay
+# aralıklarında çarpan değişir. Hızı değiştiren yazmalar (topla, yükselt,
+# boost, başlat/durdur, işçi ata/çıkar, AFK dönüşü) önce _bank_factory ile
+# birikimi depoya yazıp segmenti yeniler; okumalar belgeye dokunmaz.
+PRODUCTION_INTERVAL_SEC = 10800   # "rate" 3 saatlik üretim (production_interval_hours)
+AFK_AFTER_SEC = 300
+AFK_MULT = 0.1
+
+def _production_events():
+    """((çarpan, başlangıç, bitiş), ...) - bitmişler dahil; istek başına bir kez okunur."""
+    return event_cache.production_segments()
+
+def _production_multiplier(prod_evs, now):
+    m = 1.0
+    for mult, a, b in prod_evs or ():
+        if a <= now < b: m *= mult
+    return m
+
+def factory_stored(u, fid, now, assigned, prod_evs=None):
+    """fid deposundaki miktar (float); belgeyi değiştirmez."""
+    stored = u.get('factory_storage', {}).get(fid, 0)
+    start = u.get('factory_last_update', {}).get(fid, now)
+    conf = FACTORY_CONFIG.get(fid)
+    level = u.get('factories', {}).get(fid, 0)
+    if not conf or level <= 0 or now <= start: return stored
+    if not u.get('factory_running', {}).get(fid, True): return stored
+    rate = conf["rate"] * level * (1.0 + 0.05 * assigned) / PRODUCTION_INTERVAL_SEC
+    boost_end = u.get('factory_boosts', {}).get(fid, 0)
+    afk_from = u.get('last_active', start) + AFK_AFTER_SEC
+    points = {start, now, boost_end, afk_from}
+    for _, a, b in prod_evs or (): points.update((a, b))
+    # Çarpanların değiştiği noktalar arasında parça parça topla
+    cuts = sorted(p for p in points if start <= p <= now)
+    weighted = 0.0
+    for a, b in zip(cuts, cuts[1:]):
+        mid = (a + b) / 2
+        m = 2.0 if mid < boost_end else 1.0
+        if mid >= afk_from: m *= AFK_MULT
+        weighted += (b - a) * m * _production_multiplier(prod_evs, mid)
+    return min(conf["capacity"] * level, stored + rate * weighted)
+
+def production_snapshot(u, now=None, prod_evs=None):
+    """{fid: depodaki miktar} - /api/me ve factory_status için saf okuma."""
+    now = now or time.time()
+    assignments = get_worker_assignments(u['username'])
+    return {fid: factory_stored(u, fid, now, assignments.get(fid, 0), prod_evs)
+            for fid, level in u.get('factories', {}).items() if level > 0}
+
+def _bank_factory(u, fid, now, assigned, prod_evs=None):
+    """Birikimi depoya yazıp segmenti now'dan yeniden başlatır (mutate içinde)."""
+    u.setdefault('factory_storage', {})[fid] = factory_stored(u, fid, now, assigned, prod_evs)
+    u.setdefault('factory_last_update', {})[fid] = now
+
+def _touch_active(u, now, assignments, prod_evs=None):
+    """Oyuncu eylemi: AFK'dan dönüyorsa AFK aralığı bütün fabrikalarda kapanır."""
+    if now - u.get('last_active', now) > AFK_AFTER_SEC:
+        for fid in u.get('factories', {}):
+            _bank_factory(u, fid, now, assignments.get(fid, 0), prod_evs)
+    u['last_active'] = now
+
+# Saf okumalar (/api/me yoklaması, pazar, sayfa gezme) da aktifliktir; her
+# istekte yazmamak için last_active en fazla ACTIVITY_TOUCH_SEC'te bir tazelenir
+ACTIVITY_TOUCH_SEC = float(os.environ.get("ACTIVITY_TOUCH_SEC", "60"))
+
+def record_activity(u, now=None):
+    """Oturumu açık oyuncunun last_active'ini tazeler.
+
+    AFK aralığı kapanıyorsa birikim önce bankalanır (tam belge yazımı);
+    değilse belge write-behind kuyruğuna alınır ve USER_FLUSH_INTERVAL'da
+    bir, diğer oyuncularla aynı commit'te yazılır. Yoklama isteği kendisi
+    hiç yazmaz."""
+    now = now or time.time()
+    last = u.get('last_active') or 0
+    if now - last < ACTIVITY_TOUCH_SEC: return
+    if now - last > AFK_AFTER_SEC:
+        prod_evs = _production_events()
+        try:
+            update_user(u['username'], lambda d: _touch_active(d, now, get_worker_assignments(d['username']), prod_evs))
+        except UserVersionConflict:
+            pass
+        return
+    u['last_active'] = now
+    save_user(u, defer=True)
+
+def user_net_worth(u):
+    nw = u.get("money", 0)
+    for fid, level in u.get("factories", {}).items():
         conf = FACTORY_CONFIG.get(fid)
         if conf: nw += (conf["cost"] * level) * 0.8
-    # Add inventory value (approx)
-    user["net_worth"] = int(nw)
+    return int(nw)
+
+# ---------------------------------------------------------
+# WORLD PRODUCTION TICK
+# ---------------------------------------------------------
+# Gece hesabı / denetim gibi işler için bütün oyuncuların birikimini tek
+# seferde hesaplar: user_factory_state partiler halinde (kullanıcı x fabrika)
+# NumPy dizilerine yüklenir, factory_stored'un aynı parça parça integrali
+# vektörel yapılır ve sonuç toplu UPDATE ile depoya yazılır. Kapalı form
+# birikim bölünmeye dayanıklı olduğu için depoya yazmak miktarı değiştirmez;
+# bellekteki eski kopyalar aynı sonucu hesaplar. numpy sadece burada gerekir.
+_TICK_FACTORIES = list(FACTORY_CONFIG)
+_TICK_FACTORY_INDEX = {fid: i for i, fid in enumerate(_TICK_FACTORIES)}
+
+def _tick_arrays(np, now, level, storage, start, running, boost_end, assigned, last_active, prod_evs=None):
+    """(users x factories) dizileriyle factory_stored; (yeni depo, aktif maske) döner."""
+    rate_f = np.array([FACTORY_CONFIG[f]["rate"] for f in _TICK_FACTORIES], dtype=float)
+    cap_f = np.array([FACTORY_CONFIG[f]["capacity"] for f in _TICK_FACTORIES], dtype=float)
+    active = (level > 0) & running & (start < now)
+    rate = rate_f * level * (1.0 + 0.05 * assigned) / PRODUCTION_INTERVAL_SEC
+    afk_from = np.where(np.isnan(last_active)[:, None], start, last_active[:, None]) + AFK_AFTER_SEC
+    cuts = [start, np.full_like(start, now), boost_end, afk_from]
+    for _, ea, eb in prod_evs or ():
+        cuts += [np.full_like(start, ea), np.full_like(start, eb)]
+    # [start, now] dışındaki noktalar sınıra kırpılır: sıfır uzunluklu parça olur
+    pts = np.sort(np.clip(np.stack(cuts, axis=-1), start[..., None], now), axis=-1)
+    a, b = pts[..., :-1], pts[..., 1:]
+    mid = (a + b) / 2
+    m = np.where(mid < boost_end[..., None], 2.0, 1.0)
+    m *= np.where(mid >= afk_from[..., None], AFK_MULT, 1.0)
+    for mult, ea, eb in prod_evs or ():
+        m *= np.where((mid >= ea) & (mid < eb), mult, 1.0)
+    weighted = ((b - a) * m).sum(axis=-1)
+    new = np.minimum(cap_f * level, storage + rate * weighted)
+    return np.where(active, new, storage), active
+
+def _json_text_sql(dialect, *path):
+    """users.data içindeki alanın SQL ifadesi (metin)."""
+    if dialect == "postgresql":
+        return "CAST(data AS json)" + "".join(f"->'{p}'" for p in path[:-1]) + f"->>'{path[-1]}'"
+    return f"json_extract(data, '$.{'.'.join(path)}')"
+
+def _json_number_sql(dialect, *path):
+    if dialect == "postgresql":
+        return f"CAST({_json_text_sql(dialect, *path)} AS DOUBLE PRECISION)"
+    return _json_text_sql(dialect, *path)
+
+def production_tick(now=None, batch_size=20000, write=True):
+    """Normalize edilmiş bütün kullanıcıların üretimini now'a kadar biriktirir.
+
+    write=False sadece hesaplar (denetim). Segment yüklendikten sonra oyuncu
+    topladıysa/yükselttiyse (last_update değiştiyse) o satır atlanır.
+    """
+    import numpy as np
+    t0 = time.perf_counter()
+    now = now or time.time()
+    prod_evs = _production_events()
+    F = len(_TICK_FACTORIES)
+    stats = {"users": 0, "factories": 0, "produced": 0.0, "written": 0}
+    last = ""
+    with db.engine.connect() as conn:
+        la_sql = _json_number_sql(conn.dialect.name, "last_active")
+        while True:
+            names = [r[0] for r in conn.execute(text(
+                'SELECT DISTINCT username FROM user_factory_state WHERE username > :last AND level > 0 '
+                'ORDER BY username LIMIT :n'), {"last": last, "n": batch_size})]
+            if not names: break
+            rng = {"lo": last, "hi": names[-1]}
+            last = names[-1]
+            idx = {u: i for i, u in enumerate(names)}
+            U = len(names)
+            level = np.zeros((U, F)); storage = np.zeros((U, F)); start = np.full((U, F), now)
+            running = np.zeros((U, F), dtype=bool); boost_end = np.zeros((U, F)); assigned = np.zeros((U, F))
+            last_active = np.full(U, np.nan)
+            rows = conn.execute(text(
+                'SELECT username, factory_type, level, storage, last_update, running, boost_until FROM user_factory_state '
+                'WHERE username > :lo AND username <= :hi AND level > 0'), rng).fetchall()
+            for u, fid, lvl, st, lu, run, boost in rows:
+                j = _TICK_FACTORY_INDEX.get(fid)
+                if j is None: continue
+                i = idx[u]
+                level[i, j] = lvl; storage[i, j] = st or 0
+                start[i, j] = now if lu is None else lu
+                running[i, j] = True if run is None else bool(run)
+                boost_end[i, j] = boost or 0
+            for u, fid, c in conn.execute(text(
+                    'SELECT owner, factory_type, SUM(count) FROM factory_assignments '
+                    'WHERE owner > :lo AND owner <= :hi GROUP BY owner, factory_type'), rng):
+                j = _TICK_FACTORY_INDEX.get(fid)
+                if u in idx and j is not None: assigned[idx[u], j] = c
+            for u, la in conn.execute(text(f'SELECT username, {la_sql} FROM users WHERE username > :lo AND username <= :hi'), rng):
+                if u in idx and la is not None: last_active[idx[u]] = la
+            conn.rollback()
+
+            new, active = _tick_arrays(np, now, level, storage, start, running, boost_end, assigned, last_active, prod_evs)
+            stats["users"] += U
+            stats["factories"] += int(active.sum())
+            stats["produced"] += float((new - storage)[active].sum())
+            if not write: continue
+            ui, fj = np.nonzero(active)
+            params = [{"s": float(new[i, j]), "t": now, "u": names[i], "f": _TICK_FACTORIES[j], "t0": float(start[i, j])}
+                      for i, j in zip(ui.tolist(), fj.tolist())]
+            if params:
+                touched = sorted({p["u"] for p in params})
+                with db.engine.begin() as wconn:
+                    # version önce (istek yazmalarıyla aynı kilit sırası): tikten önce
+                    # yüklenmiş belgelerin tam yazması CAS'ta çakışıp yeniden yüklensin
+                    wconn.execute(text('UPDATE users SET version = version + 1 WHERE username = :u'),
+                                  [{"u": u} for u in touched])
+                    res = wconn.execute(text('UPDATE user_factory_state SET storage = :s, last_update = :t '
+                                             'WHERE username = :u AND factory_type = :f AND last_update = :t0'), params)
+                    stats["written"] += max(0, res.rowcount)
+                for u in touched: _user_lru.invalidate(_user_key(u))
+    stats["seconds"] = round(time.perf_counter() - t0, 3)
+    return stats
+
+# Yazan tik istekte değil, bu arka plan işinde ya da `flask production-tick`
+# komutunda çalışır. 0 = sadece istenince (admin/komut) çalışır.
+PRODUCTION_TICK_SEC = float(os.environ.get("PRODUCTION_TICK_SEC", "0"))
+_production_tick_wake = threading.Event()
+_production_tick_last = {}
+
+def request_production_tick():
+    """Arka plan tikini sırasını beklemeden uyandırır."""
+    _production_tick_wake.set()
+
+def start_production_ticker():
+    def run():
+        while True:
+            _production_tick_wake.wait(PRODUCTION_TICK_SEC or None)
+            _production_tick_wake.clear()
+            try:
+                with app.app_context():
+                    stats = production_tick()
+                _production_tick_last.clear()
+                _production_tick_last.update(stats, finished_at=time.time())
+            except Exception as e:
+                print(f"production tick error: {e}")
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+
+@app.cli.command("production-tick")
+@click.option("--dry-run", is_flag=True, help="Sadece hesapla, yazma")
+@click.option("--batch-size", default=20000, show_default=True)
+def production_tick_command(dry_run, batch_size):
+    """Bütün oyuncuların üretimini şimdiye kadar biriktirir."""
+    click.echo(json.dumps(production_tick(batch_size=batch_size, write=not dry_run)))
+
+# ---------------------------------------------------------
+# TIMED EFFECTS
+# ---------------------------------------------------------
+# Üretim turu bitişi, boost bitişi ve sefer dönüşü süreç içi bir min-heap'te
+# tutulur: açılışta DB'den yüklenir, her kullanıcı yazmasında (_write_user)
+# o kullanıcının zamanlayıcıları belgeden yeniden kurulur. Arka plan iş
+# parçacığı vakti gelenleri timer_events'e yazar; aynı olayı birden fazla
+# worker yazarsa benzersiz indeks tekrarı engeller. İstemciler /api/timers
+# ile yaklaşanları ve son gördükleri olaydan sonrakileri tek istekte alır.
+TIMER_CATCHUP_SEC = 86400   # açılışta kaçırılan olaylar bu kadar geriye kadar yazılır
+
+def user_timers(u):
+    """Belgedeki zamanlı etkiler: {(tür, hedef): bitiş zamanı}."""
+    out = {}
+    rs = u.get('factory_run_start') or {}
+    rd = u.get('factory_run_duration') or {}
+    for fid, start in rs.items():
+        if start and rd.get(fid): out[("collectable", fid)] = start + rd[fid] * 60
+    for fid, until in (u.get('factory_boosts') or {}).items():
+        if until: out[("boost_expired", fid)] = until
+    exp = u.get('expedition')
+    if exp and exp.get('end_time'): out[("expedition_done", exp.get('type') or "")] = exp['end_time']
+    return out
+
+class _TimerIndex:
+    """(bitiş, sıra, kullanıcı, tür, hedef) min-heap'i; iptal/yeniden kurma tembel:
+    heap'ten çıkan kayıt _by_user'daki güncel bitişle eşleşmiyorsa atlanır."""
+
+    def __init__(self):
+        self._heap = []
+        self._by_user = {}   # user_key -> {(tür, hedef): bitiş}
+        self._seq = 0
+        self._cond = threading.Condition()
+        self.fired = 0
+
+    def sync(self, username, timers, since=None):
+        """Kullanıcının zamanlayıcılarını timers ile değiştirir; since'ten
+        önce bitenler (zaten geçmiş etkiler) kurulmaz."""
+        since = time.time() if since is None else since
+        live = {k: due for k, due in timers.items() if due > since}
+        key = _user_key(username)
+        with self._cond:
+            old = self._by_user.get(key, {})
+            if live: self._by_user[key] = live
+            else: self._by_user.pop(key, None)
+            earliest = None
+            for (kind, target), due in live.items():
+                if old.get((kind, target)) == due: continue
+                self._seq += 1
+                heapq.heappush(self._heap, (due, self._seq, username, kind, target))
+                earliest = due if earliest is None else min(earliest, due)
+            if earliest is not None and self._heap[0][0] == earliest:
+                self._cond.notify()
+
+    def _current(self, entry):
+        due, _, username, kind, target = entry
+        return self._by_user.get(_user_key(username), {}).get((kind, target)) == due
+
+    def wait_due(self, max_wait=60):
+        """Vakti gelen etkileri döner; yoksa en yakın bitişe (ya da max_wait) kadar bekler."""
+        with self._cond:
+            while self._heap and not self._current(self._heap[0]):
+                heapq.heappop(self._heap)
+            now = time.time()
+            if not self._heap or self._heap[0][0] > now:
+                timeout = max_wait if not self._heap else min(max_wait, self._heap[0][0] - now)
+                self._cond.wait(timeout)
+                now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                if not self._current(entry): continue
+                d, _, username, kind, target = entry
+                timers = self._by_user[_user_key(username)]
+                del timers[(kind, target)]
+                if not timers: del self._by_user[_user_key(username)]
+                due.append((username, kind, target, d))
+            return due
+
+    def stats(self):
+        with self._cond:
+            nxt = self._heap[0][0] if self._heap else None
+            return {"pending": sum(len(t) for t in self._by_user.values()), "heap": len(self._heap),
+                    "fired": self.fired, "next_in": round(nxt - time.time(), 1) if nxt else None}
+
+timer_index = _TimerIndex()
+
+def load_timers(since=None):
+    """Normalize tablolardaki tur/boost bitişlerini ve belgedeki seferleri indekse yükler."""
+    since = (time.time() - TIMER_CATCHUP_SEC) if since is None else since
+    users = {}
+    with db.engine.connect() as conn:
+        rows = conn.execute(text(
+            'SELECT username, factory_type, run_start, run_duration, boost_until FROM user_factory_state '
+            'WHERE (run_start IS NOT NULL AND run_duration IS NOT NULL) OR boost_until > :s'), {"s": since})
+        for username, fid, start, dur, boost in rows:
+            t = users.setdefault(username, {})
+            if start and dur: t[("collectable", fid)] = start + dur * 60
+            if boost: t[("boost_expired", fid)] = boost
+        end_sql = _json_number_sql(conn.dialect.name, "expedition", "end_time")
+        type_sql = _json_text_sql(conn.dialect.name, "expedition", "type")
+        for username, end, kind in conn.execute(text(
+                f'SELECT username, {end_sql}, {type_sql} FROM users WHERE {end_sql} > :s'), {"s": since}):
+            users.setdefault(username, {})[("expedition_done", kind or "")] = end
+    for username, timers in users.items():
+        timer_index.sync(username, timers, since=since)
+    return sum(len(t) for t in users.values())
+
+def _record_timer_events(events):
+    now = time.time()
+    with db.engine.begin() as conn:
+        conn.execute(text('INSERT INTO timer_events (username, kind, target, due, fired_at) VALUES (:u, :k, :t, :d, :f) '
+                          'ON CONFLICT (username, kind, target, due) DO NOTHING'),
+                     [{"u": u, "k": k, "t": t, "d": d, "f": now} for u, k, t, d in events])
+    timer_index.fired += len(events)
+
+def start_timer_scheduler():
+    def run():
+        try:
+            with app.app_context():
+                n = load_timers()
+                if n: print(f"⏱️ {n} zamanlı etki yüklendi")
+        except Exception as e:
+            print(f"timer load error: {e}")
+        while True:
+            events = timer_index.wait_due()
+            if not events: continue
+            try:
+                with app.app_context():
+                    _record_timer_events(events)
+            except Exception as e:
+                print(f"timer fire error: {e}")
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+
+# ---------------------------------------------------------
+# FACTORY DASHBOARD
+# ---------------------------------------------------------
+# /api/factories ve /api/factory/list aynı satırları üretir. Olay, fiyatlar ve
+# işçi atamaları istek başına bir kez okunur, tüm satırlar tek geçişte hesaplanır.
+
+def _factory_row(fid, conf, lvl, running, assigned, prod_mult, price, now, u):
+    rate_per_hour = int(conf['rate'] * max(1, lvl) * (1 + 0.05 * assigned) * prod_mult * (1 if running else 0))
+    last_collect = u.get('factory_last_collect', {}).get(fid, u.get('factory_last_update', {}).get(fid, now))
+    # Production countdown
+    run_start = u.get('factory_run_start', {}).get(fid)
+    run_dur_min = u.get('factory_run_duration', {}).get(fid)
+    remaining_seconds = None
+    collectable = False
+    production_duration_minutes = None
+    if run_start and run_dur_min:
+        production_duration_minutes = run_dur_min
+        remaining_seconds = max(0, int(run_dur_min*60 - (now - run_start)))
+        collectable = remaining_seconds == 0
+    return {
+        "type": fid,
+        "name": conf['name'],
+        "product_type": conf.get('type'),
+        "inputs": dict(RECIPE_GRAPH.inputs[fid]),
+        "level": lvl,
+        "running": running,
+        "rate_per_hour": rate_per_hour,
+        "worker_count": assigned,
+        "worker_capacity": conf.get('worker_capacity', 0) * max(1, lvl),
+        "bonus_pct": int(0.05 * assigned * 100),
+        "production_interval_hours": 3,
+        "last_collect_hours_ago": round((now - last_collect) / 3600.0, 2),
+        "production_duration_minutes": production_duration_minutes,
+        "remaining_seconds": remaining_seconds,
+        "collectable": collectable,
+        "daily_income": int(rate_per_hour * 24 * price),
+        "build_cost": conf.get('cost', 0),
+    }
+
+def _price_map():
+    return price_book.base_map()
+
+def build_factory_rows(u):
+    """Kullanıcının tüm fabrika satırları; 3 sorgu (olay, fiyatlar, atamalar)."""
+    ev = _get_current_event()
+    prod_mult = 1.0
+    if ev and ev.get('target', {}).get('type') == 'production':
+        prod_mult = float(ev.get('production_multiplier', 1.0))
+    prices = _price_map()
+    assignments = get_worker_assignments(u['username'])
+    factories = u.get('factories', {})
+    running_map = u.get('factory_running', {})
+    now = time.time()
+    return [_factory_row(fid, conf, factories.get(fid, 0), bool(running_map.get(fid, True)),
+                         assignments.get(fid, 0), prod_mult, RECIPE_GRAPH.unit_value(fid, prices), now, u)
+            for fid, conf in FACTORY_CONFIG.items()]
+
+def _guest_factory_rows():
+    rows = []
+    for fid, conf in FACTORY_CONFIG.items():
+        rows.append({
+            "type": fid,
+            "name": conf['name'],
+            "product_type": conf.get('type'),
+            "inputs": dict(RECIPE_GRAPH.inputs[fid]),
+            "level": 0,
+            "running": False,
+            "rate_per_hour": 0,
+            "worker_count": 0,
+            "worker_capacity": conf.get('worker_capacity', 0),
+            "bonus_pct": 0,
+            "production_interval_hours": 3,
+            "last_collect_hours_ago": 0,
+            "production_duration_minutes": None,
+            "remaining_seconds": None,
+            "collectable": False,
+            "daily_income": 0,
+            "build_cost": conf.get('cost', 0),
+        })
+    return rows
+
+# Misafir görünümü kullanıcıya bağlı değil, açılışta bir kez hesaplanır
+GUEST_FACTORY_ROWS = _guest_factory_rows()
+
+# ---------------------------------------------------------
+# WORKER ALLOCATION
+# ---------------------------------------------------------
+# Saatlik gelir rate * level * (1 + 0.05 * assigned) * birim katma değer
+# (tarifli fabrikada girdi maliyeti düşülür) atanan işçide doğrusal: her fabrikanın işçi başı marjinal kazancı kapasitesi dolana kadar
+# sabit. Heap en yüksek marjinal kazançlı fabrikayı çıkarıp blok halinde
+# doldurur; süre işçi havuzunun büyüklüğünden bağımsız, O(F log F).
+
+def optimize_worker_allocation(workers, factories):
+    """factories: [(fid, işçi başı kazanç, kapasite)] -> {fid: işçi}."""
+    out = {fid: 0 for fid, _, _ in factories}
+    heap = [(-gain, fid, cap) for fid, gain, cap in factories if gain > 0 and cap > 0]
+    heapq.heapify(heap)
+    while workers > 0 and heap:
+        _, fid, cap = heapq.heappop(heap)
+        take = min(workers, cap)
+        out[fid] = take
+        workers -= take
+    return out
+
+def worker_plan(u):
+    """Mevcut ve en iyi atamayı saatlik gelirleriyle birlikte hesaplar."""
+    assignments = get_worker_assignments(u['username'])
+    prices = _price_map()
+    prod_evs = _production_events()
+    now = time.time()
+    prod_mult = _production_multiplier(prod_evs, now)
+    running_map = u.get('factory_running', {})
+    pool = int(u.get('workers_available', 0)) + sum(assignments.values())
+    base, gains = {}, []
+    for fid, conf in FACTORY_CONFIG.items():
+        level = u.get('factories', {}).get(fid, 0)
+        if level <= 0: continue
+        hourly = conf['rate'] * level * prod_mult * RECIPE_GRAPH.unit_value(fid, prices) * (1 if running_map.get(fid, True) else 0)
+        base[fid] = hourly
+        gains.append((fid, hourly * 0.05, conf.get('worker_capacity', 0) * level))
+    target = optimize_worker_allocation(pool, gains)
+    current = {fid: assignments.get(fid, 0) for fid in base}
+    # Kurulu olmayan fabrikalarda kalmış işçiler havuza döner
+    for fid, count in assignments.items():
+        if fid not in base and count:
+            current[fid] = count
+            target[fid] = 0
+    income = lambda alloc: sum(h * (1 + 0.05 * alloc.get(fid, 0)) for fid, h in base.items())
+    return {
+        "pool": pool,
+        "current": current,
+        "target": target,
+        "unassigned": pool - sum(target.values()),
+        "current_income_per_hour": round(income(assignments), 2),
+        "target_income_per_hour": round(income(target), 2),
+    }
 
 # ---------------------------------------------------------
 # ROUTES
@@ -655,11 +2819,12 @@ def calculate_production(user):
 def load_logged_in_user():
     g.user = None
     if 'user_id' in session:
-        # Optimized: Only fetch if needed or if user data is old in session
-        # For now, let's keep the g.user for convenience but use session for HUD
+        # get_user istek önbelleğini doldurur; route'lardaki get_user çağrıları
+        # aynı belgeyi DB'ye tekrar gitmeden alır
         u = get_user(session['user_id'])
         if u:
             g.user = u
+            if request.endpoint != 'static': record_activity(u)
         else:
             session.clear()
 
@@ -687,8 +2852,7 @@ def api_user_me():
     if 'user_id' not in session:
         return jsonify({"success": False, "message": "Oturum kapalı"}), 401
     
-    # Try to use cached data in session if possible for very fast HUD updates
-    # But for now, get_user is already optimized with NullPool/dispose
+    # HUD sık çağırır: get_user istek/LRU önbelleğinden okur, bağlantı havuzdan gelir
     u = get_user(session['user_id'])
     if not u:
         return jsonify({"success": False, "message": "Kullanıcı bulunamadı"}), 404
@@ -699,7 +2863,8 @@ def api_user_me():
         "money": u['money'],
         "level": u['level'],
         "xp": u['xp'],
-        "inventory": u.get('inventory', {})
+        "inventory": u.get('inventory', {}),
+        "config_version": CONFIG_VERSION
     })
 
 @app.route('/')
@@ -948,7 +3113,7 @@ def _avg_price_for(name):
 @app.route('/api/marketplace/list')
 def api_marketplace_list():
     conn = get_db_connection()
-    rows = conn.execute('SELECT * FROM marketplace_products ORDER BY created_at DESC').fetchall()
+    rows = conn.execute('SELECT * FROM marketplace_products ORDER BY created_at DESC')
     conn.close()
     return jsonify([dict(r) for r in rows])
 
@@ -963,12 +3128,8 @@ def api_marketplace_add():
     stock = int(data.get('stock', 0))
     if not name or price <= 0 or stock <= 0:
         return jsonify({"success": False, "message": "Geçersiz bilgi!"})
-    with lock:
-        current = u['inventory'].get(name, 0)
-        if current < stock:
-            return jsonify({"success": False, "message": "Envanterde yeterli stok yok!"})
-        u['inventory'][name] = current - stock
-        save_user(u)
+    if not adjust_user_balance(u, items={name: -stock}):
+        return jsonify({"success": False, "message": "Envanterde yeterli stok yok!"})
     conn = get_db_connection()
     conn.execute('INSERT INTO marketplace_products (seller, name, description, price, stock, is_bot, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
                  (u['username'], name, desc, price, stock, 0, time.time()))
@@ -1040,39 +3201,39 @@ def api_marketplace_buy():
         conn.close()
         return jsonify({"success": False, "message": "Yetersiz stok!"})
     cost = row['price'] * qty
-    with lock:
-        if buyer['money'] < cost:
+    # Alıcı ve satıcı kilitleri sabit sırada: stok, borç ve alacak birlikte
+    with user_locks.hold(buyer['username'], row['seller']):
+        claimed = conn.execute('UPDATE marketplace_products SET stock = stock - ? WHERE id = ? AND stock >= ?',
+                               (qty, pid, qty)).rowcount
+        if claimed != 1:
+            conn.close()
+            return jsonify({"success": False, "message": "Yetersiz stok!"})
+        # Bakiye kontrolü ve düşümü tek koşullu UPDATE (money + ? >= 0)
+        if not adjust_user_balance(buyer, money_delta=-cost, items={row['name']: qty}):
+            conn.execute('UPDATE marketplace_products SET stock = stock + ? WHERE id = ?', (qty, pid))
             conn.close()
             return jsonify({"success": False, "message": "Yetersiz bakiye!"})
-        buyer['money'] -= cost
-        buyer['inventory'][row['name']] = buyer['inventory'].get(row['name'], 0) + qty
-        save_user(buyer)
-        # log user action
+        seller = get_user(row['seller'])
+        credited = bool(seller) and adjust_user_balance(seller, money_delta=cost)
+        conn.execute('DELETE FROM marketplace_products WHERE id = ? AND stock <= 0', (pid,))
+    # log user action
+    try:
+        uid_b = get_user_id_by_username(buyer['username'])
+        if uid_b:
+            log_user_action(uid_b, 'marketplace_buy', -cost)
+    except Exception:
+        pass
+    if credited:
         try:
-            uid_b = get_user_id_by_username(buyer['username'])
-            if uid_b:
-                log_user_action(uid_b, 'marketplace_buy', -cost)
+            uid_s = get_user_id_by_username(seller['username'])
+            if uid_s:
+                log_user_action(uid_s, 'marketplace_sale', cost)
         except Exception:
             pass
-        seller = get_user(row['seller'])
-        if seller:
-            seller['money'] += cost
-            save_user(seller)
-            try:
-                uid_s = get_user_id_by_username(seller['username'])
-                if uid_s:
-                    log_user_action(uid_s, 'marketplace_sale', cost)
-            except Exception:
-                pass
-        new_stock = row['stock'] - qty
-        if new_stock <= 0:
-            conn.execute('DELETE FROM marketplace_products WHERE id = ?', (pid,))
-        else:
-            conn.execute('UPDATE marketplace_products SET stock = ? WHERE id = ?', (new_stock, pid))
-        conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
-                     (row['seller'], 'marketplace_buy', cost, time.time(), json.dumps({"product_id": pid, "name": row['name'], "price": row['price'], "qty": qty, "buyer": buyer['username']})))
-        conn.commit()
-        conn.close()
+    conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
+                 (row['seller'], 'marketplace_buy', cost, time.time(), json.dumps({"product_id": pid, "name": row['name'], "price": row['price'], "qty": qty, "buyer": buyer['username']})))
+    conn.commit()
+    conn.close()
     return jsonify({"success": True, "message": "Satın alındı!"})
 
 @app.route('/api/marketplace/avg_price')
@@ -1116,7 +3277,7 @@ def api_marketplace_top_sellers():
 @app.route('/api/marketplace/recent_sales')
 def api_marketplace_recent_sales():
     conn = get_db_connection()
-    rows = conn.execute("SELECT * FROM transactions WHERE type = 'marketplace_buy' ORDER BY time DESC LIMIT 10").fetchall()
+    rows = conn.execute("SELECT * FROM transactions WHERE type = 'marketplace_buy' ORDER BY time DESC LIMIT 10")
     conn.close()
     return jsonify([dict(r) for r in rows])
 
@@ -1152,26 +3313,41 @@ def api_me():
         if u.get("is_banned"):
             return jsonify({"message": "Hesabınız yasaklandı"}), 403
     
-    with lock:
-        calculate_production(u)
-        now = time.time()
-        last = u.get("last_daily_bonus", 0)
-        u["daily_bonus_available"] = (now - last) >= 86400
-        exp = u.get("expedition")
-        u["expedition_active"] = False
-        if exp:
-            u["expedition_active"] = True
-            u["expedition_end_time"] = exp.get("end_time")
-            if u["expedition_end_time"] and now >= u["expedition_end_time"]:
-                u["expedition_completed"] = True
-        u["is_admin"] = False
-        # only save for real users
-        if 'user_id' in session:
-            save_user(u)
+    # Saf okuma: belge değişmez, birikim ve türetilmiş alanlar kopyada
+    now = time.time()
+    u = dict(u)
+    if 'user_id' in session:
+        u["factory_storage"] = production_snapshot(u, now, _production_events())
+        u["is_afk"] = (now - u.get("last_active", now)) > AFK_AFTER_SEC
+    last = u.get("last_daily_bonus", 0)
+    u["daily_bonus_available"] = (now - last) >= 86400
+    exp = u.get("expedition")
+    u["expedition_active"] = False
+    if exp:
+        u["expedition_active"] = True
+        u["expedition_end_time"] = exp.get("end_time")
+        if u["expedition_end_time"] and now >= u["expedition_end_time"]:
+            u["expedition_completed"] = True
+    u["is_admin"] = False
         
-    u["factory_config"] = FACTORY_CONFIG
+    # Ayarlar /api/config'ten; burada yalnızca sürüm
+    u["config_version"] = CONFIG_VERSION
     return jsonify(u)
 
+@app.route('/api/config')
+def api_config():
+    """Sabit oyun ayarları. ETag içerik özeti; ?v=<sürüm> ile istenen yanıt
+    değişmez olduğundan uzun süre önbellekte kalır."""
+    resp = app.response_class(_CONFIG_BODY, mimetype='application/json')
+    resp.set_etag(CONFIG_VERSION)
+    if request.args.get('v') == CONFIG_VERSION:
+        resp.cache_control.public = True
+        resp.cache_control.max_age = 31536000
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
 # ---------------------------------------------------------
 # ECONOMY API: LAND
 # ---------------------------------------------------------
@@ -1185,13 +3361,7 @@ def api_land_list():
     
     owned = [dict(r) for r in rows]
     # Available types & base prices
-    options = {
-        "Tarla": {"base_price": 1000, "locations": {"Kırsal": 0.9, "Şehir": 1.1}},
-        "Sanayi Arsası": {"base_price": 5000, "locations": {"Kırsal": 0.95, "Şehir": 1.2}},
-        "Şehir Arsası": {"base_price": 10000, "locations": {"Kırsal": 1.0, "Şehir": 1.4}}
-    }
-    sizes = {"Küçük": 1.0, "Orta": 1.8, "Büyük": 3.2}
-    return jsonify({"owned": owned, "options": options, "sizes": sizes})
+    return jsonify({"owned": owned, "options": LAND_OPTIONS, "sizes": LAND_SIZES})
 
 @app.route('/api/land/buy', methods=['POST'])
 def api_land_buy():
@@ -1201,13 +3371,7 @@ def api_land_buy():
     type_ = data.get('type')
     size = data.get('size')
     location = data.get('location')
-    
-    options = {
-        "Tarla": {"base_price": 1000, "locations": {"Kırsal": 0.9, "Şehir": 1.1}},
-        "Sanayi Arsası": {"base_price": 5000, "locations": {"Kırsal": 0.95, "Şehir": 1.2}},
-        "Şehir Arsası": {"base_price": 10000, "locations": {"Kırsal": 1.0, "Şehir": 1.4}}
-    }
-    sizes = {"Küçük": 1.0, "Orta": 1.8, "Büyük": 3.2}
+    options, sizes = LAND_OPTIONS, LAND_SIZES
     
     if type_ not in options or size not in sizes or location not in options[type_]["locations"]:
         return jsonify({"success": False, "message": "Geçersiz parametre!"})
@@ -1215,19 +3379,16 @@ def api_land_buy():
     base = options[type_]["base_price"]
     price = int(base * sizes[size] * options[type_]["locations"][location])
     
-    with lock:
-        if u['money'] < price:
-            return jsonify({"success": False, "message": "Yetersiz bakiye!"})
-        u['money'] -= price
-        save_user(u)
-        
-        conn = get_db_connection()
-        conn.execute('INSERT INTO lands (owner, type, size, location, price, created_at) VALUES (?, ?, ?, ?, ?, ?)',
-                     (u['username'], type_, size, location, price, time.time()))
-        conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
-                     (u['username'], 'land_buy', -price, time.time(), json.dumps({"type": type_, "size": size, "location": location})))
-        conn.commit()
-        conn.close()
+    if not adjust_user_balance(u, money_delta=-price):
+        return jsonify({"success": False, "message": "Yetersiz bakiye!"})
+    
+    conn = get_db_connection()
+    conn.execute('INSERT INTO lands (owner, type, size, location, price, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                 (u['username'], type_, size, location, price, time.time()))
+    conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
+                 (u['username'], 'land_buy', -price, time.time(), json.dumps({"type": type_, "size": size, "location": location})))
+    conn.commit()
+    conn.close()
     
     return jsonify({"success": True, "message": f"{size} {type_} satın alındı! Maliyet: {price} TL"})
 
@@ -1244,7 +3405,7 @@ def api_workers_buy():
     if count <= 0:
         return jsonify({"success": False, "message": "Geçersiz adet!"})
     cost = 500 * count
-    with lock:
+    def _buy(u):
         if u['money'] < cost:
             return jsonify({"success": False, "message": "Yetersiz bakiye!"})
         u['money'] -= cost
@@ -1260,7 +3421,8 @@ def api_workers_buy():
                 u['mission'] = {"kind": "upgrade", "description": "1 fabrika yükselt!", "target_qty": 1, "current_qty": 0, "reward": 1000}
             else:
                 u['mission'] = m
-        save_user(u)
+    err = update_user(u['username'], _buy)
+    if err: return err
     conn = get_db_connection()
     conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
                  (u['username'], 'workers_buy', -cost, time.time(), json.dumps({"count": count})))
@@ -1276,29 +3438,22 @@ def api_workers_hire():
     type_ = data.get('type')
     count = int(data.get('count', 0))
     
-    worker_defs = {
-        "İşçi": {"salary": 50, "productivity": 1.0},
-        "Usta": {"salary": 120, "productivity": 1.5},
-        "Mühendis": {"salary": 300, "productivity": 2.0}
-    }
+    worker_defs = WORKER_TYPES
     if type_ not in worker_defs or count <= 0:
         return jsonify({"success": False, "message": "Geçersiz parametre!"})
     
     # Hire fee: 10x salary per worker
     cost = worker_defs[type_]["salary"] * 10 * count
-    with lock:
-        if u['money'] < cost:
-            return jsonify({"success": False, "message": "Yetersiz bakiye!"})
-        u['money'] -= cost
-        save_user(u)
-        
-        conn = get_db_connection()
-        conn.execute('INSERT INTO workers (owner, type, count, salary, productivity, created_at) VALUES (?, ?, ?, ?, ?, ?)',
-                     (u['username'], type_, count, worker_defs[type_]["salary"], worker_defs[type_]["productivity"], time.time()))
-        conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
-                     (u['username'], 'workers_hire', -cost, time.time(), json.dumps({"type": type_, "count": count})))
-        conn.commit()
-        conn.close()
+    if not adjust_user_balance(u, money_delta=-cost):
+        return jsonify({"success": False, "message": "Yetersiz bakiye!"})
+    
+    conn = get_db_connection()
+    conn.execute('INSERT INTO workers (owner, type, count, salary, productivity, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                 (u['username'], type_, count, worker_defs[type_]["salary"], worker_defs[type_]["productivity"], time.time()))
+    conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
+                 (u['username'], 'workers_hire', -cost, time.time(), json.dumps({"type": type_, "count": count})))
+    conn.commit()
+    conn.close()
     return jsonify({"success": True, "message": f"{count} {type_} işe alındı! Maliyet: {cost} TL"})
 
 @app.route('/api/workers/fire', methods=['POST'])
@@ -1315,17 +3470,14 @@ def api_workers_fire():
         return jsonify({"success": False, "message": "İşçi kaydı bulunamadı!"})
     # Severance cost: 2x salary per worker
     cost = row['salary'] * 2 * row['count']
-    with lock:
-        if u['money'] < cost:
-            conn.close()
-            return jsonify({"success": False, "message": "Yetersiz bakiye!"})
-        u['money'] -= cost
-        save_user(u)
-        conn.execute('DELETE FROM workers WHERE id = ?', (worker_id,))
-        conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
-                     (u['username'], 'workers_fire', -cost, time.time(), json.dumps({"id": worker_id})))
-        conn.commit()
+    if not adjust_user_balance(u, money_delta=-cost):
         conn.close()
+        return jsonify({"success": False, "message": "Yetersiz bakiye!"})
+    conn.execute('DELETE FROM workers WHERE id = ?', (worker_id,))
+    conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
+                 (u['username'], 'workers_fire', -cost, time.time(), json.dumps({"id": worker_id})))
+    conn.commit()
+    conn.close()
     return jsonify({"success": True, "message": f"İşten çıkarıldı. Tazminat: {cost} TL"})
 
 # ---------------------------------------------------------
@@ -1336,7 +3488,7 @@ def api_logistics_vehicles():
     if 'user_id' not in session: return jsonify([]), 401
     u = get_user(session['user_id'])
     conn = get_db_connection()
-    rows = conn.execute('SELECT * FROM vehicles WHERE owner = ?', (u['username'],)).fetchall()
+    rows = conn.execute('SELECT * FROM vehicles WHERE owner = ?', (u['username'],))
     conn.close()
     return jsonify([dict(r) for r in rows])
 
@@ -1346,27 +3498,19 @@ def api_logistics_buy_vehicle():
     u = get_user(session['user_id'])
     data = request.json
     type_ = data.get('type')
-    types = {
-        "Kamyon": {"capacity": 100, "price": 250000},
-        "Tır": {"capacity": 500, "price": 1000000},
-        "Uçak": {"capacity": 2000, "price": 10000000},
-        "Gemi": {"capacity": 10000, "price": 50000000}
-    }
+    types = VEHICLE_TYPES
     if type_ not in types:
         return jsonify({"success": False, "message": "Geçersiz araç türü!"})
     info = types[type_]
-    with lock:
-        if u['money'] < info['price']:
-            return jsonify({"success": False, "message": "Yetersiz bakiye!"})
-        u['money'] -= info['price']
-        save_user(u)
-        conn = get_db_connection()
-        conn.execute('INSERT INTO vehicles (owner, type, capacity, created_at) VALUES (?, ?, ?, ?)',
-                     (u['username'], type_, info['capacity'], time.time()))
-        conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
-                     (u['username'], 'vehicle_buy', -info['price'], time.time(), json.dumps({"type": type_})))
-        conn.commit()
-        conn.close()
+    if not adjust_user_balance(u, money_delta=-info['price']):
+        return jsonify({"success": False, "message": "Yetersiz bakiye!"})
+    conn = get_db_connection()
+    conn.execute('INSERT INTO vehicles (owner, type, capacity, created_at) VALUES (?, ?, ?, ?)',
+                 (u['username'], type_, info['capacity'], time.time()))
+    conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
+                 (u['username'], 'vehicle_buy', -info['price'], time.time(), json.dumps({"type": type_})))
+    conn.commit()
+    conn.close()
     return jsonify({"success": True, "message": f"{type_} satın alındı!"})
 
 @app.route('/api/logistics/tasks')
@@ -1387,7 +3531,7 @@ def api_logistics_tasks():
                 pass
             conn.execute('UPDATE logistics_tasks SET delivered = 1 WHERE id = ?', (r['id'],))
     conn.commit()
-    rows = conn.execute('SELECT * FROM logistics_tasks WHERE owner = ? ORDER BY created_at DESC', (u['username'],)).fetchall()
+    rows = conn.execute('SELECT * FROM logistics_tasks WHERE owner = ? ORDER BY created_at DESC', (u['username'],))
     conn.close()
     return jsonify([dict(r) for r in rows])
 
@@ -1412,21 +3556,18 @@ def api_logistics_create_task():
         conn.close()
         return jsonify({"success": False, "message": "Araç kapasitesi yetersiz!"})
     current = u['inventory'].get(item, 0)
-    if current < amount:
+    if current < amount or not adjust_user_balance(u, items={item: -amount}):
         conn.close()
         return jsonify({"success": False, "message": "Envanter yetersiz!"})
-    with lock:
-        u['inventory'][item] = current - amount
-        save_user(u)
-        eta_delta = 600 if city_scope == 'same' else 1800
-        ev = _get_current_event()
-        if ev and ev.get('target', {}).get('type') == 'logistics':
-            eta_delta = int(eta_delta * float(ev.get('logistics_cost_multiplier', 1.0)))
-        eta = time.time() + eta_delta
-        conn.execute('INSERT INTO logistics_tasks (owner, vehicle_id, item, amount, destination, city_scope, eta, delivered, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                     (u['username'], vehicle_id, item, amount, destination, city_scope, eta, 0, time.time()))
-        conn.commit()
-        conn.close()
+    eta_delta = 600 if city_scope == 'same' else 1800
+    ev = _get_current_event()
+    if ev and ev.get('target', {}).get('type') == 'logistics':
+        eta_delta = int(eta_delta * float(ev.get('logistics_cost_multiplier', 1.0)))
+    eta = time.time() + eta_delta
+    conn.execute('INSERT INTO logistics_tasks (owner, vehicle_id, item, amount, destination, city_scope, eta, delivered, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (u['username'], vehicle_id, item, amount, destination, city_scope, eta, 0, time.time()))
+    conn.commit()
+    conn.close()
     return jsonify({"success": True, "message": "Lojistik görevi oluşturuldu!"})
 # ---------------------------------------------------------
 # ECONOMY DASHBOARD STATS
@@ -1467,81 +3608,12 @@ def api_economy_stats():
 
 # ---------------------------------------------------------
 # NEW API: FACTORY LIST (guest-friendly)
-# ---------------------------------------------------------
-@app.route('/api/factory/list')
-def api_factory_list():
-    if 'user_id' not in session:
-        rows = []
-        for fid, conf in FACTORY_CONFIG.items():
-            rows.append({
-                "type": fid,
-                "name": conf['name'],
-                "product_type": conf.get('type'),
-                "level": 0,
-                "running": False,
-                "rate_per_hour": 0,
-                "worker_count": 0,
-                "worker_capacity": conf.get('worker_capacity', 0),
-                "bonus_pct": 0,
-                "production_interval_hours": 3,
-                "last_collect_hours_ago": 0,
-                "production_duration_minutes": None,
-                "remaining_seconds": None,
-                "collectable": False,
-                "daily_income": 0,
-                "build_cost": conf.get('cost', 0),
-            })
-        return jsonify(rows)
-    # Reuse logic from /api/factories but add build_cost
-    u = get_user(session['user_id'])
-    conn = get_db_connection()
-    rows = []
-    for fid, conf in FACTORY_CONFIG.items():
-        lvl = u.get('factories', {}).get(fid, 0)
-        running = bool(u.get('factory_running', {}).get(fid, True))
-        assigned = conn.execute('SELECT COALESCE(SUM(count),0) AS c FROM factory_assignments WHERE owner = ? AND factory_type = ?', 
-                                (u['username'], fid)).fetchone()['c']
-        ev = _get_current_event()
-        prod_mult = 1.0
-        if ev and ev.get('target', {}).get('type') == 'production':
-            prod_mult = float(ev.get('production_multiplier', 1.0))
-        rate_per_hour = int(FACTORY_CONFIG[fid]['rate'] * max(1,lvl) * (1 + 0.05 * assigned) * prod_mult * (1 if running else 0))
-        pr = conn.execute('SELECT price FROM prices WHERE item = ?', (FACTORY_CONFIG[fid]['type'],)).fetchone()
-        price = pr['price'] if pr else 0
-        daily_income = int(rate_per_hour * 24 * price)
-        last_collect = u.get('factory_last_collect', {}).get(fid, u.get('factory_last_update', {}).get(fid, time.time()))
-        elapsed_hours = round((time.time() - last_collect) / 3600.0, 2)
-        capacity = FACTORY_CONFIG[fid].get('worker_capacity', 0) * max(1, lvl or 1)
-        bonus_pct = int(0.05 * assigned * 100)
-        run_start = u.get('factory_run_start', {}).get(fid)
-        run_dur_min = u.get('factory_run_duration', {}).get(fid)
-        remaining_seconds = None
-        collectable = False
-        production_duration_minutes = None
-        if run_start and run_dur_min:
-            production_duration_minutes = run_dur_min
-            remaining_seconds = max(0, int(run_dur_min*60 - (time.time() - run_start)))
-            collectable = remaining_seconds == 0
-        rows.append({
-            "type": fid,
-            "name": FACTORY_CONFIG[fid]['name'],
-            "product_type": FACTORY_CONFIG[fid].get('type'),
-            "level": lvl,
-            "running": running,
-            "rate_per_hour": rate_per_hour,
-            "worker_count": assigned,
-            "worker_capacity": capacity,
-            "bonus_pct": bonus_pct,
-            "production_interval_hours": 3,
-            "last_collect_hours_ago": elapsed_hours,
-            "production_duration_minutes": production_duration_minutes,
-            "remaining_seconds": remaining_seconds,
-            "collectable": collectable,
-            "daily_income": daily_income,
-            "build_cost": FACTORY_CONFIG[fid].get('cost', 0),
-        })
-    conn.close()
-    return jsonify(rows)
+# ---------------------------------------------------------
+@app.route('/api/factory/list')
+def api_factory_list():
+    if 'user_id' not in session:
+        return jsonify(GUEST_FACTORY_ROWS)
+    return jsonify(build_factory_rows(get_user(session['user_id'])))
 
 # ---------------------------------------------------------
 # NEW API: INVENTORY GET (guest-friendly)
@@ -1551,20 +3623,7 @@ def api_inventory_get():
     if 'user_id' not in session:
         return jsonify({"items": [], "total_value": 0})
     u = get_user(session['user_id'])
-    conn = get_db_connection()
-    rows = conn.execute('SELECT item, price FROM prices').fetchall()
-    conn.close()
-    ev = _get_current_event()
-    prices = {}
-    for r in rows:
-        p = r['price']
-        name = r['item']
-        if ev:
-            if ev.get('target', {}).get('type') == 'item' and ev['target'].get('name') == name:
-                p = max(1.0, p * ev.get('price_multiplier', 1.0))
-            elif ev.get('target', {}).get('type') == 'prices_all':
-                p = max(1.0, p * ev.get('price_multiplier', 1.0))
-        prices[name] = p
+    prices = price_book.effective()
     items = []
     total_value = 0
     for name, qty in u.get('inventory', {}).items():
@@ -1586,23 +3645,19 @@ def api_market_overview():
         "Altın": "Altın",
         "Teknoloji": "Elektronik"
     }
-    conn = get_db_connection()
     out = []
-    try:
-        for label, item_name in focus_map.items():
-            row = conn.execute('SELECT price, last_change FROM prices WHERE item = ?', (item_name,)).fetchone()
-            price = int(row['price']) if row else 0
-            last_change = float(row['last_change']) if row else 0.0
-            trend = "Yükselişte" if last_change >= 0 else "Düşüşte"
-            out.append({
-                "label": label,
-                "item": item_name,
-                "price": price,
-                "last_change": last_change,
-                "trend": trend
-            })
-    finally:
-        conn.close()
+    for label, item_name in focus_map.items():
+        row = price_book.row(item_name)
+        price = int(row['price']) if row else 0
+        last_change = float(row['last_change']) if row else 0.0
+        trend = "Yükselişte" if last_change >= 0 else "Düşüşte"
+        out.append({
+            "label": label,
+            "item": item_name,
+            "price": price,
+            "last_change": last_change,
+            "trend": trend
+        })
     return jsonify(out)
 
 @app.route('/api/market/quick_buy', methods=['POST'])
@@ -1615,26 +3670,24 @@ def api_market_quick_buy():
     if qty <= 0:
         return jsonify({"success": False, "message": "Geçersiz miktar"})
     u = get_user(session['user_id'])
-    conn = get_db_connection()
-    try:
-        row = conn.execute('SELECT price FROM prices WHERE item = ?', (item,)).fetchone()
-        if not row:
-            return jsonify({"success": False, "message": "Ürün bulunamadı"})
-        unit_price = int(row['price'])
-        total = unit_price * qty
+    base = price_book.base(item)
+    if base is None:
+        return jsonify({"success": False, "message": "Ürün bulunamadı"})
+    unit_price = int(base)
+    total = unit_price * qty
+    def _quick_buy(u):
         if u.get('money', 0) < total:
             return jsonify({"success": False, "message": "Yetersiz bakiye"})
-        with lock:
-            old_qty = int(u.get('inventory', {}).get(item, 0))
-            old_avg = int((u.get('avg_buy_prices', {}) or {}).get(item, unit_price))
-            new_qty = old_qty + qty
-            weighted = int(((old_qty * old_avg) + (qty * unit_price)) / max(1, new_qty))
-            u['money'] = int(u.get('money', 0) - total)
-            u.setdefault('inventory', {})[item] = new_qty
-            u.setdefault('avg_buy_prices', {})[item] = weighted
-            save_user(u)
-    finally:
-        conn.close()
+        old_qty = int(u.get('inventory', {}).get(item, 0))
+        old_avg = int((u.get('avg_buy_prices', {}) or {}).get(item, unit_price))
+        new_qty = old_qty + qty
+        weighted = int(((old_qty * old_avg) + (qty * unit_price)) / max(1, new_qty))
+        u['money'] = int(u.get('money', 0) - total)
+        u.setdefault('inventory', {})[item] = new_qty
+        u.setdefault('avg_buy_prices', {})[item] = weighted
+    err = update_user(u['username'], _quick_buy)
+    if err: return err
+    u = get_user(u['username'])
     return jsonify({"success": True, "message": f"{qty} {item} alındı", "money": u.get('money', 0)})
 
 @app.route('/api/market/quick_sell', methods=['POST'])
@@ -1650,19 +3703,14 @@ def api_market_quick_sell():
     have = int(u.get('inventory', {}).get(item, 0))
     if have < qty:
         return jsonify({"success": False, "message": "Yetersiz stok"})
-    conn = get_db_connection()
-    try:
-        row = conn.execute('SELECT price FROM prices WHERE item = ?', (item,)).fetchone()
-        if not row:
-            return jsonify({"success": False, "message": "Ürün bulunamadı"})
-        unit_price = int(row['price'])
-        total = unit_price * qty
-        with lock:
-            u['inventory'][item] = have - qty
-            u['money'] = int(u.get('money', 0) + total)
-            save_user(u)
-    finally:
-        conn.close()
+    base = price_book.base(item)
+    if base is None:
+        return jsonify({"success": False, "message": "Ürün bulunamadı"})
+    unit_price = int(base)
+    total = unit_price * qty
+    # Tek hedefli UPDATE: qty = qty - ?, money = money + ?
+    if not adjust_user_balance(u, money_delta=total, items={item: -qty}):
+        return jsonify({"success": False, "message": "Yetersiz stok"})
     return jsonify({"success": True, "message": f"{qty} {item} satıldı", "money": u.get('money', 0)})
 
 # ---------------------------------------------------------
@@ -1686,11 +3734,14 @@ def add_resource(owner, item, qty):
     conn.close()
 
 def calculate_economy(user):
+    """Arazi üretimini hesaplar; eklenecek (ürün, adet) listesini döner.
+    Kaynak satırları belge kaydedildikten sonra yazılır (add_resource)."""
     now = time.time()
     last = user.get('resource_last_update', now)
     elapsed_min = (now - last) / 60.0
+    accrued = []
     if elapsed_min <= 0:
-        return
+        return accrued
     
     # Production based on lands and workers
     conn = get_db_connection()
@@ -1719,17 +3770,21 @@ def calculate_economy(user):
         for item, rate in rates.items():
             qty = int(rate * size_mult.get(l['size'], 1.0) * prod_mult * elapsed_min)
             if qty > 0:
-                add_resource(user['username'], item, qty)
+                accrued.append((item, qty))
     
     user['resource_last_update'] = now
+    return accrued
 
 @app.route('/api/resources')
 def api_resources():
     if 'user_id' not in session: return jsonify({}), 401
     u = get_user(session['user_id'])
-    with lock:
-        calculate_economy(u)
-        save_user(u)
+    accrued = []
+    def _accrue(u):
+        accrued[:] = calculate_economy(u)
+    update_user(u['username'], _accrue)
+    for item, qty in accrued:
+        add_resource(u['username'], item, qty)
     res = get_resources(u['username'])
     return jsonify(res)
 
@@ -1738,20 +3793,7 @@ def api_inventory():
     if 'user_id' not in session:
         return jsonify({"items": [], "total_value": 0})
     u = get_user(session['user_id'])
-    conn = get_db_connection()
-    rows = conn.execute('SELECT item, price FROM prices').fetchall()
-    conn.close()
-    ev = _get_current_event()
-    prices = {}
-    for r in rows:
-        p = r['price']
-        name = r['item']
-        if ev:
-            if ev.get('target', {}).get('type') == 'item' and ev['target'].get('name') == name:
-                p = max(1.0, p * ev.get('price_multiplier', 1.0))
-            elif ev.get('target', {}).get('type') == 'prices_all':
-                p = max(1.0, p * ev.get('price_multiplier', 1.0))
-        prices[name] = p
+    prices = price_book.effective()
     items = []
     total_value = 0
     for name, qty in u.get('inventory', {}).items():
@@ -1765,32 +3807,12 @@ def api_inventory():
 @app.route('/api/market')
 def api_market():
     conn = get_db_connection()
-    listings = conn.execute('SELECT * FROM market ORDER BY time DESC LIMIT 50').fetchall()
-    # Attach prices snapshot
-    prices_rows = conn.execute('SELECT * FROM prices').fetchall()
-    # Simple supply/demand based tweak on each call (10s gate)
-    now = time.time()
-    for pr in prices_rows:
-        last_upd = pr['updated_at']
-        if now - last_upd >= 10:
-            # Demand proxy: count of listings with low stock vs high
-            # Supply proxy: resources table aggregate
-            items = [r['item'] for r in listings]
-            demand_factor = items.count(pr['item']) * 0.01
-            supply_rows = conn.execute('SELECT COALESCE(SUM(quantity),0) AS q FROM resources WHERE item = ?', (pr['item'],)).fetchone()
-            supply_q = supply_rows['q']
-            supply_factor = (supply_q / 1000.0) * 0.01
-            delta = (demand_factor - supply_factor)
-            # Clamp delta
-            delta = max(-0.05, min(0.05, delta))
-            new_price = max(1.0, pr['price'] * (1.0 + delta))
-            last_change = new_price - pr['price']
-            conn.execute('UPDATE prices SET price = ?, last_change = ?, updated_at = ? WHERE item = ?',
-                         (new_price, last_change, now, pr['item']))
-    conn.commit()
-    # Re-read
-    prices_rows = conn.execute('SELECT * FROM prices').fetchall()
+    listings = conn.execute("SELECT * FROM market WHERE side = 'sell' ORDER BY time DESC LIMIT 50").fetchall()
     conn.close()
+    # Fiyatlar price_engine_tick'te güncellenir; burada sadece okunur
+    prices_rows = price_book.rows()
+    market_book.sync()
+    books = {item: market_book.depth(item) for item in list(market_book.books)}
     
     items = {
         "Odun": {"name": "Odun", "rarity": 1},
@@ -1815,25 +3837,13 @@ def api_market():
         "listings": [dict(ix) for ix in listings],
         "items": items,
         "economy": economy,
+        "books": {item: d for item, d in books.items() if d["bids"] or d["asks"]},
         "prices": [dict(p) for p in prices_rows]
     })
 
 @app.route('/api/market/prices')
 def api_market_prices():
-    conn = get_db_connection()
-    rows = conn.execute('SELECT * FROM prices').fetchall()
-    conn.close()
-    ev = _get_current_event()
-    out = []
-    for r in rows:
-        pr = dict(r)
-        if ev:
-            if ev.get('target', {}).get('type') == 'item' and ev['target'].get('name') == pr['item']:
-                pr['price'] = max(1.0, pr['price'] * ev.get('price_multiplier', 1.0))
-            elif ev.get('target', {}).get('type') == 'prices_all':
-                pr['price'] = max(1.0, pr['price'] * ev.get('price_multiplier', 1.0))
-        out.append(pr)
-    return jsonify(out)
+    return jsonify(price_book.effective_rows())
 
 @app.route('/api/news')
 def api_news():
@@ -1854,102 +3864,97 @@ def api_news():
             new_price = max(1.0, pr['price'] * factor)
             conn.execute('UPDATE prices SET price = ?, last_change = ?, updated_at = ? WHERE item = ?', 
                          (new_price, new_price - pr['price'], now, it))
+            _prices_written(conn)
         conn.commit()
         last = conn.execute('SELECT * FROM news ORDER BY id DESC LIMIT 1').fetchone()
     # Return recent 10
-    rows = conn.execute('SELECT * FROM news ORDER BY id DESC LIMIT 10').fetchall()
+    rows = conn.execute('SELECT * FROM news ORDER BY id DESC LIMIT 10')
     conn.close()
     return jsonify([dict(r) for r in rows])
 
+def _place_order(u, side, item, qty, price, order_id=None):
+    ev = _get_current_event()
+    if order_id is not None:
+        res = market_book.take(u, order_id, qty)
+        if res is False:
+            return jsonify({"success": False, "message": "Yetersiz stok!"})
+    else:
+        res = market_book.place(u, side, item, qty, price)
+    if res is None:
+        return jsonify({"success": False, "message": "Yetersiz bakiye!" if side == 'buy' else "Yetersiz stok!"})
+    # Event participation bonus XP
+    if ev:
+        def _bonus(u):
+            u['xp'] = u.get('xp', 0) + 5
+            check_level_up(u)
+        update_user(u['username'], _bonus)
+    if not res['filled']:
+        msg = "İlan oluşturuldu!" if side == 'sell' else "Alış emri deftere yazıldı!"
+    elif res['rest']:
+        msg = f"{res['filled']} adet {item} eşleşti, kalan {res['rest']} adet deftere yazıldı."
+    else:
+        msg = f"{res['filled']} adet {item} {'alındı' if side == 'buy' else 'satıldı'}!"
+    return jsonify({"success": True, "message": msg, **res})
+
+def _order_args(data):
+    try:
+        return int(data.get('adet', 0) or 0), int(data.get('fiyat', 0) or 0)
+    except (TypeError, ValueError):
+        return 0, 0
+
 @app.route('/buy', methods=['POST'])
 def buy():
+    """Limit alış emri: {item, adet, fiyat}. Eski istemcinin {order_id, adet}
+    isteği sadece o ilandan alır: ilan yetmezse hiçbir şey almaz ve deftere
+    alış emri bırakmaz (fill-or-kill)."""
     if 'user_id' not in session: return jsonify({"success": False}), 401
     u = get_user(session['user_id'])
-    data = request.json
-    
-    # Implement buy from market
-    # This requires looking up the order in DB
-    order_id = data.get('order_id')
-    qty = data.get('adet')
-    
-    conn = get_db_connection()
-    listing = conn.execute('SELECT * FROM market WHERE id = ?', (order_id,)).fetchone()
-    
-    if not listing:
-        conn.close()
-        return jsonify({"success": False, "message": "İlan bulunamadı!"})
-        
-    if listing['adet'] < qty:
-        conn.close()
-        return jsonify({"success": False, "message": "Yetersiz stok!"})
-        
-    cost = listing['fiyat'] * qty
-    
-    with lock:
-        if u['money'] < cost:
-            conn.close()
-            return jsonify({"success": False, "message": "Yetersiz bakiye!"})
-            
-        # Update Buyer
-        u['money'] -= cost
-        item_name = listing['item']
-        u['inventory'][item_name] = u['inventory'].get(item_name, 0) + qty
-        # Event participation bonus XP
-        ev = _get_current_event()
-        if ev:
-            u['xp'] = u.get('xp', 0) + 5
-            check_level_up(u)
-        save_user(u)
-        
-        # Update Seller
-        seller = get_user(listing['satici'])
-        if seller:
-            seller['money'] += cost
-            save_user(seller)
-            
-        # Update Market DB
-        if listing['adet'] == qty:
-            conn.execute('DELETE FROM market WHERE id = ?', (order_id,))
-        else:
-            conn.execute('UPDATE market SET adet = adet - ? WHERE id = ?', (qty, order_id))
-        conn.commit()
-        
-    conn.close()
-    return jsonify({"success": True, "message": f"{qty} adet {item_name} alındı!"})
+    data = request.json or {}
+    qty, price = _order_args(data)
+    item = data.get('item')
+    if data.get('order_id') is not None:
+        try:
+            listing = market_book.order(int(data.get('order_id')))
+        except (TypeError, ValueError):
+            listing = None
+        if not listing or listing['side'] != 'sell':
+            return jsonify({"success": False, "message": "İlan bulunamadı!"})
+        if qty <= 0:
+            return jsonify({"success": False, "message": "Geçersiz miktar/fiyat!"})
+        return _place_order(u, 'buy', listing['item'], qty, listing['price'], order_id=listing['id'])
+    if not item or qty <= 0 or price <= 0:
+        return jsonify({"success": False, "message": "Geçersiz miktar/fiyat!"})
+    return _place_order(u, 'buy', item, qty, price)
 
 @app.route('/sell', methods=['POST'])
 def sell():
     if 'user_id' not in session: return jsonify({"success": False}), 401
     u = get_user(session['user_id'])
-    data = request.json
-    
+    data = request.json or {}
     item = data.get('item')
-    qty = int(data.get('adet', 0))
-    price = int(data.get('fiyat', 0))
-    
-    if qty <= 0 or price <= 0:
+    qty, price = _order_args(data)
+    if not item or qty <= 0 or price <= 0:
         return jsonify({"success": False, "message": "Geçersiz miktar/fiyat!"})
-        
-    with lock:
-        current_qty = u['inventory'].get(item, 0)
-        if current_qty < qty:
-            return jsonify({"success": False, "message": "Yetersiz stok!"})
-            
-        u['inventory'][item] -= qty
-        # Event participation bonus XP
-        ev = _get_current_event()
-        if ev:
-            u['xp'] = u.get('xp', 0) + 5
-            check_level_up(u)
-        save_user(u)
-        
-        conn = get_db_connection()
-        conn.execute('INSERT INTO market (satici, item, adet, fiyat, time) VALUES (?, ?, ?, ?, ?)',
-                     (u['username'], item, qty, price, time.time()))
-        conn.commit()
-        conn.close()
-        
-    return jsonify({"success": True, "message": "İlan oluşturuldu!"})
+    return _place_order(u, 'sell', item, qty, price)
+
+@app.route('/api/market/cancel', methods=['POST'])
+def api_market_cancel():
+    if 'user_id' not in session: return jsonify({"success": False}), 401
+    u = get_user(session['user_id'])
+    try:
+        order_id = int((request.json or {}).get('id'))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "message": "Emir bulunamadı!"})
+    qty = market_book.cancel(u, order_id)
+    if qty is None:
+        return jsonify({"success": False, "message": "Emir bulunamadı!"})
+    return jsonify({"success": True, "message": f"Emir iptal edildi, {qty} adet iade edildi."})
+
+@app.route('/api/market/book')
+def api_market_book():
+    item = request.args.get('item', '')
+    market_book.sync()
+    return jsonify({"item": item, **market_book.depth(item, min(50, request.args.get('depth', ORDER_BOOK_DEPTH, type=int)))})
 
 # Factory Actions
 @app.route('/api/factory_status/<fid>')
@@ -1961,7 +3966,8 @@ def factory_status(fid):
     if not conf: return jsonify({}), 404
     
     level = u['factories'].get(fid, 0)
-    storage = u['factory_storage'].get(fid, 0)
+    assigned = get_worker_assignments(u['username']).get(fid, 0)
+    storage = factory_stored(u, fid, time.time(), assigned, _production_events())
     
     next_level = level + 1
     next_cost = conf['cost'] * next_level
@@ -1969,11 +3975,12 @@ def factory_status(fid):
     # Calculate next mat cost logic (simplified)
     next_mat = None
     next_mat_cost = 0
-    if level > 0:
-        # Example: Upgrade needs previous tier material
-        pass 
-        
+    # Aralık başı girdi ihtiyacı derlenmiş tablodan
+    _, needs = RECIPE_GRAPH.throughput(fid, max(1, level))
+
     return jsonify({
+        "inputs": dict(RECIPE_GRAPH.inputs[fid]),
+        "inputs_per_interval": dict(needs),
         "level": level,
         "storage": storage,
         "capacity": conf['capacity'] * level if level > 0 else conf['capacity'],
@@ -1991,8 +3998,10 @@ def upgrade_factory(fid):
     u = get_user(session['user_id'])
     conf = FACTORY_CONFIG.get(fid)
     if not conf: return jsonify({"success": False}), 404
+    assignments = get_worker_assignments(u['username'])
+    prod_evs = _production_events()
     
-    with lock:
+    def _upgrade(u):
         current_lvl = u['factories'].get(fid, 0)
         next_lvl = current_lvl + 1
         
@@ -2006,6 +4015,9 @@ def upgrade_factory(fid):
         if u['level'] < conf['unlock_lvl']:
              return jsonify({"success": False, "message": f"Seviye {conf['unlock_lvl']} gerekli!"})
              
+        now = time.time()
+        _touch_active(u, now, assignments, prod_evs)
+        _bank_factory(u, fid, now, assignments.get(fid, 0), prod_evs)
         u['money'] -= cost
         u['factories'][fid] = next_lvl
         # Mission progress for upgrade
@@ -2018,13 +4030,13 @@ def upgrade_factory(fid):
                 u['mission'] = {"kind": "produce", "description": "100 ürün üret!", "target_qty": 100, "current_qty": 0, "reward": 1000}
             else:
                 u['mission'] = m
-        save_user(u)
+    err = update_user(u['username'], _upgrade)
+    if err: return err
+    u = get_user(u['username'])
+    next_lvl = u['factories'][fid]
     
     # Compute new production metrics for response
-    conn = get_db_connection()
-    assigned = conn.execute('SELECT COALESCE(SUM(count),0) AS c FROM factory_assignments WHERE owner = ? AND factory_type = ?', 
-                            (u['username'], fid)).fetchone()['c']
-    conn.close()
+    assigned = get_worker_assignments(u['username']).get(fid, 0)
     running = bool(u.get('factory_running', {}).get(fid, True))
     rate_per_hour = int(conf['rate'] * max(1, next_lvl) * (1 + 0.05 * assigned) * (1 if running else 0))
     next_cost = conf['cost'] * (next_lvl + 1)
@@ -2038,77 +4050,12 @@ def upgrade_factory(fid):
 
 @app.route('/api/factories')
 def api_factories():
+    # /api/factory/list ile aynı satırlar, build_cost hariç
     if 'user_id' not in session:
-        rows = []
-        for fid, conf in FACTORY_CONFIG.items():
-            rows.append({
-                "type": fid,
-                "name": conf['name'],
-                "product_type": conf.get('type'),
-                "level": 0,
-                "running": False,
-                "rate_per_hour": 0,
-                "worker_count": 0,
-                "worker_capacity": conf.get('worker_capacity', 0),
-                "bonus_pct": 0,
-                "production_interval_hours": 3,
-                "last_collect_hours_ago": 0,
-                "production_duration_minutes": None,
-                "remaining_seconds": None,
-                "collectable": False,
-                "daily_income": 0
-            })
-        return jsonify(rows)
-    u = get_user(session['user_id'])
-    conn = get_db_connection()
-    rows = []
-    for fid, conf in FACTORY_CONFIG.items():
-        lvl = u.get('factories', {}).get(fid, 0)
-        running = bool(u.get('factory_running', {}).get(fid, True))
-        assigned = conn.execute('SELECT COALESCE(SUM(count),0) AS c FROM factory_assignments WHERE owner = ? AND factory_type = ?', 
-                                (u['username'], fid)).fetchone()['c']
-        # rate per hour
-        ev = _get_current_event()
-        prod_mult = 1.0
-        if ev and ev.get('target', {}).get('type') == 'production':
-            prod_mult = float(ev.get('production_multiplier', 1.0))
-        rate_per_hour = int(conf['rate'] * max(1,lvl) * (1 + 0.05 * assigned) * prod_mult * (1 if running else 0))
-        # approximate price from global prices
-        pr = conn.execute('SELECT price FROM prices WHERE item = ?', (conf['type'],)).fetchone()
-        price = pr['price'] if pr else 0
-        daily_income = int(rate_per_hour * 24 * price)
-        last_collect = u.get('factory_last_collect', {}).get(fid, u.get('factory_last_update', {}).get(fid, time.time()))
-        elapsed_hours = round((time.time() - last_collect) / 3600.0, 2)
-        capacity = conf.get('worker_capacity', 0) * max(1, lvl)
-        bonus_pct = int(0.05 * assigned * 100)
-        # Production countdown
-        run_start = u.get('factory_run_start', {}).get(fid)
-        run_dur_min = u.get('factory_run_duration', {}).get(fid)
-        remaining_seconds = None
-        collectable = False
-        production_duration_minutes = None
-        if run_start and run_dur_min:
-            production_duration_minutes = run_dur_min
-            remaining_seconds = max(0, int(run_dur_min*60 - (time.time() - run_start)))
-            collectable = remaining_seconds == 0
-        rows.append({
-            "type": fid,
-            "name": conf['name'],
-            "level": lvl,
-            "running": running,
-            "rate_per_hour": rate_per_hour,
-            "worker_count": assigned,
-            "worker_capacity": capacity,
-            "bonus_pct": bonus_pct,
-            "production_interval_hours": 3,
-            "last_collect_hours_ago": elapsed_hours,
-            "production_duration_minutes": production_duration_minutes,
-            "remaining_seconds": remaining_seconds,
-            "collectable": collectable,
-            "daily_income": daily_income
-        })
-    conn.close()
-    return jsonify(rows)
+        rows = GUEST_FACTORY_ROWS
+    else:
+        rows = build_factory_rows(get_user(session['user_id']))
+    return jsonify([{k: v for k, v in r.items() if k != "build_cost"} for r in rows])
 
 @app.route('/api/factory/start', methods=['POST'])
 def api_factory_start():
@@ -2116,7 +4063,12 @@ def api_factory_start():
     u = get_user(session['user_id'])
     fid = request.json.get('type')
     if fid not in FACTORY_CONFIG: return jsonify({"success": False, "message": "Geçersiz fabrika!"})
-    with lock:
+    assignments = get_worker_assignments(u['username'])
+    prod_evs = _production_events()
+    def _start(u):
+        now = time.time()
+        _touch_active(u, now, assignments, prod_evs)
+        _bank_factory(u, fid, now, assignments.get(fid, 0), prod_evs)
         fr = u.get('factory_running', {})
         fr[fid] = True
         u['factory_running'] = fr
@@ -2125,9 +4077,10 @@ def api_factory_start():
         conf = FACTORY_CONFIG.get(fid, {})
         base_dur = conf.get('duration_min')
         duration_min = base_dur if base_dur else max(2, 10 - 2 * (int(lvl) - 1))
-        u.setdefault('factory_run_start', {})[fid] = time.time()
+        u.setdefault('factory_run_start', {})[fid] = now
         u.setdefault('factory_run_duration', {})[fid] = duration_min
-        save_user(u)
+    err = update_user(u['username'], _start)
+    if err: return err
     return jsonify({"success": True, "message": "Üretim başlatıldı"})
 
 @app.route('/api/factory/stop', methods=['POST'])
@@ -2136,7 +4089,12 @@ def api_factory_stop():
     u = get_user(session['user_id'])
     fid = request.json.get('type')
     if fid not in FACTORY_CONFIG: return jsonify({"success": False, "message": "Geçersiz fabrika!"})
-    with lock:
+    assignments = get_worker_assignments(u['username'])
+    prod_evs = _production_events()
+    def _stop(u):
+        now = time.time()
+        _touch_active(u, now, assignments, prod_evs)
+        _bank_factory(u, fid, now, assignments.get(fid, 0), prod_evs)
         fr = u.get('factory_running', {})
         fr[fid] = False
         u['factory_running'] = fr
@@ -2147,7 +4105,8 @@ def api_factory_stop():
         if fid in rd: del rd[fid]
         u['factory_run_start'] = rs
         u['factory_run_duration'] = rd
-        save_user(u)
+    err = update_user(u['username'], _stop)
+    if err: return err
     return jsonify({"success": True, "message": "Üretim durduruldu"})
 
 @app.route('/api/factory/assign_workers', methods=['POST'])
@@ -2162,25 +4121,36 @@ def api_factory_assign_workers():
     if level <= 0:
         return jsonify({"success": False, "message": "Önce fabrikayı kurmalısınız!"})
     capacity = FACTORY_CONFIG[fid].get('worker_capacity', 0) * level
-    with lock:
+    conn = get_db_connection()
+    row = conn.execute('SELECT * FROM factory_assignments WHERE owner = ? AND factory_type = ?', (u['username'], fid)).fetchone()
+    current = row['count'] if row else 0
+    if current + count > capacity:
+        conn.close()
+        return jsonify({"success": False, "message": f"Kapasite dolu! (Kapasite: {capacity})"})
+    assignments = get_worker_assignments(u['username'])
+    prod_evs = _production_events()
+    def _take(u):
         available = u.get('workers_available', 0)
         if available < count:
             return jsonify({"success": False, "message": "Yetersiz işçi havuzu!"})
-        conn = get_db_connection()
-        row = conn.execute('SELECT * FROM factory_assignments WHERE owner = ? AND factory_type = ?', (u['username'], fid)).fetchone()
-        current = row['count'] if row else 0
-        if current + count > capacity:
-            conn.close()
-            return jsonify({"success": False, "message": f"Kapasite dolu! (Kapasite: {capacity})"})
-        if row:
-            conn.execute('UPDATE factory_assignments SET count = count + ? WHERE id = ?', (count, row['id']))
-        else:
-            conn.execute('INSERT INTO factory_assignments (owner, factory_type, count, created_at) VALUES (?, ?, ?, ?)',
-                         (u['username'], fid, count, time.time()))
-        conn.commit()
-        conn.close()
+        # Eski işçi sayısıyla biriken üretim depoya yazılır, yeni hız şimdiden başlar
+        now = time.time()
+        _touch_active(u, now, assignments, prod_evs)
+        _bank_factory(u, fid, now, current, prod_evs)
         u['workers_available'] = available - count
-        save_user(u)
+    err = update_user(u['username'], _take)
+    if err:
+        conn.close()
+        return err
+    # Havuzdan düşüldükten sonra atama satırı yazılır
+    if row:
+        conn.execute('UPDATE factory_assignments SET count = count + ? WHERE owner = ? AND factory_type = ?', (count, u['username'], fid))
+    else:
+        conn.execute('INSERT INTO factory_assignments (owner, factory_type, count, created_at) VALUES (?, ?, ?, ?)',
+                     (u['username'], fid, count, time.time()))
+    conn.commit()
+    conn.close()
+    _forget_worker_assignments(u['username'])
     return jsonify({"success": True, "message": "İşçi atandı"})
 
 @app.route('/api/factory/unassign_workers', methods=['POST'])
@@ -2196,15 +4166,119 @@ def api_factory_unassign_workers():
     if not row:
         conn.close()
         return jsonify({"success": False, "message": "Atama bulunamadı"})
-    newc = max(0, row['count'] - count)
-    conn.execute('UPDATE factory_assignments SET count = ? WHERE id = ?', (newc, row['id']))
+    released = min(count, row['count'])
+    assignments = get_worker_assignments(u['username'])
+    prod_evs = _production_events()
+    # Koşullu düşüş: eşzamanlı iki çıkarma aynı işçiyi iki kez iade edemez
+    done = conn.execute('UPDATE factory_assignments SET count = count - ? WHERE owner = ? AND factory_type = ? AND count >= ?',
+                        (released, u['username'], fid, released)).rowcount
     conn.commit()
     conn.close()
-    with lock:
-        u['workers_available'] = u.get('workers_available', 0) + min(count, row['count'])
-        save_user(u)
+    _forget_worker_assignments(u['username'])
+    if done != 1:
+        return jsonify({"success": False, "message": "Atama değişti, tekrar deneyin."}), 409
+    def _release(u):
+        now = time.time()
+        _touch_active(u, now, assignments, prod_evs)
+        _bank_factory(u, fid, now, row['count'], prod_evs)
+        u['workers_available'] = u.get('workers_available', 0) + released
+    update_user(u['username'], _release)
     return jsonify({"success": True, "message": "İşçi çıkarıldı"})
 
+def _settle_collect(u, fid, now, assigned, prod_evs, vehicle, consumed=None):
+    """Tek fabrikanın birikimini envantere/XP'ye/göreve işler (mutate içinde).
+    Toplanan miktarı (kritik bonus dahil) ya da birikim/girdi yoksa 0 döner."""
+    conf = FACTORY_CONFIG[fid]
+    # Toplama da segment sınırı: aynı formülle birikim, küsurat depoda kalır.
+    # Tarifli fabrikada en kıt girdinin karşılamadığı kısım da depoda bekler.
+    stored = factory_stored(u, fid, now, assigned, prod_evs)
+    produced = RECIPE_GRAPH.max_output(fid, u['inventory'], int(stored))
+    if produced <= 0: return 0
+    RECIPE_GRAPH.consume(fid, u['inventory'], produced, consumed)
+    u.setdefault('factory_storage', {})[fid] = stored - produced
+    u.setdefault('factory_last_update', {})[fid] = now
+    rtype = conf['type']
+    if rtype.startswith('Vehicle:') and u.get('factory_run_start', {}).get(fid):
+        kind = rtype.split(':',1)[1]
+        capacities = {"Kamyon": 500, "Tır": 1000, "Uçak": 2000, "Gemi": 10000}
+        cap = capacities.get(kind, 100)
+        vehicle.append((kind, cap))
+        # reset run to require next start
+        u['factory_run_start'].pop(fid, None)
+        u['factory_run_duration'].pop(fid, None)
+    else:
+        u['inventory'][rtype] = u['inventory'].get(rtype, 0) + produced
+    # Random critical bonus +20% chance
+    if random.random() < 0.1:
+        produced = int(produced * 1.2)
+    u.setdefault('factory_last_collect', {})[fid] = now
+    # XP reward proportional
+    u['xp'] += produced
+    # Mission progress: production
+    m = u.get('mission') or {}
+    if m.get('kind') == 'produce':
+        m['current_qty'] = int(m.get('current_qty', 0)) + int(produced)
+        if m['current_qty'] >= m.get('target_qty', 100):
+            u['money'] += int(m.get('reward', 0))
+            u['xp'] += int(m.get('reward', 0) // 2)
+            # Next mission: buy workers
+            u['mission'] = {"kind": "workers", "description": "5 işçi satın al!", "target_qty": 5, "current_qty": 0, "reward": 1500}
+        else:
+            u['mission'] = m
+    return produced
+
+def _insert_vehicles(owner, vehicle):
+    # Araç satırı ancak belge kaydedildikten sonra eklenir
+    for kind, cap in vehicle:
+        conn = get_db_connection()
+        conn.execute('INSERT INTO vehicles (owner, type, capacity, created_at) VALUES (?, ?, ?, ?)',
+                     (owner, kind, cap, time.time()))
+        conn.commit()
+        conn.close()
+
+@app.route('/api/factory/optimize_workers', methods=['POST'])
+def api_factory_optimize_workers():
+    """En yüksek saatlik geliri veren işçi dağılımı; apply=true ise tek
+    transaction'da uygulanır (atama satırları + işçi havuzu)."""
+    if 'user_id' not in session: return jsonify({"success": False}), 401
+    u = get_user(session['user_id'])
+    if not (request.get_json(silent=True) or {}).get('apply'):
+        return jsonify({"success": True, **worker_plan(u)})
+    username = u['username']
+    with user_locks.hold(username):
+        _forget_worker_assignments(username)
+        plan = worker_plan(get_user(username))
+        current, target = plan["current"], plan["target"]
+        changed = [fid for fid in target if target[fid] != current.get(fid, 0)]
+        if not changed:
+            return jsonify({"success": True, "message": "Dağılım zaten en iyi durumda", **plan})
+        freed = sum(current.values()) - sum(target.values())
+        assignments = get_worker_assignments(username)
+        prod_evs = _production_events()
+        def _reassign(u):
+            if u.get('workers_available', 0) + freed < 0:
+                return jsonify({"success": False, "message": "İşçi havuzu değişti, tekrar deneyin."}), 409
+            now = time.time()
+            _touch_active(u, now, assignments, prod_evs)
+            # Eski işçi sayısıyla biriken üretim depoya yazılır
+            for fid in changed:
+                if u.get('factories', {}).get(fid, 0) > 0:
+                    _bank_factory(u, fid, now, current.get(fid, 0), prod_evs)
+            u['workers_available'] = u.get('workers_available', 0) + freed
+        with savepoint():
+            err = update_user(username, _reassign)
+            if err: return err
+            conn = get_db_connection()
+            for fid in changed:
+                conn.execute('DELETE FROM factory_assignments WHERE owner = ? AND factory_type = ?', (username, fid))
+                if target[fid] > 0:
+                    conn.execute('INSERT INTO factory_assignments (owner, factory_type, count, created_at) VALUES (?, ?, ?, ?)',
+                                 (username, fid, target[fid], time.time()))
+            conn.commit()
+            conn.close()
+        _forget_worker_assignments(username)
+    return jsonify({"success": True, "message": "İşçiler yeniden dağıtıldı", **plan})
+
 @app.route('/api/factory/collect', methods=['POST'])
 def collect_factory():
     if 'user_id' not in session: return jsonify({"success": False}), 401
@@ -2215,68 +4289,74 @@ def collect_factory():
     conf = FACTORY_CONFIG.get(fid)
     if not conf:
         return jsonify({"success": False, "message": "Geçersiz fabrika!"})
-    with lock:
+    # Assigned workers
+    assignments = get_worker_assignments(u['username'])
+    prod_evs = _production_events()
+    vehicle = []
+    def _collect(u):
+        del vehicle[:]
         now = time.time()
-        last = u.get('factory_last_collect', {}).get(fid, u.get('factory_last_update', {}).get(fid, now))
-        elapsed = now - last
-        if elapsed <= 0:
+        if u.get('factories', {}).get(fid, 0) <= 0:
             return jsonify({"success": False, "message": "Üretim yok!"})
-        # Assigned workers
-        conn = get_db_connection()
-        assigned = conn.execute('SELECT COALESCE(SUM(count),0) AS c FROM factory_assignments WHERE owner = ? AND factory_type = ?', 
-                                (u['username'], fid)).fetchone()['c']
-        conn.close()
-        worker_mult = 1.0 + (0.05 * assigned)
-        level = u.get('factories', {}).get(fid, 0)
-        running = bool(u.get('factory_running', {}).get(fid, True))
-        # Boost
-        is_boosted = u.get("factory_boosts", {}).get(fid, 0) > now
-        ev = _get_current_event()
-        prod_mult = 1.0
-        if ev and ev.get('target', {}).get('type') == 'production':
-            prod_mult = float(ev.get('production_multiplier', 1.0))
-        rate_per_hour = conf["rate"] * max(1, level) * worker_mult * (2 if is_boosted else 1) * prod_mult * (1 if running else 0)
-        produced = int((elapsed / 10800.0) * rate_per_hour)
-        if produced <= 0:
-            # Update last collect anyway to avoid zero spam on tiny intervals
-            u.setdefault('factory_last_collect', {})[fid] = now
-            save_user(u)
+        stored = int(factory_stored(u, fid, now, assignments.get(fid, 0), prod_evs))
+        if stored <= 0:
             return jsonify({"success": False, "message": "Üretim henüz birikmedi!"})
-        rtype = conf['type']
-        if rtype.startswith('Vehicle:') and u.get('factory_run_start', {}).get(fid):
-            kind = rtype.split(':',1)[1]
-            capacities = {"Kamyon": 500, "Tır": 1000, "Uçak": 2000, "Gemi": 10000}
-            cap = capacities.get(kind, 100)
-            conn = get_db_connection()
-            conn.execute('INSERT INTO vehicles (owner, type, capacity, created_at) VALUES (?, ?, ?, ?)',
-                         (u['username'], kind, cap, time.time()))
-            conn.commit()
-            conn.close()
-            # reset run to require next start
-            u['factory_run_start'].pop(fid, None)
-            u['factory_run_duration'].pop(fid, None)
-        else:
-            u['inventory'][rtype] = u['inventory'].get(rtype, 0) + produced
-        # Random critical bonus +20% chance
-        if random.random() < 0.1:
-            produced = int(produced * 1.2)
-        u.setdefault('factory_last_collect', {})[fid] = now
-        # XP reward proportional
-        u['xp'] += produced
-        # Mission progress: production
-        m = u.get('mission') or {}
-        if m.get('kind') == 'produce':
-            m['current_qty'] = int(m.get('current_qty', 0)) + int(produced)
-            if m['current_qty'] >= m.get('target_qty', 100):
-                u['money'] += int(m.get('reward', 0))
-                u['xp'] += int(m.get('reward', 0) // 2)
-                # Next mission: buy workers
-                u['mission'] = {"kind": "workers", "description": "5 işçi satın al!", "target_qty": 5, "current_qty": 0, "reward": 1500}
-            else:
-                u['mission'] = m
+        if RECIPE_GRAPH.max_output(fid, u['inventory'], stored) <= 0:
+            need = ", ".join(f"{ratio} {item}" for item, ratio in RECIPE_GRAPH.inputs[fid])
+            return jsonify({"success": False, "message": f"Yetersiz hammadde! 1 {conf['type']} için {need} gerekli."})
+        _touch_active(u, now, assignments, prod_evs)
+        produced = _settle_collect(u, fid, now, assignments.get(fid, 0), prod_evs, vehicle)
         check_level_up(u)
-        save_user(u)
-    return jsonify({"success": True, "message": f"{produced} {conf['type']} toplandı!"})
+        return jsonify({"success": True, "message": f"{produced} {conf['type']} toplandı!"})
+    resp = update_user(u['username'], _collect)
+    _insert_vehicles(u['username'], vehicle)
+    return resp
+
+@app.route('/api/factory/collect_all', methods=['POST'])
+def collect_all_factories():
+    """Bütün fabrikaları tek geçişte toplar: tek belge yazması, tek yedek."""
+    if 'user_id' not in session: return jsonify({"success": False}), 401
+    u = get_user(session['user_id'])
+    assignments = get_worker_assignments(u['username'])
+    prod_evs = _production_events()
+    vehicle = []
+    breakdown = []
+    def _collect_all(u):
+        del vehicle[:]
+        del breakdown[:]
+        now = time.time()
+        owned = [fid for fid in FACTORY_CONFIG if u.get('factories', {}).get(fid, 0) > 0]
+        stored = {fid: int(factory_stored(u, fid, now, assignments.get(fid, 0), prod_evs)) for fid in owned}
+        ready = [fid for fid in owned if stored[fid] > 0]
+        if not ready:
+            return jsonify({"success": False, "message": "Üretim henüz birikmedi!", "factories": []})
+        # Üretemeyen fabrika envanteri değiştirmez; ilk üreten sırada hangisiyse
+        # mevcut envanterle de üretir, o yüzden kontrol belgeye dokunmadan yapılır
+        if not any(RECIPE_GRAPH.max_output(fid, u['inventory'], stored[fid]) > 0 for fid in ready):
+            breakdown.extend({"type": fid, "name": FACTORY_CONFIG[fid]['name'], "product_type": FACTORY_CONFIG[fid]['type'],
+                              "produced": 0, "consumed": {}} for fid in owned)
+            return jsonify({"success": False, "message": "Yetersiz hammadde, üretim toplanamadı!", "factories": breakdown})
+        _touch_active(u, now, assignments, prod_evs)
+        level_before = u['level']
+        # Topolojik sıra: Demir önce envantere girer, Çelik aynı geçişte onu tüketir
+        rows = {}
+        for fid in RECIPE_GRAPH.order:
+            if fid not in owned: continue
+            consumed = {}
+            produced = _settle_collect(u, fid, now, assignments.get(fid, 0), prod_evs, vehicle, consumed) if fid in ready else 0
+            rows[fid] = {"type": fid, "name": FACTORY_CONFIG[fid]['name'],
+                         "product_type": FACTORY_CONFIG[fid]['type'], "produced": produced, "consumed": consumed}
+        breakdown.extend(rows[fid] for fid in owned)
+        collected = sum(1 for b in breakdown if b["produced"] > 0)
+        # Sırayla toplamak her fabrikada bir seviye atlatabilirdi
+        while check_level_up(u): pass
+        total = sum(b["produced"] for b in breakdown)
+        return jsonify({"success": True, "message": f"{collected} fabrikadan {total} ürün toplandı!",
+                        "total": total, "level": u['level'], "level_up": u['level'] > level_before,
+                        "factories": breakdown})
+    resp = update_user(u['username'], _collect_all)
+    _insert_vehicles(u['username'], vehicle)
+    return resp
 
 @app.route('/api/factory/boost', methods=['POST'])
 def boost_factory():
@@ -2288,19 +4368,26 @@ def boost_factory():
     # Cost: 1000 TL for 5 mins
     COST = 1000
     DURATION = 300
+    if fid not in FACTORY_CONFIG:
+        return jsonify({"success": False, "message": "Geçersiz fabrika!"})
+    assignments = get_worker_assignments(u['username'])
+    prod_evs = _production_events()
     
-    with lock:
+    def _boost(u):
         if u['money'] < COST:
              return jsonify({"success": False, "message": "Yetersiz bakiye (1000 TL gerekli)!"})
              
         if u.get("factory_boosts", {}).get(fid, 0) > time.time():
              return jsonify({"success": False, "message": "Zaten aktif!"})
              
+        now = time.time()
+        _touch_active(u, now, assignments, prod_evs)
+        _bank_factory(u, fid, now, assignments.get(fid, 0), prod_evs)
         u['money'] -= COST
         if "factory_boosts" not in u: u["factory_boosts"] = {}
-        u["factory_boosts"][fid] = time.time() + DURATION
-        save_user(u)
-        
+        u["factory_boosts"][fid] = now + DURATION
+    err = update_user(u['username'], _boost)
+    if err: return err
     return jsonify({"success": True, "message": "Fabrika hızlandırıldı!"})
 
 # Chat
@@ -2340,22 +4427,18 @@ def api_chat():
 @app.route('/api/leaderboard')
 def api_leaderboard():
     conn = get_db_connection()
-    # This is tricky with JSON data. We need to fetch all and sort in Py
-    users = conn.execute('SELECT * FROM users').fetchall()
+    # net_worth kolonu indeksli; blob'u parse etmeden ilk 20
+    users = [dict(r) for r in conn.execute('SELECT username, money, net_worth FROM users WHERE net_worth IS NOT NULL ORDER BY net_worth DESC LIMIT 20').fetchall()]
+    if not _blobs_migrated:
+        # Taşıma sürerken henüz taşınmamış oyuncular blob'daki değerleriyle sıralanır
+        dialect = db.engine.dialect.name
+        nw, money = _json_number_sql(dialect, "net_worth"), _json_number_sql(dialect, "money")
+        users += [dict(r) for r in conn.execute(
+            f'SELECT username, {money} AS money, {nw} AS net_worth FROM users '
+            f'WHERE money IS NULL ORDER BY {nw} DESC LIMIT 20').fetchall()]
+        users = sorted(users, key=lambda r: r['net_worth'] or 0, reverse=True)[:20]
     conn.close()
-    
-    leaderboard = []
-    for user_row in users:
-        d = json.loads(user_row['data'])
-        leaderboard.append({
-            "username": user_row['username'],
-            "money": d.get('money', 0),
-            "net_worth": d.get('net_worth', 0)
-        })
-        
-    # Sort by net worth
-    leaderboard.sort(key=lambda x: x['net_worth'], reverse=True)
-    return jsonify(leaderboard[:20])
+    return jsonify([{"username": r['username'], "money": r['money'], "net_worth": r['net_worth']} for r in users])
 
 # ---------------------------------------------------------
 # NEW MECHANICS ROUTES
@@ -2367,7 +4450,7 @@ def daily_bonus():
     u = get_user(session['username'])
     if not u: return jsonify({"success": False}), 401
     
-    with lock:
+    def _claim(u):
         now = time.time()
         last = u.get("last_daily_bonus", 0)
         
@@ -2383,9 +4466,9 @@ def daily_bonus():
         u["last_daily_bonus"] = now
         
         check_level_up(u)
-        save_user(u)
         
         return jsonify({"success": True, "message": f"Günlük ödül: {reward} TL ve 200 XP alındı!"})
+    return update_user(u['username'], _claim)
 
 @app.route('/api/venture', methods=['POST'])
 def venture():
@@ -2399,7 +4482,7 @@ def venture():
     if amount <= 0:
         return jsonify({"success": False, "message": "Geçersiz miktar!"})
         
-    with lock:
+    def _venture(u):
         if u["money"] < amount:
             return jsonify({"success": False, "message": "Yetersiz bakiye!"})
             
@@ -2417,8 +4500,8 @@ def venture():
             msg = f"BAŞARISIZ! {amount} TL kaybettin..."
             success = False
             
-        save_user(u)
         return jsonify({"success": True, "message": msg, "win": success})
+    return update_user(u['username'], _venture)
 
 @app.route('/api/expedition/start', methods=['POST'])
 def start_expedition():
@@ -2429,16 +4512,11 @@ def start_expedition():
     data = request.json
     type_ = data.get('type') # short, medium, long
     
-    with lock:
+    def _start(u):
         if u.get("expedition"):
              return jsonify({"success": False, "message": "Zaten bir seferdesin!"})
              
-        # Config
-        types = {
-            "short": {"name": "Kısa Mesafe", "time": 300, "cost": 100, "reward_mult": 1.5},
-            "medium": {"name": "Orta Mesafe", "time": 900, "cost": 500, "reward_mult": 2.0},
-            "long": {"name": "Uzun Mesafe", "time": 3600, "cost": 2000, "reward_mult": 3.0}
-        }
+        types = EXPEDITION_TYPES
         
         if type_ not in types:
              return jsonify({"success": False, "message": "Geçersiz sefer türü!"})
@@ -2457,8 +4535,8 @@ def start_expedition():
             "reward_mult": conf["reward_mult"]
         }
         
-        save_user(u)
         return jsonify({"success": True, "message": f"{conf['name']} seferi başladı!"})
+    return update_user(u['username'], _start)
 
 @app.route('/api/expedition/collect', methods=['POST'])
 def collect_expedition():
@@ -2466,7 +4544,7 @@ def collect_expedition():
     u = get_user(session['username'])
     if not u: return jsonify({"success": False}), 401
     
-    with lock:
+    def _collect(u):
         exp = u.get("expedition")
         if not exp:
              return jsonify({"success": False, "message": "Aktif sefer yok!"})
@@ -2485,9 +4563,9 @@ def collect_expedition():
         u["expedition"] = None
         
         check_level_up(u)
-        save_user(u)
         
         return jsonify({"success": True, "message": f"Sefer tamamlandı! {total} TL ve {int(total/10)} XP kazanıldı!"})
+    return update_user(u['username'], _collect)
 
 # ---------------------------------------------------------
 # ADMIN PAGES & ACTIONS
@@ -2505,16 +4583,21 @@ def admin_page():
     conn = get_db_connection()
     rows = conn.execute('SELECT * FROM users').fetchall()
     market_count = conn.execute('SELECT COUNT(*) AS c FROM market').fetchone()['c']
+    fac_counts = {r['username']: r['c'] for r in conn.execute('SELECT username, COUNT(*) AS c FROM user_factory_state WHERE level IS NOT NULL GROUP BY username').fetchall()}
     conn.close()
     
     users = []
     total_money = 0
     for r in rows:
         d = json.loads(r['data'])
+        if r['money'] is not None:
+            d['money'], d['level'] = r['money'], r['level']
+            factories_count = fac_counts.get(r['username'], 0)
+        else:
+            factories_count = len(d.get('factories', {}))
         conn2 = get_db_connection()
         uid_row = conn2.execute('SELECT user_id FROM user_ids WHERE username = ?', (r['username'],)).fetchone()
         conn2.close()
-        factories_count = len(d.get('factories', {}))
         users.append({
             "user_id": uid_row['user_id'] if uid_row else None,
             "username": r['username'],
@@ -2579,127 +4662,134 @@ def admin_action():
     if not u:
         return jsonify({"success": False, "message": "Kullanıcı bulunamadı!"})
     
-    with lock:
-        if action == 'add_money':
-            val = int(amount or 0)
-            u['money'] = u.get('money', 0) + max(0, val)
-            try:
-                conn = get_db_connection()
-                uid_row = conn.execute('SELECT user_id FROM user_ids WHERE username = ?', (u['username'],)).fetchone()
-                if uid_row:
-                    conn.execute('INSERT INTO user_logs (user_id, action, amount, timestamp) VALUES (?, ?, ?, ?)', (uid_row['user_id'], 'admin_add_money', val, time.time()))
-                    conn.commit()
-                conn.close()
-            except Exception:
-                pass
-        elif action == 'remove_money':
-            val = int(amount or 0)
-            u['money'] = max(0, u.get('money', 0) - max(0, val))
-            try:
-                conn = get_db_connection()
-                uid_row = conn.execute('SELECT user_id FROM user_ids WHERE username = ?', (u['username'],)).fetchone()
-                if uid_row:
-                    conn.execute('INSERT INTO user_logs (user_id, action, amount, timestamp) VALUES (?, ?, ?, ?)', (uid_row['user_id'], 'admin_remove_money', val, time.time()))
-                    conn.commit()
-                conn.close()
-            except Exception:
-                pass
-        elif action == 'set_level':
-            val = int(amount or 1)
-            u['level'] = max(1, val)
-        elif action == 'ban_user':
-            u['is_banned'] = True
-        elif action == 'unban_user':
-            u['is_banned'] = False
-        elif action == 'reset_password':
-            # set new password
-            new_pw = str(amount or '').strip()
-            if len(new_pw) < 6:
-                return jsonify({"success": False, "message": "Yeni şifre en az 6 karakter!"})
-            conn = get_db_connection()
-            conn.execute('UPDATE users SET password_hash = ? WHERE username = ?', (generate_password_hash(new_pw), u['username']))
-            conn.commit()
-            conn.close()
-        elif action == 'rename_user':
-            new_name = str(amount or '').strip()
-            if not new_name:
-                return jsonify({"success": False, "message": "Yeni kullanıcı adı gerekli!"})
-            # enforce uniqueness
-            conn = get_db_connection()
-            exists = conn.execute('SELECT username FROM users WHERE username = ?', (new_name,)).fetchone()
-            if exists:
-                conn.close()
-                return jsonify({"success": False, "message": "Bu kullanıcı adı zaten alınmış"})
-            # update primary and all references
-            conn.execute('UPDATE users SET username = ? WHERE username = ?', (new_name, u['username']))
-            # update mapping
-            conn.execute('UPDATE user_ids SET username = ? WHERE username = ?', (new_name, u['username']))
-            # update related tables
-            for tbl_col in [
-                ('lands','owner'),('workers','owner'),('buildings','owner'),('resources','owner'),
-                ('factories','owner'),('transactions','owner'),('factory_assignments','owner'),
-                ('vehicles','owner'),('logistics_tasks','owner'),('marketplace_products','seller'),('chat','username')
-            ]:
-                tbl, col = tbl_col
-                conn.execute(f'UPDATE {tbl} SET {col} = ? WHERE {col} = ?', (new_name, u['username']))
-            conn.commit()
-            conn.close()
-            u['username'] = new_name
-        elif action == 'give_land':
-            if not meta or not all(k in meta for k in ['type','size','location']):
-                return jsonify({"success": False, "message": "Meta eksik: type,size,location"})
-            conn = get_db_connection()
-            price = int(meta.get('price', 0))
-            conn.execute('INSERT INTO lands (owner, type, size, location, price, created_at) VALUES (?, ?, ?, ?, ?, ?)',
-                         (u['username'], meta['type'], meta['size'], meta['location'], price, time.time()))
-            conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
-                         (u['username'], 'admin_give_land', 0, time.time(), json.dumps(meta)))
-            conn.commit()
-            conn.close()
-        elif action == 'give_factory':
-            if not meta or not all(k in meta for k in ['type','level']):
-                return jsonify({"success": False, "message": "Meta eksik: type,level"})
-            # store high-level ownership in factories table, and user dict for gameplay
-            fid = meta['type']
-            lvl = int(meta['level'])
-            u.setdefault('factories', {})[fid] = lvl
+    if action == 'add_money':
+        val = int(amount or 0)
+        u['money'] = u.get('money', 0) + max(0, val)
+        try:
             conn = get_db_connection()
-            conn.execute('INSERT INTO factories (owner, type, level, created_at) VALUES (?, ?, ?, ?)',
-                         (u['username'], fid, lvl, time.time()))
-            conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
-                         (u['username'], 'admin_give_factory', 0, time.time(), json.dumps(meta)))
-            conn.commit()
+            uid_row = conn.execute('SELECT user_id FROM user_ids WHERE username = ?', (u['username'],)).fetchone()
+            if uid_row:
+                conn.execute('INSERT INTO user_logs (user_id, action, amount, timestamp) VALUES (?, ?, ?, ?)', (uid_row['user_id'], 'admin_add_money', val, time.time()))
+                conn.commit()
             conn.close()
-        elif action == 'set_factory_level':
-            if not meta or not all(k in meta for k in ['type','level']):
-                return jsonify({"success": False, "message": "Meta eksik: type,level"})
-            fid = meta['type']
-            lvl = int(meta['level'])
-            u.setdefault('factories', {})[fid] = lvl
-        elif action == 'reset_economy':
+        except Exception:
+            pass
+    elif action == 'remove_money':
+        val = int(amount or 0)
+        u['money'] = max(0, u.get('money', 0) - max(0, val))
+        try:
             conn = get_db_connection()
-            conn.execute('DELETE FROM lands WHERE owner = ?', (u['username'],))
-            conn.execute('DELETE FROM workers WHERE owner = ?', (u['username'],))
-            conn.execute('DELETE FROM buildings WHERE owner = ?', (u['username'],))
-            conn.execute('DELETE FROM resources WHERE owner = ?', (u['username'],))
-            conn.execute('DELETE FROM transactions WHERE owner = ?', (u['username'],))
-            conn.commit()
+            uid_row = conn.execute('SELECT user_id FROM user_ids WHERE username = ?', (u['username'],)).fetchone()
+            if uid_row:
+                conn.execute('INSERT INTO user_logs (user_id, action, amount, timestamp) VALUES (?, ?, ?, ?)', (uid_row['user_id'], 'admin_remove_money', val, time.time()))
+                conn.commit()
             conn.close()
-            # reset in-user aggregates
-            u['inventory'] = {}
-            u['factories'] = {}
-            u['factory_storage'] = {}
-            u['factory_last_update'] = {}
-        elif action == 'delete_user':
-            conn = get_db_connection()
-            conn.execute('DELETE FROM users WHERE username = ?', (target,))
-            conn.commit()
+        except Exception:
+            pass
+    elif action == 'set_level':
+        val = int(amount or 1)
+        u['level'] = max(1, val)
+    elif action == 'ban_user':
+        u['is_banned'] = True
+    elif action == 'unban_user':
+        u['is_banned'] = False
+    elif action == 'reset_password':
+        # set new password
+        new_pw = str(amount or '').strip()
+        if len(new_pw) < 6:
+            return jsonify({"success": False, "message": "Yeni şifre en az 6 karakter!"})
+        conn = get_db_connection()
+        conn.execute('UPDATE users SET password_hash = ? WHERE username = ?', (generate_password_hash(new_pw), u['username']))
+        conn.commit()
+        conn.close()
+    elif action == 'rename_user':
+        new_name = str(amount or '').strip()
+        if not new_name:
+            return jsonify({"success": False, "message": "Yeni kullanıcı adı gerekli!"})
+        # enforce uniqueness
+        conn = get_db_connection()
+        exists = conn.execute('SELECT username FROM users WHERE username = ?', (new_name,)).fetchone()
+        if exists:
             conn.close()
-            return jsonify({"success": True, "message": "Kullanıcı silindi!"})
-        else:
-            return jsonify({"success": False, "message": "Geçersiz eylem!"})
-        
-        save_user(u)
+            return jsonify({"success": False, "message": "Bu kullanıcı adı zaten alınmış"})
+        # update primary and all references
+        conn.execute('UPDATE users SET username = ? WHERE username = ?', (new_name, u['username']))
+        # update mapping
+        conn.execute('UPDATE user_ids SET username = ? WHERE username = ?', (new_name, u['username']))
+        # update related tables
+        for tbl_col in [
+            ('lands','owner'),('workers','owner'),('buildings','owner'),('resources','owner'),
+            ('factories','owner'),('transactions','owner'),('factory_assignments','owner'),
+            ('vehicles','owner'),('logistics_tasks','owner'),('marketplace_products','seller'),('chat','username'),
+            ('user_inventory','username'),('user_factory_state','username')
+        ]:
+            tbl, col = tbl_col
+            conn.execute(f'UPDATE {tbl} SET {col} = ? WHERE {col} = ?', (new_name, u['username']))
+        conn.commit()
+        conn.close()
+        _forget_user(u['username'])
+        u['username'] = new_name
+    elif action == 'give_land':
+        if not meta or not all(k in meta for k in ['type','size','location']):
+            return jsonify({"success": False, "message": "Meta eksik: type,size,location"})
+        conn = get_db_connection()
+        price = int(meta.get('price', 0))
+        conn.execute('INSERT INTO lands (owner, type, size, location, price, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                     (u['username'], meta['type'], meta['size'], meta['location'], price, time.time()))
+        conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
+                     (u['username'], 'admin_give_land', 0, time.time(), json.dumps(meta)))
+        conn.commit()
+        conn.close()
+    elif action == 'give_factory':
+        if not meta or not all(k in meta for k in ['type','level']):
+            return jsonify({"success": False, "message": "Meta eksik: type,level"})
+        # store high-level ownership in factories table, and user dict for gameplay
+        fid = meta['type']
+        lvl = int(meta['level'])
+        u.setdefault('factories', {})[fid] = lvl
+        conn = get_db_connection()
+        conn.execute('INSERT INTO factories (owner, type, level, created_at) VALUES (?, ?, ?, ?)',
+                     (u['username'], fid, lvl, time.time()))
+        conn.execute('INSERT INTO transactions (owner, type, amount, time, meta) VALUES (?, ?, ?, ?, ?)',
+                     (u['username'], 'admin_give_factory', 0, time.time(), json.dumps(meta)))
+        conn.commit()
+        conn.close()
+    elif action == 'set_factory_level':
+        if not meta or not all(k in meta for k in ['type','level']):
+            return jsonify({"success": False, "message": "Meta eksik: type,level"})
+        fid = meta['type']
+        lvl = int(meta['level'])
+        u.setdefault('factories', {})[fid] = lvl
+    elif action == 'reset_economy':
+        conn = get_db_connection()
+        conn.execute('DELETE FROM lands WHERE owner = ?', (u['username'],))
+        conn.execute('DELETE FROM workers WHERE owner = ?', (u['username'],))
+        conn.execute('DELETE FROM buildings WHERE owner = ?', (u['username'],))
+        conn.execute('DELETE FROM resources WHERE owner = ?', (u['username'],))
+        conn.execute('DELETE FROM transactions WHERE owner = ?', (u['username'],))
+        conn.commit()
+        conn.close()
+        # reset in-user aggregates
+        u['inventory'] = {}
+        u['factories'] = {}
+        u['factory_storage'] = {}
+        u['factory_last_update'] = {}
+    elif action == 'delete_user':
+        conn = get_db_connection()
+        conn.execute('DELETE FROM users WHERE username = ?', (target,))
+        conn.execute('DELETE FROM user_inventory WHERE username = ?', (u['username'],))
+        conn.execute('DELETE FROM user_factory_state WHERE username = ?', (u['username'],))
+        conn.commit()
+        conn.close()
+        _forget_user(u['username'])
+        return jsonify({"success": True, "message": "Kullanıcı silindi!"})
+    else:
+        return jsonify({"success": False, "message": "Geçersiz eylem!"})
+    
+    
+    # Admin işlemi tek seferlik yazar; araya bir oyuncu yazması girdiyse 409
+    if not save_user(u, durable=True):
+        raise UserVersionConflict(u['username'])
     
     return jsonify({"success": True, "message": "İşlem tamamlandı!"})
 
@@ -2717,10 +4807,54 @@ def api_admin_user_logs():
     if not uid:
         return jsonify([])
     conn = get_db_connection()
-    rows = conn.execute('SELECT * FROM user_logs WHERE user_id = ? ORDER BY timestamp DESC LIMIT 200', (uid,)).fetchall()
+    rows = conn.execute('SELECT * FROM user_logs WHERE user_id = ? ORDER BY timestamp DESC LIMIT 200', (uid,))
     conn.close()
     return jsonify([dict(r) for r in rows])
 
+@app.route('/api/admin/db_stats')
+def api_admin_db_stats():
+    if 'user_id' not in session: return jsonify({"success": False}), 401
+    if not session.get('is_admin'): return jsonify({"success": False}), 403
+    out = {"tx": tx_stats(), "user_writes": dict(_write_stats), "pool": pool_stats(), "timers": timer_index.stats(), "event_cache": event_cache.stats(), "price_book": price_book.stats(), "order_book": market_book.stats()}
+    if db.engine.dialect.name == "sqlite": out["wal_checkpoint"] = dict(_checkpoint_stats)
+    return jsonify(out)
+
+@app.route('/api/timers')
+def api_timers():
+    """Yaklaşan zamanlı etkiler + since'ten sonra ateşlenen olaylar.
+    Durum uçlarını saniyede bir yoklamak yerine istemci bunu seyrek çağırır."""
+    if 'user_id' not in session: return jsonify({"success": False}), 401
+    u = get_user(session['user_id'])
+    if not u: return jsonify({"success": False}), 401
+    since = request.args.get('since', 0, type=int)
+    now = time.time()
+    upcoming = sorted(({"kind": k, "target": t, "due": d, "remaining_seconds": int(d - now)}
+                       for (k, t), d in user_timers(u).items() if d > now), key=lambda e: e["due"])
+    conn = get_db_connection()
+    rows = conn.execute('SELECT id, kind, target, due, fired_at FROM timer_events WHERE username = ? AND id > ? ORDER BY id LIMIT 50',
+                        (u['username'], since)).fetchall()
+    conn.close()
+    events = [dict(r) for r in rows]
+    return jsonify({"success": True, "now": now, "upcoming": upcoming, "events": events,
+                    "last_id": events[-1]["id"] if events else since})
+
+@app.route('/api/admin/production_tick', methods=['POST'])
+def api_admin_production_tick():
+    if 'user_id' not in session: return jsonify({"success": False}), 401
+    if not session.get('is_admin'): return jsonify({"success": False}), 403
+    # dry_run: sadece hesapla (denetim), yazma; tik kendi bağlantısından okur
+    if (request.get_json(silent=True) or {}).get('dry_run'):
+        return jsonify({"success": True, **production_tick(write=False)})
+    # Yazan tik istek transaction'ında değil, arka plan işinde çalışır
+    request_production_tick()
+    return jsonify({"success": True, "queued": True, "last": dict(_production_tick_last)}), 202
+
+@app.route('/api/admin/price_tick', methods=['POST'])
+def api_admin_price_tick():
+    if 'user_id' not in session: return jsonify({"success": False}), 401
+    if not session.get('is_admin'): return jsonify({"success": False}), 403
+    return jsonify({"success": True, **price_engine_tick()})
+
 def _wrap_routes_with_session_cleanup():
     for endpoint, view_func in list(app.view_functions.items()):
         if endpoint == 'static':
@@ -2732,20 +4866,19 @@ def _wrap_routes_with_session_cleanup():
         def _wrapped(*args, __view_func=view_func, **kwargs):
             try:
                 return __view_func(*args, **kwargs)
-            finally:
-                try:
-                    db.session.remove()
-                except Exception:
-                    pass
+            except Exception:
+                abort_unit_of_work()
+                raise
 
         _wrapped._session_cleanup_wrapped = True
         app.view_functions[endpoint] = _wrapped
 
 _wrap_routes_with_session_cleanup()
 
-@app.teardown_appcontext
-def shutdown_session(exception=None):
-    db.session.remove()
+@app.errorhandler(UserVersionConflict)
+def user_conflict_error(error):
+    """CAS denemeleri tükendi: istemci tekrar denemeli"""
+    return jsonify({"success": False, "message": "Hesabınız aynı anda güncellendi, lütfen tekrar deneyin"}), 409
 
 @app.errorhandler(500)
 def internal_error(error):
@@ -2775,7 +4908,17 @@ try:
     print(f"  PORT: {os.environ.get('PORT', '5000')}")
     print(f"  FLASK_ENV: {os.environ.get('FLASK_ENV', 'development')}")
     
-    # init_db() cagrisini kaldir - uygulama cokmesin
+    # init_db() cagrisini kaldir - uygulama cokmesin (tablo silmez ama seed de yapmaz)
+    with app.app_context():
+        run_migrations()
+        if db.engine.dialect.name == "sqlite":
+            print(f"  SQLite profili: {sqlite_profile_report()}")
+            start_sqlite_checkpointer()
+        print(f"  Emir defteri: {market_book.load()} emir")
+    start_user_migrations()
+    start_timer_scheduler()
+    start_price_engine()
+    start_production_ticker()
     print("=== UYGULAMA BAŞARILIYLA BAŞLATILDI ===")
 except Exception as e:
     print(f"!!! Startup initialization failed: {e}")
@@ -2791,8 +4934,8 @@ def admin_panel():
             data = json.loads(user.data) if user.data else {}
             user_list.append({
                 'username': user.username,
-                'money': data.get('money', 0),
-                'level': data.get('level', 1),
+                'money': user.money if user.money is not None else data.get('money', 0),
+                'level': user.level if user.level is not None else data.get('level', 1),
                 'is_admin': data.get('is_admin', False)
             })
         return {'users': user_list, 'total': len(user_list)}
@@ -0,0 +1,91 @@
+"""Emir defteri ölçümü: en iyi emri heap'ten alma ile düz listede tarama
+(eski 'market' okuma biçimi) karşılaştırması, ardından binlerce bekleyen emir
+varken place() ile uçtan uca eşleşme hızı (DB yazmaları dahil).
+
+Kullanım: python bench_order_book.py [bekleyen emir sayısı] [gelen emir sayısı]
+Varsayılan 20000 bekleyen, 2000 gelen emir. Geçici bir SQLite veritabanı
+kullanır; gerçek DB'ye dokunmaz.
+"""
+import heapq
+import random
+import sys
+import time
+
+from harness import gm, in_request, log
+from sqlalchemy import text
+
+ITEMS = ["Demir", "Odun", "Taş", "Çelik"]
+TRADERS = 50
+
+def random_asks(n, seed=1):
+    rng = random.Random(seed)
+    t0 = time.time() - n
+    return [(rng.choice(ITEMS), rng.randint(1, 20), rng.randint(100, 200), t0 + i) for i in range(n)]
+
+def best_heap_us(asks, takes):
+    heap = [(p, t, i) for i, (_, _, p, t) in enumerate(asks)]
+    heapq.heapify(heap)
+    t0 = time.perf_counter()
+    for _ in range(takes):
+        heapq.heappop(heap)
+    return (time.perf_counter() - t0) / takes * 1e6
+
+def best_scan_us(asks, takes):
+    flat = [(p, t, i) for i, (_, _, p, t) in enumerate(asks)]
+    t0 = time.perf_counter()
+    for _ in range(takes):
+        k = min(range(len(flat)), key=flat.__getitem__)
+        flat[k] = flat[-1]; flat.pop()
+    return (time.perf_counter() - t0) / takes * 1e6
+
+def seed(asks):
+    with gm.app.app_context():
+        for i in range(TRADERS):
+            gm.create_user(f"t{i:03d}", "secret1")
+        gm.db.session.execute(text("UPDATE users SET money = 10000000000"))
+        gm.db.session.execute(text("INSERT INTO market (satici, item, adet, fiyat, time, side) VALUES (:s, :i, :a, :f, :t, 'sell')"),
+                              [{"s": f"t{k % TRADERS:03d}", "i": item, "a": qty, "f": price, "t": t}
+                               for k, (item, qty, price, t) in enumerate(asks)])
+        gm.db.session.commit()
+        # Kullanıcı önbelleği bakiyeyi DB'den yeniden okusun
+        for i in range(TRADERS): gm._forget_user(f"t{i:03d}")
+        return gm.market_book.load()
+
+def run_orders(n, seed_=2):
+    rng = random.Random(seed_)
+    filled = 0
+    t0 = time.perf_counter()
+    for k in range(n):
+        item = rng.choice(ITEMS)
+        name = f"t{rng.randrange(TRADERS):03d}"
+        res = in_request(lambda: gm.market_book.place(gm.get_user(name), 'buy', item, rng.randint(5, 40), rng.randint(100, 140)))
+        if res: filled += res["filled"]
+    return time.perf_counter() - t0, filled
+
+if __name__ == "__main__":
+    resting = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    incoming = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    gm.init_db()
+
+    for depth in (1000, 10000, 100000):
+        asks = random_asks(depth)
+        takes = min(500, depth)
+        h, s = best_heap_us(asks, takes), best_scan_us(asks, takes)
+        log(f"{depth:>7} bekleyen  en iyi emir  heap: {h:6.2f} µs  düz tarama: {s:9.1f} µs  ({s / h:,.0f}x)")
+
+    asks = random_asks(resting)
+    t0 = time.perf_counter()
+    n = seed(asks)
+    with gm.app.app_context():
+        t1 = time.perf_counter(); gm.market_book.load(); rebuild = time.perf_counter() - t1
+    log(f"defter {n} emirle kuruldu ({(time.perf_counter() - t0):.2f} s, yeniden kurma {rebuild * 1000:.0f} ms)")
+
+    secs, filled = run_orders(incoming)
+    stats = gm.market_book.stats()
+    log(f"{incoming} alış emri {secs:.2f} s  ({incoming / secs:,.0f} emir/s, {stats['matched'] / secs:,.0f} eşleşme/s)  "
+        f"dolan adet {filled}, toplam eşleşme {stats['matched']}")
+
+    with gm.app.app_context():
+        db_rows = {r[0]: (r[1], r[2]) for r in gm.db.session.execute(text("SELECT id, adet, side FROM market WHERE adet > 0"))}
+    mem = {o['id']: (o['qty'], o['side']) for o in gm.market_book.orders.values()}
+    log(f"bellek/DB defter eşleşiyor: {mem == db_rows} ({len(mem)} emir)", "OK" if mem == db_rows else "FAIL")
@@ -0,0 +1,110 @@
+"""production_tick ölçümü: vektörel çekirdek (_tick_arrays) ile kullanıcı başına
+factory_stored döngüsünün karşılaştırması, ardından uçtan uca DB turu.
+
+Kullanım: python bench_production_tick.py [kullanıcı sayıları...] [--db N]
+Varsayılan 10000 100000 1000000 kullanıcı, DB turu 10000 kullanıcı.
+Geçici bir SQLite veritabanı kullanır; gerçek DB'ye dokunmaz.
+"""
+import sys
+import time
+
+import numpy as np
+from harness import gm, log
+from sqlalchemy import text
+
+CHUNK = 20000
+NOW = time.time()
+
+def random_world(n, seed=1):
+    rng = np.random.default_rng(seed)
+    F = len(gm._TICK_FACTORIES)
+    level = rng.integers(0, 4, (n, F)).astype(float)
+    storage = rng.random((n, F)) * 50
+    start = NOW - rng.random((n, F)) * 86400
+    running = rng.random((n, F)) > 0.1
+    boost_end = np.where(rng.random((n, F)) > 0.8, start + rng.random((n, F)) * 3600, 0.0)
+    assigned = rng.integers(0, 6, (n, F)).astype(float)
+    last_active = NOW - rng.random(n) * 7200
+    return level, storage, start, running, boost_end, assigned, last_active
+
+def as_doc(world, i):
+    level, storage, start, running, boost_end, _, last_active = world
+    fids = gm._TICK_FACTORIES
+    return {
+        "username": f"u{i}",
+        "last_active": float(last_active[i]),
+        "factories": {f: int(level[i, j]) for j, f in enumerate(fids)},
+        "factory_storage": {f: float(storage[i, j]) for j, f in enumerate(fids)},
+        "factory_last_update": {f: float(start[i, j]) for j, f in enumerate(fids)},
+        "factory_running": {f: bool(running[i, j]) for j, f in enumerate(fids)},
+        "factory_boosts": {f: float(boost_end[i, j]) for j, f in enumerate(fids)},
+    }
+
+def vector_us(world, prod_evs):
+    n = len(world[-1])
+    t0 = time.perf_counter()
+    for lo in range(0, n, CHUNK):
+        part = [a[lo:lo + CHUNK] for a in world]
+        gm._tick_arrays(np, NOW, *part, prod_evs=prod_evs)
+    return (time.perf_counter() - t0) / n * 1e6
+
+def scalar_us(world, n, prod_evs):
+    assigned = world[5]
+    docs = [as_doc(world, i) for i in range(n)]
+    t0 = time.perf_counter()
+    for i, u in enumerate(docs):
+        for j, fid in enumerate(gm._TICK_FACTORIES):
+            gm.factory_stored(u, fid, NOW, assigned[i, j], prod_evs)
+    return (time.perf_counter() - t0) / n * 1e6
+
+def check_equal(world, n, prod_evs):
+    new, _ = gm._tick_arrays(np, NOW, *[a[:n] for a in world], prod_evs=prod_evs)
+    worst = 0.0
+    for i in range(n):
+        u = as_doc(world, i)
+        for j, fid in enumerate(gm._TICK_FACTORIES):
+            worst = max(worst, abs(new[i, j] - gm.factory_stored(u, fid, NOW, world[5][i, j], prod_evs)))
+    return worst
+
+def db_round(n):
+    world = random_world(n, seed=2)
+    level, storage, start, running, boost_end, assigned, last_active = world
+    with gm.app.app_context():
+        with gm.db.engine.begin() as conn:
+            conn.execute(text("INSERT INTO users (username, password_hash, data, is_admin, money, version) VALUES (:u, 'x', :d, 0, 0, 1)"),
+                         [{"u": f"b{i:07d}", "d": f'{{"last_active": {last_active[i]}}}'} for i in range(n)])
+            rows = []
+            for i, j in zip(*np.nonzero(level > 0)):
+                rows.append({"u": f"b{i:07d}", "f": gm._TICK_FACTORIES[j], "l": int(level[i, j]), "s": float(storage[i, j]),
+                             "t": float(start[i, j]), "r": int(running[i, j]), "b": float(boost_end[i, j])})
+            conn.execute(text("INSERT INTO user_factory_state (username, factory_type, level, storage, last_update, running, boost_until) "
+                              "VALUES (:u, :f, :l, :s, :t, :r, :b)"), rows)
+        dry = gm.production_tick(now=NOW, write=False)
+        wet = gm.production_tick(now=NOW)
+        again = gm.production_tick(now=NOW, write=False)
+    return dry, wet, again
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    db_n = 10000
+    if "--db" in args:
+        k = args.index("--db"); db_n = int(args[k + 1]); del args[k:k + 2]
+    sizes = [int(a) for a in args] or [10000, 100000, 1000000]
+    gm.init_db()
+    prod_evs = ((0.8, NOW - 7200, NOW - 3600), (1.5, NOW - 1800, NOW + 600))
+
+    base = random_world(max(sizes))
+    log(f"vektörel/skaler en büyük fark: {check_equal(base, 2000, prod_evs):.2e}")
+    scalar = scalar_us(base, min(10000, max(sizes)), prod_evs)
+    for n in sizes:
+        world = [a[:n] for a in base]
+        vec = vector_us(world, prod_evs)
+        log(f"{n:>8} kullanıcı  vektörel: {vec * n / 1e6:7.3f} s ({vec:6.2f} µs/kullanıcı)  "
+            f"skaler: ~{scalar * n / 1e6:7.2f} s ({scalar:6.1f} µs/kullanıcı)  ({scalar / vec:.0f}x)")
+
+    if db_n:
+        dry, wet, again = db_round(db_n)
+        log(f"DB turu {db_n} kullanıcı  ölçüm: {dry}")
+        log(f"DB turu yazma: {wet}")
+        status = "OK" if abs(again["produced"]) < 1e-6 * max(1.0, dry["produced"]) else "FAIL"
+        log(f"yazdıktan sonra kalan birikim {again['produced']:.6f}", status)
@@ -0,0 +1,68 @@
+"""_SAConnection.execute için ?→:pN çeviri maliyeti: eski karakter karakter
+çeviri ile derlenmiş SQL önbelleğinin (_compile_sql) karşılaştırması.
+
+Kullanım: python bench_sql_cache.py [tekrar]
+Geçici bir SQLite veritabanı kullanır; gerçek DB'ye dokunmaz.
+"""
+import sys
+import time
+
+from harness import gm, log
+from sqlalchemy import text
+
+# Sıcak yoldaki gerçek sorgular
+QUERIES = [
+    ("SELECT value FROM system_state WHERE key = ?", ("current_event",)),
+    ("SELECT user_id FROM user_ids WHERE username = ?", ("alice",)),
+    ("SELECT COALESCE(SUM(count),0) AS c FROM factory_assignments WHERE owner = ? AND factory_type = ?", ("alice", "wood_cutter")),
+    ("SELECT * FROM marketplace_products WHERE id = ?", (1,)),
+    ("INSERT INTO user_logs (user_id, action, amount, timestamp) VALUES (?, ?, ?, ?)", (1, "bench", 0, 0.0)),
+    ("UPDATE market SET adet = adet - ? WHERE id = ? AND adet >= ?", (1, 1, 1)),
+]
+
+def translate_uncached(sql, params):
+    """Önbellekten önceki execute'un yaptığı iş."""
+    out, bind, idx = [], {}, 0
+    for ch in sql:
+        if ch == '?':
+            key = f"p{idx}"; out.append(f":{key}"); bind[key] = params[idx]; idx += 1
+        else: out.append(ch)
+    sql = "".join(out)
+    return text(sql), bind, sql.lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE"))
+
+def translate_cached(sql, params):
+    clause, keys, is_write = gm._compile_sql(sql, True)
+    return clause, dict(zip(keys, params)), is_write
+
+def per_call_us(fn, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        for sql, params in QUERIES:
+            fn(sql, params)
+    return (time.perf_counter() - t0) / (n * len(QUERIES)) * 1e6
+
+def execute_us(n, cached):
+    with gm.app.app_context():
+        conn = gm.get_db_connection()
+        reads = [q for q in QUERIES if not q[0].startswith(("INSERT", "UPDATE"))]
+        t0 = time.perf_counter()
+        for _ in range(n):
+            for sql, params in reads:
+                if not cached: gm._compile_sql.cache_clear()
+                conn.execute(sql, params)
+        return (time.perf_counter() - t0) / (n * len(reads)) * 1e6
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    gm.init_db()
+
+    old = per_call_us(translate_uncached, n)
+    gm._compile_sql.cache_clear()
+    new = per_call_us(translate_cached, n)
+    log(f"çeviri   eski: {old:7.2f} µs/çağrı  önbellekli: {new:7.2f} µs/çağrı  ({old / new:.1f}x)")
+    log(f"önbellek {gm._compile_sql.cache_info()}")
+
+    m = max(1, n // 10)
+    cold = execute_us(m, cached=False)
+    warm = execute_us(m, cached=True)
+    log(f"execute  önbelleksiz: {cold:7.2f} µs/çağrı  önbellekli: {warm:7.2f} µs/çağrı")
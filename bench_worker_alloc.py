@@ -0,0 +1,70 @@
+"""optimize_worker_allocation ölçümü: işçi işçi marjinal kazanç açgözlüsü ile
+heap'in blok dağıtımının karşılaştırması ve küçük örneklerde kaba kuvvetle
+doğruluk kontrolü.
+
+Kullanım: python bench_worker_alloc.py [fabrika sayısı]
+Veritabanına dokunmaz (app import edilirken geçici SQLite kullanılır).
+"""
+import itertools
+import random
+import sys
+import time
+
+from harness import gm, log
+
+def random_factories(n, seed=1):
+    rng = random.Random(seed)
+    return [(f"f{i}", rng.uniform(0.5, 50.0), rng.randint(1, 20) * rng.randint(1, 5)) for i in range(n)]
+
+def greedy_per_worker(workers, factories):
+    """Deneme yanılmanın sunucu tarafı karşılığı: her işçi için en iyi fabrikayı tara."""
+    out = {fid: 0 for fid, _, _ in factories}
+    caps = {fid: cap for fid, _, cap in factories}
+    for _ in range(workers):
+        best = None
+        for fid, gain, _ in factories:
+            if gain > 0 and out[fid] < caps[fid] and (best is None or gain > best[1]):
+                best = (fid, gain)
+        if best is None: break
+        out[best[0]] += 1
+    return out
+
+def income(alloc, factories):
+    return sum(gain * alloc.get(fid, 0) for fid, gain, _ in factories)
+
+def brute_force(workers, factories):
+    best = 0.0
+    ranges = [range(min(cap, workers) + 1) for _, _, cap in factories]
+    for combo in itertools.product(*ranges):
+        if sum(combo) <= workers:
+            best = max(best, sum(g * c for (_, g, _), c in zip(factories, combo)))
+    return best
+
+def timed(fn, *args, repeat=1):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        out = fn(*args)
+    return (time.perf_counter() - t0) / repeat, out
+
+if __name__ == "__main__":
+    n_fac = int(sys.argv[1]) if len(sys.argv) > 1 else len(gm.FACTORY_CONFIG)
+
+    worst = 0.0
+    for seed in range(200):
+        facs = [(f, g, c % 6 + 1) for f, g, c in random_factories(4, seed)]
+        w = random.Random(seed).randint(0, 18)
+        worst = max(worst, abs(brute_force(w, facs) - income(gm.optimize_worker_allocation(w, facs), facs)))
+    log(f"kaba kuvvetle en büyük fark (200 örnek): {worst:.2e}", "OK" if worst < 1e-9 else "FAIL")
+
+    facs = random_factories(n_fac)
+    total_cap = sum(c for _, _, c in facs)
+    for workers in (100, 10_000, 1_000_000):
+        heap_s, heap_out = timed(gm.optimize_worker_allocation, workers, facs, repeat=200)
+        if workers <= 10_000:
+            naive_s, naive_out = timed(greedy_per_worker, workers, facs)
+            same = abs(income(naive_out, facs) - income(heap_out, facs)) < 1e-6
+            log(f"{n_fac} fabrika, {workers:>9} işçi  heap: {heap_s * 1e6:8.1f} µs  "
+                f"işçi işçi: {naive_s * 1e3:9.2f} ms  ({naive_s / heap_s:,.0f}x, aynı gelir: {same})")
+        else:
+            log(f"{n_fac} fabrika, {workers:>9} işçi  heap: {heap_s * 1e6:8.1f} µs  "
+                f"(toplam kapasite {total_cap}, işçi işçi çözüm atlandı)")
@@ -0,0 +1,80 @@
+"""Sıcak sorguların planlarını kontrol eder: tam tablo taraması gören sorgu
+varsa 1 ile çıkar.
+
+Kullanım: python check_indexes.py
+DATABASE_URL verilmezse göçlerle geçici bir SQLite şeması kurulur. Postgres'te
+küçük tablolarda planlayıcı yine de Seq Scan seçebildiği için kontrol
+enable_seqscan = off ile yapılır; indeks yoksa plan Seq Scan'de kalır.
+"""
+import re
+import sys
+
+from harness import gm, log
+from sqlalchemy import text
+
+# (açıklama, sorgu) - app.py'deki route'ların sıcak sorguları, yer tutucular :p
+HOT_QUERIES = [
+    ("lands by owner", "SELECT * FROM lands WHERE owner = :p"),
+    ("workers by owner", "SELECT COALESCE(SUM(count),0) AS c FROM workers WHERE owner = :p"),
+    ("resources by owner", "SELECT item, quantity FROM resources WHERE owner = :p"),
+    ("resources supply", "SELECT item, COALESCE(SUM(quantity),0) AS q FROM resources GROUP BY item"),
+    ("market recent demand", "SELECT item, COUNT(*) AS c FROM (SELECT item FROM market WHERE side = 'sell' ORDER BY time DESC LIMIT 50) recent GROUP BY item"),
+    ("factory assignments", "SELECT factory_type, COALESCE(SUM(count),0) AS c FROM factory_assignments WHERE owner = :p GROUP BY factory_type"),
+    ("vehicles by owner", "SELECT * FROM vehicles WHERE owner = :p"),
+    ("logistics tasks", "SELECT * FROM logistics_tasks WHERE owner = :p ORDER BY created_at DESC"),
+    ("marketplace history", "SELECT * FROM transactions WHERE type = 'marketplace_buy' ORDER BY time DESC LIMIT 10"),
+    ("marketplace stats", "SELECT meta FROM transactions WHERE type = 'marketplace_buy' AND time >= :p"),
+    ("marketplace avg price", "SELECT AVG(price) AS avgp FROM marketplace_products WHERE name = :p AND is_bot = 0"),
+    ("marketplace list", "SELECT * FROM marketplace_products ORDER BY created_at DESC"),
+    ("user logs", "SELECT * FROM user_logs WHERE user_id = :p ORDER BY timestamp DESC LIMIT 200"),
+    ("timer events", "SELECT id, kind, target, due, fired_at FROM timer_events WHERE username = :p AND id > 0 ORDER BY id LIMIT 50"),
+    ("chat tail", "SELECT * FROM chat ORDER BY id DESC LIMIT 50"),
+    ("market listings", "SELECT * FROM market WHERE side = 'sell' ORDER BY time DESC LIMIT 50"),
+    ("leaderboard", "SELECT username, money, net_worth FROM users WHERE net_worth IS NOT NULL ORDER BY net_worth DESC LIMIT 20"),
+    ("username lookup", "SELECT username FROM users WHERE LOWER(username) = LOWER(:p)"),
+]
+
+def plan(conn, sql):
+    if conn.dialect.name == "sqlite":
+        rows = conn.execute(text("EXPLAIN QUERY PLAN " + sql), {"p": "x"}).fetchall()
+        return [r[-1] for r in rows]
+    rows = conn.execute(text("EXPLAIN " + sql), {"p": "x"}).fetchall()
+    return [r[0] for r in rows]
+
+def full_scans(sql, lines):
+    # SQLite: "SCAN t" (indeks kullanmadan); Postgres: "Seq Scan on t".
+    # ORDER BY ... LIMIT'li sorguda sıralama için geçici B-tree yoksa SCAN,
+    # rowid/PK sırasında yürüyüp LIMIT'te durur; tam tarama sayılmaz.
+    # Alt sorgunun kendi sonucunu (CO-ROUTINE/MATERIALIZE) taramak tablo taraması değil.
+    ordered_walk = " LIMIT " in sql and not any("TEMP B-TREE" in l for l in lines)
+    subqueries = {m.group(1) for l in lines for m in [re.match(r"^\s*(?:CO-ROUTINE|MATERIALIZE) (\w+)", l)] if m}
+    bad = []
+    for line in lines:
+        m = re.match(r"^\s*SCAN (\w+)$", line)
+        if (m and not ordered_walk and m.group(1) not in subqueries) or "Seq Scan on" in line:
+            bad.append(line.strip())
+    return bad
+
+def check():
+    failed = 0
+    with gm.app.app_context():
+        gm.run_migrations()
+        with gm.db.engine.connect() as conn:
+            if conn.dialect.name == "postgresql":
+                conn.execute(text("SET enable_seqscan = off"))
+            for name, sql in HOT_QUERIES:
+                lines = plan(conn, sql)
+                bad = full_scans(sql, lines)
+                if bad:
+                    failed += 1
+                    log(f"{name}: tam tarama -> {'; '.join(bad)}", "FAIL")
+                else:
+                    log(f"{name}: {' | '.join(l.strip() for l in lines)}", "OK")
+    return failed
+
+if __name__ == "__main__":
+    n = check()
+    with gm.app.app_context():
+        version = gm.schema_version()
+    log(f"şema sürümü {version}, {n} sorgu tam tarama yapıyor", "ERROR" if n else "INFO")
+    sys.exit(1 if n else 0)
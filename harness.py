@@ -0,0 +1,32 @@
+"""bench_*, check_indexes ve tests/ için ortak düzen: DATABASE_URL verilmezse
+geçici bir SQLite veritabanı seçer (gerçek DB'ye dokunmaz) ve app'i yükler.
+
+Kullanım: from harness import gm, log, in_request
+app'ten önce içe aktarılmalı; DATABASE_URL app import edilirken okunur.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+if not os.environ.get("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'gm.db')}"
+
+import app as gm
+
+def log(msg, status="INFO"):
+    print(f"[{status}] {msg}")
+
+@contextmanager
+def request_scope(**kwargs):
+    """İş birimi açık bir istek. Commit/rollback çıkışta process_response'ta
+    yapılır; verilen dict'in 'response' anahtarına son cevap yazılır."""
+    out = {}
+    with gm.app.test_request_context(**kwargs):
+        gm.app.preprocess_request()
+        yield out
+        out["response"] = gm.app.process_response(gm.app.response_class())
+
+def in_request(fn):
+    """fn'i iş birimi açık bir istek içinde çalıştırıp sonucunu döner."""
+    with request_scope():
+        return fn()
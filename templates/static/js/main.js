@@ -1,6 +1,7 @@
 // ===== GLOBAL STATE =====
 let globalItems = {};
 let globalFactoryConfig = {};
+let gameConfigVersion = null;
 let globalPlayer = {};
 let currentSort = 'time';
 
@@ -218,6 +219,22 @@ async function fetchMarket() {
     }
 }
 
+// Sabit ayarlar sürümlü URL'den bir kez çekilir (tarayıcı önbelleği tutar);
+// /api/me yalnızca sürümü taşır, sürüm değişince yeniden yüklenir.
+async function loadGameConfig(version) {
+    if (!version || version === gameConfigVersion) return;
+    try {
+        const res = await fetch(`/api/config?v=${encodeURIComponent(version)}`);
+        if (!res.ok) return;
+        const cfg = await res.json();
+        gameConfigVersion = cfg.version;
+        globalFactoryConfig = cfg.factories || {};
+        if (globalPlayer && globalPlayer.factories) renderFactories(globalPlayer);
+    } catch (e) {
+        console.error("Config fetch error:", e);
+    }
+}
+
 async function fetchUserData() {
     try {
         const res = await fetch('/api/user/me');
@@ -256,10 +273,10 @@ function renderHUD(data) {
         is_admin: false,
         daily_bonus_available: false,
         expedition_active: false,
-        factory_config: {}
+        config_version: null
     };
     globalPlayer = player;
-    globalFactoryConfig = player.factory_config || {};
+    loadGameConfig(player.config_version);
     renderHUD(player);
     renderInventory(player);
     renderFactories(player);
@@ -0,0 +1,54 @@
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SQLITE_CHECKPOINT_INTERVAL", "0")
+# Ertelenmiş yazmaları testler kendisi boşaltır
+os.environ.setdefault("USER_FLUSH_INTERVAL", "3600")
+
+import pytest
+from sqlalchemy import text
+
+from harness import gm
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    with gm.app.app_context():
+        gm.init_db()
+
+def unique(prefix="p"):
+    return f"{prefix}{uuid.uuid4().hex[:10]}"
+
+def fund(name, money=None, level=None, items=None):
+    """Oyuncunun bakiyesini/seviyesini/envanterini doğrudan DB'de ayarlar."""
+    with gm.app.app_context():
+        sets = {"money": money, "level": level}
+        cols = [f"{k} = :{k}" for k, v in sets.items() if v is not None]
+        gm.db.session.execute(text(f"UPDATE users SET {', '.join(cols + ['version = version + 1'])} WHERE username = :u"),
+                              {"u": name, **{k: v for k, v in sets.items() if v is not None}})
+        for item, qty in (items or {}).items():
+            gm.db.session.execute(text('INSERT INTO user_inventory (username, item, qty) VALUES (:u, :i, :q) '
+                                       'ON CONFLICT (username, item) DO UPDATE SET qty = excluded.qty'),
+                                  {"u": name, "i": item, "q": qty})
+        gm.db.session.commit()
+    gm._forget_user(name)
+
+def row(name):
+    """(money, version, {ürün: adet}) - DB'deki güncel durum."""
+    with gm.app.app_context():
+        money, version = gm.db.session.execute(text('SELECT money, version FROM users WHERE username = :u'), {"u": name}).fetchone()
+        inv = dict(gm.db.session.execute(text('SELECT item, qty FROM user_inventory WHERE username = :u'), {"u": name}).fetchall())
+    return money, version, inv
+
+@pytest.fixture
+def player():
+    """Kayıt olmuş ve oturum açmış yeni oyuncu: make(**fund) -> (isim, client)."""
+    def make(**kwargs):
+        name = unique()
+        client = gm.app.test_client()
+        res = client.post('/register', json={"username": name, "password": "secret1"})
+        assert res.get_json()["success"], res.get_json()
+        if kwargs: fund(name, **kwargs)
+        return name, client
+    return make
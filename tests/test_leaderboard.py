@@ -0,0 +1,23 @@
+import json
+
+from sqlalchemy import text
+
+from conftest import gm, unique
+
+def test_unmigrated_users_rank_by_blob_until_migration_finishes(monkeypatch):
+    name = unique("legacy")
+    with gm.app.app_context():
+        gm.db.session.execute(text("INSERT INTO users (username, password_hash, data) VALUES (:u, 'x', :d)"),
+                              {"u": name, "d": json.dumps({"money": 10 ** 12, "net_worth": 10 ** 12})})
+        gm.db.session.commit()
+    try:
+        monkeypatch.setattr(gm, "_blobs_migrated", False)
+        top = gm.app.test_client().get('/api/leaderboard').get_json()
+        assert top[0] == {"username": name, "money": 10 ** 12, "net_worth": 10 ** 12}
+        monkeypatch.setattr(gm, "_blobs_migrated", True)
+        top = gm.app.test_client().get('/api/leaderboard').get_json()
+        assert name not in [r["username"] for r in top]
+    finally:
+        with gm.app.app_context():
+            gm.db.session.execute(text("DELETE FROM users WHERE username = :u"), {"u": name})
+            gm.db.session.commit()
@@ -0,0 +1,128 @@
+from sqlalchemy import text
+
+from conftest import row, unique
+from harness import gm, request_scope
+
+def book(client, item):
+    return client.get(f'/api/market/book?item={item}').get_json()
+
+def test_partial_fills_at_maker_price_then_rest(player):
+    item = unique("Cevher")
+    seller, s = player(money=0, items={item: 10})
+    buyer, b = player(money=10000)
+
+    res = s.post('/sell', json={"item": item, "adet": 10, "fiyat": 100}).get_json()
+    assert res["success"] and res["filled"] == 0 and res["rest"] == 10
+    assert row(seller)[2][item] == 0          # stok emanette
+
+    res = b.post('/buy', json={"item": item, "adet": 4, "fiyat": 110}).get_json()
+    assert (res["filled"], res["rest"], res["avg_price"]) == (4, 0, 100)
+    assert row(buyer)[0] == 10000 - 400       # yapıcının fiyatı, fark iade
+    assert row(buyer)[2][item] == 4
+    assert row(seller)[0] == 400
+    assert book(b, item)["asks"] == [{"fiyat": 100, "adet": 6}]
+
+    res = b.post('/buy', json={"item": item, "adet": 10, "fiyat": 100}).get_json()
+    assert (res["filled"], res["rest"]) == (6, 4) and res["order_id"]
+    assert row(buyer)[0] == 10000 - 1000 - 400  # kalan 4 adet emanette
+    assert row(seller)[0] == 1000
+    assert book(b, item) == {"item": item, "bids": [{"fiyat": 100, "adet": 4}], "asks": []}
+
+def test_price_time_priority(player):
+    item = unique("Cevher")
+    early, e = player(money=0, items={item: 5})
+    late, l = player(money=0, items={item: 5})
+    cheap, c = player(money=0, items={item: 5})
+    buyer, b = player(money=10000)
+    e.post('/sell', json={"item": item, "adet": 5, "fiyat": 50})
+    l.post('/sell', json={"item": item, "adet": 5, "fiyat": 50})
+    c.post('/sell', json={"item": item, "adet": 5, "fiyat": 40})
+    res = b.post('/buy', json={"item": item, "adet": 8, "fiyat": 50}).get_json()
+    assert [t["price"] for t in res["trades"]] == [40, 50]
+    assert (row(cheap)[0], row(early)[0], row(late)[0]) == (200, 150, 0)
+
+def test_cancel_refunds_escrow(player):
+    item = unique("Cevher")
+    buyer, b = player(money=1000)
+    seller, s = player(money=0, items={item: 7})
+    bid = b.post('/buy', json={"item": item, "adet": 5, "fiyat": 30}).get_json()
+    ask = s.post('/sell', json={"item": item, "adet": 7, "fiyat": 90}).get_json()
+    assert row(buyer)[0] == 850 and row(seller)[2][item] == 0
+
+    # Başkasının emri iptal edilemez
+    assert not s.post('/api/market/cancel', json={"id": bid["order_id"]}).get_json()["success"]
+    assert b.post('/api/market/cancel', json={"id": bid["order_id"]}).get_json()["success"]
+    assert s.post('/api/market/cancel', json={"id": ask["order_id"]}).get_json()["success"]
+    assert row(buyer)[0] == 1000
+    assert row(seller)[2][item] == 7
+    assert book(b, item) == {"item": item, "bids": [], "asks": []}
+    # İkinci iptal bir şey iade etmez
+    assert not b.post('/api/market/cancel', json={"id": bid["order_id"]}).get_json()["success"]
+    assert row(buyer)[0] == 1000
+
+def test_unfunded_order_writes_nothing(player):
+    item = unique("Cevher")
+    buyer, b = player(money=100)
+    before = row(buyer)
+    res = b.post('/buy', json={"item": item, "adet": 5, "fiyat": 30}).get_json()
+    assert not res["success"]
+    assert row(buyer) == before
+    assert book(b, item)["bids"] == []
+
+def test_rebuilt_book_matches_memory(player):
+    item = unique("Cevher")
+    seller, s = player(money=0, items={item: 20})
+    buyer, b = player(money=10000)
+    s.post('/sell', json={"item": item, "adet": 12, "fiyat": 20})
+    s.post('/sell', json={"item": item, "adet": 8, "fiyat": 25})
+    b.post('/buy', json={"item": item, "adet": 15, "fiyat": 25})
+    b.post('/buy', json={"item": item, "adet": 3, "fiyat": 10})
+    before = gm.market_book.depth(item)
+    with gm.app.app_context():
+        gm.market_book.load()
+    assert gm.market_book.depth(item) == before == {"bids": [{"fiyat": 10, "adet": 3}], "asks": [{"fiyat": 25, "adet": 5}]}
+
+def test_legacy_buy_is_fill_or_kill_against_the_listing(player):
+    item = unique("Cevher")
+    seller, s = player(money=0, items={item: 3})
+    buyer, b = player(money=1000)
+    ask = s.post('/sell', json={"item": item, "adet": 3, "fiyat": 10}).get_json()
+    before = row(buyer)
+    res = b.post('/buy', json={"order_id": ask["order_id"], "adet": 5}).get_json()
+    assert res == {"success": False, "message": "Yetersiz stok!"}
+    assert row(buyer) == before
+    assert book(b, item) == {"item": item, "bids": [], "asks": [{"fiyat": 10, "adet": 3}]}
+    res = b.post('/buy', json={"order_id": ask["order_id"], "adet": 2}).get_json()
+    assert (res["filled"], res["rest"], res["order_id"]) == (2, 0, None)
+    assert row(buyer)[0] == 980 and row(seller)[0] == 20
+
+def test_rolled_back_request_leaves_book_unchanged(player):
+    item = unique("Cevher")
+    seller, s = player(money=0, items={item: 5})
+    buyer, b = player(money=1000)
+    s.post('/sell', json={"item": item, "adet": 5, "fiyat": 20})
+    with request_scope() as scope:
+        assert gm.market_book.place(gm.get_user(buyer), 'buy', item, 2, 20)["filled"] == 2
+        gm.abort_unit_of_work()
+    assert scope["response"].status_code == 500
+    # Başka bir worker'ın yazması sürümü geri alınan sürümle aynı değere getirir
+    with gm.app.app_context():
+        gm.db.session.execute(text("UPDATE system_state SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT) WHERE key = 'market_version'"))
+        gm.db.session.commit()
+    assert book(b, item)["asks"] == [{"fiyat": 20, "adet": 5}]
+    assert row(seller)[0] == 0 and row(buyer)[0] == 1000
+
+def test_order_filled_elsewhere_is_not_credited_twice(player):
+    item = unique("Cevher")
+    seller, s = player(money=0, items={item: 5})
+    buyer, b = player(money=1000)
+    ask = s.post('/sell', json={"item": item, "adet": 5, "fiyat": 20}).get_json()
+    book(b, item)
+    # Başka bir worker 2 adedini doldurmuş, bu sürecin defteri henüz bilmiyor
+    with gm.app.app_context():
+        gm.db.session.execute(text('UPDATE market SET adet = adet - 2 WHERE id = :i'), {"i": ask["order_id"]})
+        gm.db.session.commit()
+    res = b.post('/buy', json={"item": item, "adet": 5, "fiyat": 20}).get_json()
+    assert (res["filled"], res["rest"]) == (3, 2)
+    assert row(seller)[0] == 60
+    assert row(buyer)[0] == 1000 - 60 - 40
@@ -0,0 +1,123 @@
+import time
+
+from sqlalchemy import text
+
+from conftest import row
+from harness import gm, request_scope
+
+def set_factories(name, storage, started=None):
+    """{fabrika: depo} - seviye 1, segment started'da (varsayılan şimdi) başlıyor."""
+    with gm.app.app_context():
+        for fid, stored in storage.items():
+            gm.db.session.execute(text(
+                'INSERT INTO user_factory_state (username, factory_type, level, storage, last_update) VALUES (:u, :f, 1, :s, :t) '
+                'ON CONFLICT (username, factory_type) DO UPDATE SET level = 1, storage = excluded.storage, last_update = excluded.last_update'),
+                {"u": name, "f": fid, "s": stored, "t": started or time.time()})
+        gm.db.session.execute(text('UPDATE users SET version = version + 1 WHERE username = :u'), {"u": name})
+        gm.db.session.commit()
+    gm._forget_user(name)
+
+def test_accrual_keeps_multiplier_of_ended_event():
+    u = {"factories": {"wood_cutter": 1}, "factory_storage": {"wood_cutter": 0},
+         "factory_last_update": {"wood_cutter": 0}, "last_active": 10 ** 9}
+    segs = ((0.8, 0, 3600),)
+    series = [gm.factory_stored(u, "wood_cutter", t, 0, segs) for t in range(3500, 3700, 1)]
+    assert all(a <= b for a, b in zip(series, series[1:]))
+    rate = gm.FACTORY_CONFIG["wood_cutter"]["rate"] / gm.PRODUCTION_INTERVAL_SEC
+    assert abs(gm.factory_stored(u, "wood_cutter", 3601, 0, segs) - rate * (3600 * 0.8 + 1)) < 1e-9
+
+def test_ended_event_stays_in_production_history(player):
+    name, _ = player()
+    now = time.time()
+    set_factories(name, {"wood_cutter": 0}, started=now - 200)
+    ev = {"title": "t", "target": {"type": "production"}, "production_multiplier": 0.8,
+          "started_at": now - 100, "end_time": now + 3600}
+    with gm.app.app_context():
+        gm._set_current_event(ev)
+        assert (0.8, now - 100, now + 3600) in gm._production_events()
+        gm._clear_current_event()
+        segs = [s for s in gm._production_events() if s[1] == now - 100]
+    assert len(segs) == 1 and segs[0][0] == 0.8 and now <= segs[0][2] < now + 60
+
+def test_polling_keeps_player_active(player):
+    """Saf okumalar da last_active'i tazeler; oyuncu AFK'ya düşmez."""
+    name, client = player()
+    with gm.app.app_context():
+        gm.db.session.execute(text("UPDATE users SET data = json_set(data, '$.last_active', :t), version = version + 1 "
+                                   "WHERE username = :u"), {"t": time.time() - gm.AFK_AFTER_SEC + 30, "u": name})
+        gm.db.session.commit()
+    gm._forget_user(name)
+    version = row(name)[1]
+    assert client.get('/api/me').get_json()["is_afk"] is False
+    with gm.app.app_context():
+        gm.flush_pending_users()
+    assert row(name)[1] == version + 1
+    client.get('/api/me')                     # ACTIVITY_TOUCH_SEC içinde tekrar yazmaz
+    with gm.app.app_context():
+        gm.flush_pending_users()
+    assert row(name)[1] == version + 1
+    gm._forget_user(name)
+    with gm.app.app_context():
+        assert time.time() - gm.get_user(name)["last_active"] < gm.ACTIVITY_TOUCH_SEC
+
+def test_production_tick_invalidates_loaded_documents(player):
+    name, _ = player(level=10)
+    set_factories(name, {"wood_cutter": 0})
+    with request_scope():
+        stale = gm.get_user(name)
+    with gm.app.app_context():
+        stats = gm.production_tick(now=time.time() + 60)
+        gm.db.session.rollback()
+        assert stats["written"] >= 1
+        stale['xp'] = stale.get('xp', 0) + 1
+        assert not gm._write_user(stale)
+
+def test_admin_tick_runs_in_the_background_job(player):
+    name, client = player()
+    set_factories(name, {"wood_cutter": 0}, started=time.time() - 3600)
+    with client.session_transaction() as sess:
+        sess['is_admin'] = True
+    res = client.post('/api/admin/production_tick', json={"dry_run": True})
+    assert res.status_code == 200 and res.get_json()["written"] == 0
+    gm._production_tick_last.clear()
+    res = client.post('/api/admin/production_tick')
+    assert res.status_code == 202 and res.get_json()["queued"]
+    deadline = time.time() + 10
+    while not gm._production_tick_last and time.time() < deadline:
+        time.sleep(0.05)
+    assert gm._production_tick_last["written"] >= 1
+
+def test_collect_all_feeds_upstream_output_downstream(player):
+    name, client = player(level=10, items={"Demir": 0, "Çelik": 0})
+    set_factories(name, {"iron_mine": 10, "steel_mill": 3})
+    res = client.post('/api/factory/collect_all').get_json()
+    assert res["success"], res
+    rows = {f["type"]: f for f in res["factories"]}
+    assert rows["steel_mill"]["consumed"] == {"Demir": 6}
+    inv = row(name)[2]
+    assert (inv["Demir"], inv["Çelik"]) == (4, 3)
+
+def test_collect_without_inputs_leaves_document_untouched(player):
+    name, client = player(level=10, items={"Demir": 1})
+    set_factories(name, {"steel_mill": 3})
+    before = row(name)
+    res = client.post('/api/factory/collect_all').get_json()
+    assert not res["success"] and "hammadde" in res["message"]
+    res = client.post('/api/factory/collect', json={"factory_id": "steel_mill"}).get_json()
+    assert not res["success"]
+    assert row(name) == before
+
+def test_recipe_graph_orders_producers_before_consumers():
+    order = gm.RECIPE_GRAPH.order
+    assert order.index("iron_mine") < order.index("steel_mill") < order.index("electronics_factory")
+    assert order.index("plastic_plant") < order.index("electronics_factory")
+
+def test_recipe_consumption_is_limited_by_scarcest_input():
+    inv = {"Plastik": 9, "Çelik": 3}
+    assert gm.RECIPE_GRAPH.max_output("electronics_factory", inv, 10) == 3
+    assert gm.RECIPE_GRAPH.max_output("electronics_factory", inv, 2) == 2
+    consumed = {}
+    gm.RECIPE_GRAPH.consume("electronics_factory", inv, 3, consumed)
+    assert inv == {"Plastik": 3, "Çelik": 0}
+    assert consumed == {"Plastik": 6, "Çelik": 3}
+    assert gm.RECIPE_GRAPH.max_output("wood_cutter", {}, 7) == 7
@@ -0,0 +1,33 @@
+import pytest
+
+from harness import gm, in_request
+
+def test_qmark_placeholders_become_named_binds():
+    clause, keys, is_write = gm._compile_sql("SELECT * FROM market WHERE item = ? AND fiyat <= ?", True)
+    assert str(clause) == "SELECT * FROM market WHERE item = :p0 AND fiyat <= :p1"
+    assert keys == ("p0", "p1") and not is_write
+
+def test_named_sql_is_left_alone():
+    clause, keys, _ = gm._compile_sql("SELECT * FROM market WHERE item = :i", False)
+    assert str(clause) == "SELECT * FROM market WHERE item = :i" and keys == ()
+
+@pytest.mark.parametrize("sql", ["INSERT INTO chat (x) VALUES (?)", "  update market SET adet = ?", "DELETE FROM market WHERE id = ?"])
+def test_writes_are_detected(sql):
+    assert gm._compile_sql(sql, True)[2]
+
+def test_same_text_compiles_once():
+    sql = "SELECT value FROM system_state WHERE key = ? -- cache test"
+    before = gm._compile_sql.cache_info()
+    first = gm._compile_sql(sql, True)
+    assert gm._compile_sql(sql, True) is first
+    after = gm._compile_sql.cache_info()
+    assert (after.misses - before.misses, after.hits - before.hits) == (1, 1)
+
+def test_execute_binds_positional_params():
+    def run():
+        conn = gm.get_db_connection()
+        row = conn.execute("SELECT ? AS a, ? AS b", (1, "x")).fetchone()
+        with pytest.raises(IndexError):
+            conn.execute("SELECT ? AS a, ? AS b", (1,))
+        return dict(row)
+    assert in_request(run) == {"a": 1, "b": "x"}
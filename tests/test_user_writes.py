@@ -0,0 +1,169 @@
+import threading
+import time
+
+from sqlalchemy import text
+
+from conftest import gm, row
+from harness import request_scope
+
+def _last_active(name):
+    with gm.app.app_context():
+        return gm.db.session.execute(text("SELECT json_extract(data, '$.last_active') FROM users WHERE username = :u"),
+                                     {"u": name}).scalar()
+
+def _set_last_active(name, ts):
+    with gm.app.app_context():
+        gm.db.session.execute(text("UPDATE users SET data = json_set(data, '$.last_active', :v) WHERE username = :u"),
+                              {"v": ts, "u": name})
+        gm.db.session.commit()
+    gm._forget_user(name)
+
+def test_polling_defers_activity_to_interval_flush(player):
+    name, client = player()
+    old = int(time.time() - 2 * gm.ACTIVITY_TOUCH_SEC)
+    _set_last_active(name, old)
+    _, version, _ = row(name)
+    for _ in range(3):
+        assert client.get('/api/me').status_code == 200
+    # Yoklama isteği yazmaz; tazelenen last_active kuyrukta bekler
+    assert _last_active(name) == old
+    assert row(name)[1] == version
+    assert gm._user_key(name) in gm._pending_users
+    with gm.app.app_context():
+        assert gm.flush_pending_users() >= 1
+    assert _last_active(name) > old
+    assert gm._user_key(name) not in gm._pending_users
+
+def test_durable_write_supersedes_pending_doc(player):
+    name, client = player()
+    _set_last_active(name, time.time() - 2 * gm.ACTIVITY_TOUCH_SEC)
+    client.get('/api/me')
+    assert gm._user_key(name) in gm._pending_users
+    with gm.app.test_request_context():
+        gm.update_user(name, lambda u: u.__setitem__("xp", 7))
+    assert gm._user_key(name) not in gm._pending_users
+    with gm.app.app_context():
+        assert gm.get_user(name)["xp"] == 7
+
+def test_update_user_retries_after_concurrent_write(player):
+    """Araya giren yazma CAS'ı bozar; mutate güncel belgeyle tekrar çalışır."""
+    name, _ = player(money=1000)
+    calls = []
+    def mutate(u):
+        if not calls:
+            # Başka bir worker'ın commit ettiği yazma
+            gm.db.session.execute(text('UPDATE users SET money = money + 100, version = version + 1 WHERE username = :u'), {"u": name})
+        calls.append(u['money'])
+        u['money'] -= 50
+    with request_scope() as scope:
+        gm.update_user(name, mutate)
+    assert scope["response"].status_code == 200
+    assert calls == [1000, 1100]
+    assert row(name)[0] == 1050
+
+def test_exhausted_cas_returns_409_and_writes_nothing(player, monkeypatch):
+    name, client = player(money=5000)
+    money, version, _ = row(name)
+    def always_conflict(doc): raise gm.UserVersionConflict(doc['username'])
+    monkeypatch.setattr(gm, "_write_user_rows", always_conflict)
+    res = client.post('/api/factory/boost', json={"factory_id": "wood_cutter"})
+    assert res.status_code == 409
+    assert row(name)[:2] == (money, version)
+
+def test_db_error_is_not_retried_as_a_conflict(player, monkeypatch):
+    name, client = player(money=5000)
+    money, version, _ = row(name)
+    calls = []
+    def broken(doc):
+        calls.append(doc['username'])
+        raise RuntimeError("disk I/O error")
+    monkeypatch.setattr(gm, "_write_user_rows", broken)
+    res = client.post('/api/factory/boost', json={"factory_id": "wood_cutter"})
+    assert res.status_code == 500
+    assert len(calls) == 1
+    assert row(name)[:2] == (money, version)
+
+def test_insufficient_balance_writes_nothing(player):
+    name, _ = player(money=100, items={"Odun": 3})
+    with request_scope() as scope:
+        u = gm.get_user(name)
+        assert not gm.adjust_user_balance(u, -500)
+        assert not gm.adjust_user_balance(u, 50, items={"Odun": -5})
+        assert gm.adjust_user_balance(u, -40, items={"Odun": -3, "Taş": 2})
+    assert scope["response"].status_code == 200
+    money, _, inv = row(name)
+    assert (money, inv["Odun"], inv["Taş"]) == (60, 0, 2)
+
+def _commit_elsewhere():
+    with gm.app.app_context():
+        gm.db.session.execute(text('UPDATE prices SET updated_at = updated_at + 1'))
+        gm.db.session.commit()
+
+def test_read_only_request_does_not_block_writers(player):
+    name, _ = player()
+    t = threading.Thread(target=_commit_elsewhere)
+    with request_scope():
+        gm.get_user(name)
+        gm.get_db_connection().execute('SELECT COUNT(*) AS c FROM prices').fetchone()
+        t.start()
+        t.join(timeout=1)
+        # Okuyan istek yazma kilidi tutmaz: diğer bağlantı beklemeden commit eder
+        assert not t.is_alive()
+    t.join()
+
+def test_commit_elsewhere_after_first_read_does_not_block_write(player):
+    """İsteğin ilk okumasından sonra başka bağlantı commit etse de yazma kilitlenmez."""
+    name, _ = player(money=1000)
+    t = threading.Thread(target=_commit_elsewhere)
+    with request_scope() as scope:
+        u = gm.get_user(name)
+        t.start()
+        t.join(timeout=0.5)
+        ok = gm.adjust_user_balance(u, -10)
+    t.join()
+    assert ok
+    assert scope["response"].status_code == 200
+    assert row(name)[0] == 990
+
+def test_abort_rolls_back_earlier_writes(player):
+    name, _ = player(money=1000)
+    with request_scope() as scope:
+        assert gm.adjust_user_balance(gm.get_user(name), 500)
+        gm.abort_unit_of_work()
+    assert scope["response"].status_code == 500
+    assert row(name)[0] == 1000
+
+def test_failed_write_fails_the_request(player):
+    """Yutulan bir yazma hatası bile isteği geri alır ve 200 dönmez."""
+    name, _ = player(money=1000)
+    with request_scope() as scope:
+        assert gm.adjust_user_balance(gm.get_user(name), 500)
+        conn = gm.get_db_connection()
+        try:
+            conn.execute('INSERT INTO no_such_table (x) VALUES (?)', (1,))
+        except Exception:
+            pass
+    assert scope["response"].status_code == 500
+    assert row(name)[0] == 1000
+
+def test_failed_read_fails_the_request(player):
+    name, _ = player(money=1000)
+    with request_scope() as scope:
+        u = gm.get_user(name)
+        conn = gm.get_db_connection()
+        try:
+            conn.execute('SELECT x FROM no_such_table').fetchall()
+        except Exception:
+            pass
+        assert gm.adjust_user_balance(u, 500)
+    assert scope["response"].status_code == 500
+    assert row(name)[0] == 1000
+
+def test_client_error_response_rolls_back(player):
+    name, _ = player(money=1000)
+    with gm.app.test_request_context():
+        gm.app.preprocess_request()
+        assert gm.adjust_user_balance(gm.get_user(name), 500)
+        resp = gm.app.process_response(gm.app.response_class(status=400))
+    assert resp.status_code == 400
+    assert row(name)[0] == 1000